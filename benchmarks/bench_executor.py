@@ -0,0 +1,243 @@
+"""
+Benchmark extmgr's own overhead on synthetic distributions: registry startup, scheduling,
+stamp I/O, setup-script generation and the executor around the build steps.
+
+Every configuration generates a random DAG of packages whose steps do (almost) nothing, writes
+their recipes to a temporary recipe root and builds them into a temporary prefix without network.
+Results are printed as a table and written as JSON for regression tracking.
+
+    python3 benchmarks/bench_executor.py --sizes 50,100,200,400 --widths 1,8,64 -o results.json
+"""
+import argparse
+import json
+import logging
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from extmgr.core import BuildConfig, Executor, HostResources, PackageRegistry, Scheduler, StampStore  # noqa: E402
+from benchmarks.synthetic import StepKind, random_dag, write_recipes  # noqa: E402
+
+# Phases reported for every configuration, in seconds
+PHASES = [
+    'registry_cold',      # scan the recipe roots and build the package index (imports all recipes)
+    'registry_warm',      # load the cached index and register the distribution
+    'distribution_load',  # import and instantiate the packages of the distribution
+    'schedule',           # run the scheduler over the DAG with builds that do nothing
+    'build_cold',         # make_distribution into an empty prefix
+    'steps',              # wall time during which at least one step command ran in build_cold
+    'build_overhead',     # build_cold minus steps, the time nothing but extmgr ran
+    'build_noop',         # make_distribution again, everything up-to-date
+    'setup_scripts',      # write the setup scripts
+    'stamp_load',         # open the stamp database and load all stamps
+]
+
+
+@contextmanager
+def timed(phases: dict[str, float], name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = time.perf_counter() - start
+
+
+def busy_time(intervals: list[tuple[float, float]]) -> float:
+    """
+    Length of the union of time intervals, steps run concurrently (e.g. source preparation).
+    """
+    res, end = 0.0, float('-inf')
+    for start, stop in sorted(intervals):
+        if stop > end:
+            res += stop - max(start, end)
+            end = stop
+    return res
+
+
+def purge_modules(roots: dict[str, Path]) -> None:
+    """
+    Forget imported recipe modules, so the next import is as cold as in a new process.
+    """
+    for module in [m for m in sys.modules if any(m.startswith(f'{root}.') for root in roots)]:
+        del sys.modules[module]
+
+
+def bench_one(work_dir: Path, n_packages: int, width: int, step_kind: StepKind, parallel: int, seed: int) -> dict:
+    """
+    Benchmark one synthetic distribution.
+
+    Args:
+        work_dir (Path): Directory for recipes, prefixes and indexes.
+        n_packages (int): Number of packages.
+        width (int): Packages per DAG layer, see `random_dag`.
+        step_kind (StepKind): Kind of the build steps.
+        parallel (int): Packages built at the same time (and jobs).
+        seed (int): Random seed of the DAG.
+
+    Returns:
+        dict: The configuration and its phase timings.
+    """
+    tag = f'n{n_packages}_w{width}'
+    dag = random_dag(n_packages, width, seed=seed)
+
+    module = f'extmgr_bench_{tag}'
+    recipes = write_recipes(work_dir / 'recipes' / module, dag, step_kind)
+    if str(recipes.parent) not in sys.path:
+        sys.path.insert(0, str(recipes.parent))
+
+    # The real recipe roots are kept, the registry is that of a whole tree
+    roots = Executor.RECIPE_ROOTS | {module: recipes}
+    index_path = work_dir / 'index' / f'{tag}.json'
+    phases: dict[str, float] = {}
+
+    purge_modules(roots)
+    with timed(phases, 'registry_cold'):
+        PackageRegistry(roots, index_path).versions()
+
+    purge_modules(roots)
+    executor = Executor()
+    with timed(phases, 'registry_warm'):
+        executor.registry = PackageRegistry(roots, index_path)
+        executor.register_distribution(tag, [(name, '1.0') for name in dag], dag)
+
+    with timed(phases, 'distribution_load'):
+        dist = executor.get_distribution(tag)
+
+    nodes = {package.name: package for package in dist.sorted_packages()}
+    with timed(phases, 'schedule'):
+        Scheduler(nodes, dag, max_parallel=parallel, n_jobs=parallel).run(lambda key, package: True)
+
+    prefix = work_dir / 'prefixes' / tag
+    config = BuildConfig(patch_dir=prefix / 'patches',
+                         build_prefix=prefix / 'build',
+                         install_prefix=prefix / 'install',
+                         cmake_build_type='Release',
+                         build_flag='bench-opt',
+                         n_jobs=parallel,
+                         max_parallel_packages=parallel)
+
+    with timed(phases, 'build_cold'):
+        ok = executor.make_distribution(tag, config)
+
+    # Every step ran once, so its last start is its only start
+    runs = StampStore.for_prefix(config.install_prefix).run_stats()
+    phases['steps'] = busy_time([(st['last'], st['last'] + st['wall']) for st in runs])
+    phases['build_overhead'] = phases['build_cold'] - phases['steps']
+
+    with timed(phases, 'build_noop'):
+        ok = executor.make_distribution(tag, config) and ok
+
+    with timed(phases, 'setup_scripts'):
+        executor._write_setup_scripts(tag, config, dist.sorted_packages())
+
+    with timed(phases, 'stamp_load'):
+        StampStore(config.install_prefix.resolve() / StampStore.DB_NAME, readonly=True)
+
+    return {
+        'packages': n_packages,
+        'width': width,
+        'edges': sum(len(deps) for deps in dag.values()),
+        'ok': ok,
+        'phases': {name: round(phases[name], 6) for name in PHASES},
+        'per_package_ms': {name: round(1000 * phases[name] / n_packages, 3) for name in PHASES},
+    }
+
+
+def machine_info() -> dict:
+    try:
+        revision = subprocess.check_output(['git', '-C', str(REPO_DIR), 'rev-parse', 'HEAD'],
+                                           text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': HostResources.cpus(),
+        'memory': HostResources.memory_total(),
+    }
+
+
+def print_table(results: list[dict]) -> None:
+    columns = ['packages', 'width'] + PHASES
+    print(' '.join(f'{c:>17}' for c in columns), file=sys.stderr)
+    for res in results:
+        row = [res['packages'], res['width']] + [f'{res["phases"][p]:.3f}' for p in PHASES]
+        print(' '.join(f'{v:>17}' for v in row), file=sys.stderr)
+
+
+def int_list(value: str) -> list[int]:
+    try:
+        res = [int(v) for v in value.split(',') if v.strip() != '']
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not a comma-separated list of integers')
+
+    if not res or min(res) <= 0:
+        raise argparse.ArgumentTypeError(f'{value} is not a comma-separated list of positive integers')
+    return res
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python3 benchmarks/bench_executor.py', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int_list, default=[50, 100, 200, 400],
+                        help='numbers of packages (default: 50,100,200,400)')
+    parser.add_argument('--widths', type=int_list, default=[1, 8, 64],
+                        help='packages per DAG layer, 1 is a chain (default: 1,8,64)')
+    parser.add_argument('--step', choices=['true', 'sleep', 'dd'], default='true', dest='step_kind',
+                        help='what the build steps do (default: true)')
+    parser.add_argument('-P', '--parallel', type=int, default=1,
+                        help='packages built at the same time (default: 1)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the DAGs (default: 0)')
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='keep recipes and prefixes in this directory (default: a temporary directory)')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='write the JSON results to this file (default: stdout)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the log of extmgr')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format='%(name)-20s %(levelname)-7s %(message)s')
+
+    work_dir = Path(args.work_dir) if args.work_dir is not None else Path(tempfile.mkdtemp(prefix='extmgr-bench-'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    try:
+        for n_packages in args.sizes:
+            for width in args.widths:
+                if width > n_packages:
+                    continue
+                print(f'Benchmarking {n_packages} packages, width {width}', file=sys.stderr)
+                results.append(bench_one(work_dir.resolve(), n_packages, width, args.step_kind, args.parallel, args.seed))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_table(results)
+
+    report = {
+        'machine': machine_info(),
+        'settings': {'step': args.step_kind, 'parallel': args.parallel, 'seed': args.seed},
+        'results': results,
+    }
+    text = json.dumps(report, indent=1)
+    if args.output is None:
+        print(text)
+    else:
+        Path(args.output).write_text(text + '\n')
+
+    return 0 if all(res['ok'] for res in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
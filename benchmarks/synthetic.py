@@ -0,0 +1,115 @@
+"""
+Synthetic packages for benchmarks: random dependency DAGs and recipe modules generated from them.
+"""
+import random
+from pathlib import Path
+from typing import Literal
+
+StepKind = Literal['true', 'sleep', 'dd']
+
+RECIPE_TEMPLATE = '''from extmgr import BasePackage
+
+
+class {class_name}(BasePackage):
+    @property
+    def name(self) -> str: return '{name}'
+
+    @property
+    def version(self) -> str: return '{version}'
+
+    def prepare_src_steps(self):
+        return [('fetch', [{fetch_cmd!r}])]
+
+    def build_steps(self):
+        return [('config', ['true']), ('build', [{build_cmd!r}])]
+
+    def setup_envvars(self):
+        return [('PATH', f'{{self.install_dir}}/bin'),
+                ('LD_LIBRARY_PATH', f'{{self.install_dir}}/lib'),
+                ('CMAKE_PREFIX_PATH', f'{{self.install_dir}}')]
+'''
+
+
+def step_command(kind: StepKind, seconds: float = 0.01, size_kb: int = 64) -> str:
+    """
+    Command of a synthetic build step.
+
+    Args:
+        kind (StepKind): `true` (nothing), `sleep` (wall time without CPU) or `dd` (writes and syncs
+            `size_kb` KiB to a temporary file).
+        seconds (float, optional): Duration of `sleep` steps. Defaults to 0.01.
+        size_kb (int, optional): Size written by `dd` steps. Defaults to 64.
+
+    Returns:
+        str: The bash command.
+    """
+    if kind == 'sleep':
+        return f'sleep {seconds}'
+    if kind == 'dd':
+        return f'f=$(mktemp) && dd if=/dev/zero of="$f" bs=1k count={size_kb} conv=fsync status=none && rm -f "$f"'
+    return 'true'
+
+
+def random_dag(n_packages: int, width: int, max_deps: int = 3, seed: int = 0) -> dict[str, list[str]]:
+    """
+    Generate a layered random DAG. Packages are split into layers of `width` packages, and
+    every package depends on up to `max_deps` random packages of the layers before it, always
+    including one of the previous layer. So `width=1` gives a chain and `width=n_packages`
+    a graph without dependencies.
+
+    Args:
+        n_packages (int): Number of packages.
+        width (int): Number of packages per layer.
+        max_deps (int, optional): Maximum number of direct dependencies. Defaults to 3.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        dict[str, list[str]]: `{package_name: [dependency_name]}`, packages named `pkg0000`, `pkg0001`, ...
+    """
+    rng = random.Random(seed)
+    width = max(1, min(width, n_packages))
+    names = [f'pkg{i:04d}' for i in range(n_packages)]
+
+    res: dict[str, list[str]] = {}
+    for i, name in enumerate(names):
+        layer = i // width
+        if layer == 0:
+            res[name] = []
+            continue
+
+        previous = names[(layer - 1) * width:layer * width]
+        earlier = names[:(layer - 1) * width]
+        deps = {rng.choice(previous)}
+        deps |= set(rng.sample(earlier, min(len(earlier), rng.randint(0, max_deps - 1))))
+        res[name] = sorted(deps)
+    return res
+
+
+def write_recipes(root: Path,
+                  dag: dict[str, list[str]],
+                  step_kind: StepKind = 'true',
+                  version: str = '1.0') -> Path:
+    """
+    Write one recipe module per package of a DAG, as a recipe root for `PackageRegistry`.
+
+    Args:
+        root (Path): Directory of the recipe package, its name is used as module name.
+        dag (dict[str, list[str]]): The packages, see `random_dag`.
+        step_kind (StepKind, optional): Kind of the build step. Defaults to `true`.
+        version (str, optional): Version of all packages. Defaults to `1.0`.
+
+    Returns:
+        Path: The recipe root.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    (root / '__init__.py').write_text('')
+
+    for name in dag:
+        text = RECIPE_TEMPLATE.format(class_name=name.capitalize(),
+                                      name=name,
+                                      version=version,
+                                      fetch_cmd='true',
+                                      build_cmd=step_command(step_kind))
+        (root / f'{name}.py').write_text(text)
+
+    return root
@@ -2,5 +2,3 @@ from .core import BasePackage, StepName, CmdList
 from .core import BaseDistribution
 from .core import BuildConfig
 from .core import ILog
-
-from .distributions import dist_python
\ No newline at end of file
@@ -0,0 +1,118 @@
+import os
+import shutil
+import subprocess
+import tarfile
+from pathlib import Path
+
+from .ILog import ILog
+
+
+class Archive(ILog):
+    def __init__(self) -> None:
+        """
+        Pack, unpack and relocate directory trees.
+
+        Archives are compressed with multithreaded `zstd` when it is available, and fall back
+        to gzip through `tarfile` otherwise.
+        """
+        super().__init__()
+
+        self.use_zstd = shutil.which('zstd') is not None and shutil.which('tar') is not None
+
+    @property
+    def suffix(self) -> str:
+        """
+        File suffix of archives created by `pack`.
+        """
+        return '.tar.zst' if self.use_zstd else '.tar.gz'
+
+    def pack(self, src_dir: Path, archive_path: Path, members: list[str] = None) -> None:
+        """
+        Pack the content of a directory into an archive. The archive is written to a
+        temporary file first and renamed in place, so readers never see partial archives.
+
+        Args:
+            src_dir (Path): Directory to pack.
+            archive_path (Path): Path of the archive, should end with `self.suffix`.
+            members (list[str], optional): Paths relative to `src_dir` to pack. Defaults to None,
+                which packs the whole directory.
+        """
+        archive_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = archive_path.with_name(f'.{archive_path.name}.{os.getpid()}.tmp')
+        members = ['.'] if members is None else members
+
+        try:
+            if self.use_zstd:
+                subprocess.run(['tar', '-I', 'zstd -T0', '-cf', str(tmp_path), '-C', str(src_dir), *members],
+                               check=True)
+            else:
+                with tarfile.open(tmp_path, 'w:gz') as tar:
+                    for member in members:
+                        tar.add(src_dir / member, arcname=member)
+            tmp_path.rename(archive_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def unpack(self, archive_path: Path, dest_dir: Path) -> None:
+        """
+        Unpack an archive created by `pack` into a directory.
+
+        Args:
+            archive_path (Path): Path of the archive.
+            dest_dir (Path): Destination directory, created if needed.
+        """
+        dest_dir.mkdir(parents=True, exist_ok=True)
+
+        if archive_path.name.endswith('.tar.zst'):
+            subprocess.run(['tar', '-I', 'zstd -T0', '-xf', str(archive_path), '-C', str(dest_dir)],
+                           check=True)
+        else:
+            with tarfile.open(archive_path, 'r:*') as tar:
+                tar.extractall(dest_dir, filter='tar')
+
+    @staticmethod
+    def relocate(root: Path, old: str, new: str) -> int:
+        """
+        Replace the absolute path `old` with `new` in all text files and symlinks under `root`.
+        Binary files are left untouched.
+
+        Args:
+            root (Path): Directory to relocate.
+            old (str): Old absolute path.
+            new (str): New absolute path.
+
+        Returns:
+            int: Number of rewritten files and symlinks.
+        """
+        if old == new:
+            return 0
+
+        old_bytes, new_bytes = old.encode(), new.encode()
+        n_rewritten = 0
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in dirnames + filenames:
+                path = Path(dirpath) / filename
+
+                if path.is_symlink():
+                    target = os.readlink(path)
+                    if target.startswith(old):
+                        path.unlink()
+                        path.symlink_to(new + target[len(old):])
+                        n_rewritten += 1
+                    continue
+
+                if not path.is_file():
+                    continue
+
+                data = path.read_bytes()
+                if b'\0' in data[:8192] or old_bytes not in data:
+                    continue
+
+                mode = path.stat().st_mode
+                path.chmod(mode | 0o200)
+                path.write_bytes(data.replace(old_bytes, new_bytes))
+                path.chmod(mode)
+                n_rewritten += 1
+
+        return n_rewritten
@@ -77,3 +77,80 @@ class BaseDistribution:
             raise ValueError("The graph has a cycle!")
 
         return [self._packages[pkg_name] for pkg_name in sorted_packages]
+
+    def dependency_closure(self, package_name: str) -> list[str]:
+        """
+        Returns the names of all direct and indirect dependencies of a package,
+        ordered so that every package comes after its own dependencies.
+
+        Args:
+            package_name (str): The name of the package.
+
+        Returns:
+            list[str]: A list of dependency names sorted by dependencies.
+        """
+        required = set()
+        stack = list(self._dependencies[package_name])
+        while stack:
+            dep = stack.pop()
+            if dep not in required:
+                required.add(dep)
+                stack += self._dependencies[dep]
+
+        return [pkg.name for pkg in self.sorted_packages() if pkg.name in required]
+
+    def dependent_closure(self, package_name: str) -> list[str]:
+        """
+        Returns the names of all packages depending directly or indirectly on a package,
+        ordered so that every package comes after its own dependencies.
+
+        Args:
+            package_name (str): The name of the package.
+
+        Returns:
+            list[str]: A list of dependent names sorted by dependencies.
+        """
+        dependents = defaultdict(list)
+        for item, deps in self._dependencies.items():
+            for dep in deps:
+                dependents[dep].append(item)
+
+        required = set()
+        stack = list(dependents[package_name])
+        while stack:
+            item = stack.pop()
+            if item not in required:
+                required.add(item)
+                stack += dependents[item]
+
+        return [pkg.name for pkg in self.sorted_packages() if pkg.name in required]
+
+    def select(self, only: list[str] = None, from_: list[str] = None, until: list[str] = None) -> list[str]:
+        """
+        Returns a part of the distribution. Every given selector restricts the selection, e.g.
+        `from_` and `until` together select the packages on the paths between two packages.
+
+        Args:
+            only (list[str], optional): Just these packages. Defaults to None.
+            from_ (list[str], optional): These packages and all packages depending on them. Defaults to None.
+            until (list[str], optional): These packages and all their dependencies. Defaults to None.
+
+        Raises:
+            ValueError: If a selector names a package that is not in the distribution.
+
+        Returns:
+            list[str]: The names of the selected packages sorted by dependencies.
+        """
+        unknown = [p for p in (only or []) + (from_ or []) + (until or []) if p not in self._packages]
+        if unknown:
+            raise ValueError(f'Package {", ".join(unknown)} not in distribution {self.name}')
+
+        selected = set(self._packages)
+        if only is not None:
+            selected &= set(only)
+        if from_ is not None:
+            selected &= set(from_).union(*(self.dependent_closure(p) for p in from_))
+        if until is not None:
+            selected &= set(until).union(*(self.dependency_closure(p) for p in until))
+
+        return [pkg.name for pkg in self.sorted_packages() if pkg.name in selected]
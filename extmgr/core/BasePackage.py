@@ -1,22 +1,48 @@
 from abc import ABC, abstractmethod
 from pathlib import Path
-from collections import deque, defaultdict
+from contextlib import nullcontext
+import functools
+import hashlib
+import os
+import re
+import shutil
 import subprocess
-import sys
+import threading
 import time
-import json
 from typing import Literal
 
 from .BuildConfig import BuildConfig
 from .ILog import ILog
+from .JobServer import JobServer
+from .Fingerprint import Fingerprint
+from .StampStore import StampStore
+from .FileLock import FileLock
+from .CompilerCache import CompilerCache
+from .StepLog import StepLog
+from .BuildEvent import BuildEvent, EventKind
+from .EventBus import EventBus
 
 StepName = str
 CmdList = list[str]
+EnvChanges = list[tuple[Literal['prepend', 'append', 'set', 'unset'], str, str]]
 
 
 class BasePackage(ABC, ILog):
     _packages: list['BasePackage'] = []  # All packages that have been created
 
+    # Resource hints, override them in subclasses of packages with known needs
+    max_jobs: int = None  # Never build with more jobs than this
+    mem_per_job: int = None  # Peak memory of one compile job in bytes, measured in previous builds if None
+
+    # Number of output lines of a failed step that are printed
+    LOG_TAIL_LINES = 50
+
+    # Variables that change in every bash, ignored when capturing the environment of setup commands
+    VOLATILE_ENVVARS = ('_', 'SHLVL', 'PWD', 'OLDPWD')
+
+    # Evaluating the setup of a package evaluates its dependencies first
+    _setup_env_lock = threading.RLock()
+
     def __init__(self) -> None:
         ABC.__init__(self)
         ILog.__init__(self)
@@ -30,16 +56,37 @@ class BasePackage(ABC, ILog):
         # Build flag, e.g. x86_64-el9-gcc13-opt
         self.build_flag: str = None
 
+        # Number of parallel jobs for this package, may be reduced by the scheduler
+        self.n_jobs: int | str = None
+
+        # Jobserver shared by all concurrent builds, set by the executor
+        self.jobserver: JobServer = None
+
+        # Compiler cache used as compiler launcher, set by the executor
+        self.compiler_cache: CompilerCache = None
+
+        # Receives the build events of the package, set by the executor
+        self.events: EventBus = None
+
+        # Packages this package depends on, set by the executor
+        self.dependencies: list['BasePackage'] = []
+
+        # Changes of the environment by the package's setup, evaluated once, see `setup_env`
+        self._setup_env: EnvChanges = None
+
+        # Fingerprint of the installed package, computed once per configuration, see `fingerprint`
+        self._fingerprint: str = None
+
         # Package's private directories
         self.pkg_base_dir: Path = None  # Base directory
         self.version_dir: Path = None  # Version directory
         self.source_dir: Path = None  # Source directory
         self.build_dir: Path = None  # Build directory
         self.install_dir: Path = None  # Install directory
-        self.stamp_path: Path = None  # Stamp file path
+        self.stamp_store: StampStore = None  # Stamp database of the install prefix
 
-        # Step timestamps, {StepName: Time Stamp}, e.g. {'download': 1234567890, 'patch': 1234567890, ...}
-        self.step_stamp: dict[StepName, float] = defaultdict(float)
+        # Step stamps, {StepName: {'fingerprint': ..., 'time': ...}}, e.g. {'download': {'fingerprint': 'ab12...', 'time': 1234567890}, ...}
+        self.step_stamp: dict[StepName, dict] = {}
         self.tmp_bash_path: Path = None  # Temporary bash file path
 
     @property
@@ -68,7 +115,7 @@ class BasePackage(ABC, ILog):
     def prepare_src_steps(self) -> list[tuple[StepName, CmdList]]:
         """
         Return a list of `(step_name, step_commands)` tuples. The `step_name` will be used as the
-        key in the `build_stamp` file to store the step's timestamp. The `step_commands` should
+        key in the `build_stamp` file to store the step's stamp. The `step_commands` should
         be a list of bash commands to be executed.
 
         You should use this method to prepare the source code for building. This could include
@@ -83,7 +130,7 @@ class BasePackage(ABC, ILog):
     def build_steps(self) -> list[tuple[StepName, CmdList]]:
         """
         Return a list of `(step_name, step_commands)` tuples. The `step_name` will be used as the
-        key in the `build_stamp` file to store the step's timestamp. The `step_commands` should
+        key in the `build_stamp` file to store the step's stamp. The `step_commands` should
         be a list of bash commands to be executed.
 
         You should use this method to build and install the package. This could include running
@@ -94,20 +141,35 @@ class BasePackage(ABC, ILog):
         """
         raise NotImplementedError
 
-    @abstractmethod
+    def setup_envvars(self) -> list[tuple[str, str]]:
+        """
+        Return a list of `(variable, path)` tuples, the paths to prepend to path-like environment
+        variables (`PATH`, `LD_LIBRARY_PATH`, ...) to use the package.
+
+        Setup scripts of a distribution combine the paths of all its packages into a single
+        export per variable. Setup that is not a list of paths, e.g. sourcing a script installed
+        by the package, belongs in `setup_cmds` instead.
+
+        Returns:
+            list[tuple[str, str]]: List of `(variable, path)` tuples
+        """
+        return []
+
     def setup_cmds(self) -> dict[str, CmdList]:
         """
         Return `{shell_type: setup_cmd}` dictionary where `shell_type` is the type of shell
         (`sh`, `csh`, ...) and `setup_cmd` is the list of commands to be executed
         in that shell.
 
-        You should use this method to set up the environment variables, paths, etc. needed to
-        use the package.
+        By default, these prepend the `setup_envvars` one by one. Override this method for
+        packages whose setup cannot be expressed by `setup_envvars`.
 
         Returns:
             dict[str, CmdList]: `{shell_type: setup_cmd}` dictionary
         """
-        raise NotImplementedError
+        envvars = self.setup_envvars()
+        return {'sh': self.append_envvar(envvars, 'sh'),
+                'csh': self.append_envvar(envvars, 'csh')}
 
     ################################################################
     ####################### Magic functions ########################
@@ -132,12 +194,12 @@ class BasePackage(ABC, ILog):
         self.patch_dir = config.patch_dir.resolve()
 
         self.build_flag = config.build_flag
+        self.n_jobs = config.n_jobs
 
         self.pkg_base_dir = self.external_prefix / self.name
         self.version_dir = self.pkg_base_dir / self.version
         self.source_dir = self.version_dir / 'src'
         self.install_dir = self.version_dir / self.build_flag
-        self.stamp_path = self.version_dir / f'step_stamp.json'
 
         self.build_dir = config.build_prefix / self.name / self.version / self.build_flag
         self.tmp_bash_path = self.build_dir / f'tmp-{self.build_flag}.sh'
@@ -146,20 +208,14 @@ class BasePackage(ABC, ILog):
         self.debug(f'Source directory: {self.source_dir}')
         self.debug(f'Build directory: {self.build_dir}')
         self.debug(f'Install directory: {self.install_dir}')
-        self.debug(f'Stamp file: {self.stamp_path}')
         self.debug(f'Build flag: {self.build_flag}')
 
-        # Try to load stamp file
-        if self.stamp_path.exists():
-            try:
-                with open(self.stamp_path, 'r') as f:
-                    tmp_dict = json.load(f)
-                    self.step_stamp = defaultdict(int)
-                    for k, v in tmp_dict.items():
-                        self.step_stamp[k] = v
-            except Exception as e:
-                self.error(f'Failed to load stamp file: {e}, please check it or remove it!')
-                raise RuntimeError('Failed to load stamp file')
+        self._setup_env = None
+        self._fingerprint = None
+
+        # Stamps of all packages are loaded at once when the prefix's store is opened
+        self.stamp_store = StampStore.for_prefix(self.external_prefix, readonly=config.dry_run)
+        self.step_stamp = self.stamp_store.stamps_of(self.name, self.version)
 
     def prepare_directories(self) -> None:
         """
@@ -183,7 +239,267 @@ class BasePackage(ABC, ILog):
             else:
                 d.mkdir(parents=True, exist_ok=True)
 
-    def _make(self, env_setup_cmds: CmdList) -> bool:
+    def lock_source(self, shared: bool = False) -> FileLock | nullcontext:
+        """
+        Cross-process lock of the source directory. Preparing the source takes it exclusively,
+        builds of all build flags take it shared.
+
+        Args:
+            shared (bool, optional): Take a shared lock. Defaults to False.
+
+        Returns:
+            FileLock | nullcontext: The lock, to be used in a `with` statement. Nothing is locked in dry run.
+        """
+        if self.build_config.dry_run:
+            return nullcontext()
+        return FileLock(self.version_dir / '.src.lock', shared=shared)
+
+    def lock_install(self) -> FileLock | nullcontext:
+        """
+        Cross-process lock of the install directory (and the build directory) of the current build flag.
+
+        Returns:
+            FileLock | nullcontext: The lock, to be used in a `with` statement. Nothing is locked in dry run.
+        """
+        if self.build_config.dry_run:
+            return nullcontext()
+        return FileLock(self.version_dir / f'.{self.build_flag}.lock')
+
+    def emit(self, kind: EventKind, flag: str = None, **kwargs) -> None:
+        """
+        Emit a build event of the package, if anyone is subscribed to the executor's events.
+
+        Args:
+            kind (EventKind): The kind of the event.
+            flag (str, optional): The build flag of the event. Defaults to None, the package's build flag.
+            **kwargs: Other fields of the `BuildEvent`.
+        """
+        if self.events is not None and self.events.active:
+            self.events.emit(BuildEvent(kind, self.name, self.version, self.build_flag if flag is None else flag, **kwargs))
+
+    def emit_lock_wait(self, lock: FileLock | None, flag: str = None) -> None:
+        """
+        Emit a `lock_wait` event if taking the lock had to wait for another process.
+
+        Args:
+            lock (FileLock | None): The lock taken, None in dry run.
+            flag (str, optional): The build flag of the event. Defaults to None, the package's build flag.
+        """
+        if lock is not None and lock.waited > 0:
+            self.emit('lock_wait', flag, duration=lock.waited, data={'lock': str(lock.path)})
+
+    def reload_stamps(self) -> None:
+        """
+        Re-read the stamps of the package from the stamp database, e.g. after waiting
+        for a lock held by another process that may have run some steps.
+        """
+        self.step_stamp = self.stamp_store.stamps_of(self.name, self.version, refresh=True)
+
+    def setup_env(self) -> EnvChanges:
+        """
+        The changes the package's setup makes to the environment, evaluated once per package
+        and build flag. `setup_envvars` are taken as they are. Other `setup_cmds` (e.g. sourcing
+        a script of the package) are run once in bash, on top of the environment of the
+        dependencies, and the environment after them is compared with the one before.
+
+        Raises:
+            RuntimeError: If the setup commands fail.
+
+        Returns:
+            EnvChanges: List of `(operation, variable, value)` tuples, see `apply_env`.
+        """
+        with self._setup_env_lock:
+            if self._setup_env is None:
+                self._setup_env = self._eval_setup_env()
+            return self._setup_env
+
+    def _eval_setup_env(self) -> EnvChanges:
+        envvars = self.setup_envvars()
+        if envvars:
+            return [('prepend', k, v) for k, v in envvars]
+
+        cmds = self.setup_cmds().get('sh', [])
+        if not cmds:
+            return []
+
+        self.debug('Evaluating environment setup commands')
+        before = self.dependency_env()
+        script = 'set -e\n{\n' + '\n'.join(cmds) + '\n} >&2\nenv -0'
+        proc = subprocess.run(['bash', '-c', script], env=before, stdout=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise RuntimeError(f'environment setup commands of {self.name} failed with exit code {proc.returncode}')
+
+        after = dict(item.split('=', 1) for item in proc.stdout.decode().split('\0') if '=' in item)
+
+        res: EnvChanges = []
+        for k, v in after.items():
+            old = before.get(k)
+            if k in self.VOLATILE_ENVVARS or v == old:
+                continue
+
+            if old and v.endswith(':' + old):
+                res.append(('prepend', k, v[:-len(old) - 1]))
+            elif old and v.startswith(old + ':'):
+                res.append(('append', k, v[len(old) + 1:]))
+            elif not old and k.endswith('PATH'):
+                # Path lists of packages set up before are kept, as if they had been set
+                res.append(('prepend', k, v))
+            else:
+                res.append(('set', k, v))
+
+        res += [('unset', k, '') for k in before if k not in after and k not in self.VOLATILE_ENVVARS]
+        return res
+
+    @staticmethod
+    def apply_env(env: dict[str, str], changes: EnvChanges) -> dict[str, str]:
+        """
+        Apply environment changes, see `setup_env`.
+
+        Args:
+            env (dict[str, str]): The environment, changed in place.
+            changes (EnvChanges): `(operation, variable, value)` tuples. `prepend` and `append` add
+                a path to a path list, `set` replaces the value and `unset` removes the variable.
+
+        Returns:
+            dict[str, str]: The environment.
+        """
+        for op, k, v in changes:
+            old = env.get(k)
+            if op == 'unset':
+                env.pop(k, None)
+            elif op == 'prepend' and old:
+                env[k] = f'{v}:{old}'
+            elif op == 'append' and old:
+                env[k] = f'{old}:{v}'
+            else:
+                env[k] = v
+        return env
+
+    def dependency_closure(self) -> list['BasePackage']:
+        """
+        Return all direct and indirect dependencies of the package, every package after its own dependencies.
+
+        Returns:
+            list[BasePackage]: The dependencies.
+        """
+        res: list[BasePackage] = []
+        seen: set[int] = set()
+
+        def visit(package: BasePackage) -> None:
+            for dep in package.dependencies:
+                if id(dep) not in seen:
+                    seen.add(id(dep))
+                    visit(dep)
+                    res.append(dep)
+
+        visit(self)
+        return res
+
+    def dependency_env(self) -> dict[str, str]:
+        """
+        The environment the build steps run in: the current environment with the setup of all
+        direct and indirect dependencies applied in dependency order.
+
+        Raises:
+            RuntimeError: If the setup commands of a dependency fail.
+
+        Returns:
+            dict[str, str]: The environment.
+        """
+        env = dict(os.environ)
+        for dep in self.dependency_closure():
+            self.apply_env(env, dep.setup_env())
+        return env
+
+    def flagged_build_steps(self) -> list[tuple[StepName, CmdList]]:
+        """
+        Return the build steps with the build flag prepended to their names,
+        as they are recorded in the stamps.
+
+        Returns:
+            list[tuple[StepName, CmdList]]: List of `(step_name, [step_commands])` tuples
+        """
+        return [(f'{self.build_flag}-{step_name}', cmd_list) for step_name, cmd_list in self.build_steps()]
+
+    def step_fingerprints(self, steps: list[tuple[StepName, CmdList]], upstream: list[str]) -> list[str]:
+        """
+        Compute the fingerprints of a chain of steps. Each step's fingerprint covers its commands,
+        the input files they refer to and the fingerprint of the previous step (or `upstream`
+        for the first step), so a change invalidates the step and all steps after it.
+
+        Args:
+            steps (list[tuple[StepName, CmdList]]): List of `(step_name, step_commands)` tuples.
+            upstream (list[str]): Fingerprints the first step depends on.
+
+        Returns:
+            list[str]: Fingerprint of each step.
+        """
+        # Files under the prefixes are produced by the build, not inputs of the recipe
+        exclude = [self.build_config.install_prefix.resolve(), self.build_config.build_prefix.resolve()]
+
+        res = []
+        for step_name, cmd_list in steps:
+            upstream = [Fingerprint.step(step_name, cmd_list, upstream, exclude)]
+            res += upstream
+        return res
+
+    def fingerprints(self) -> tuple[list[str], list[str]]:
+        """
+        Compute the fingerprints of the source preparation steps and of the build steps.
+        The first build step depends on the last source preparation step and on the
+        fingerprints of all dependency packages.
+
+        Returns:
+            tuple[list[str], list[str]]: Fingerprints of `prepare_src_steps()` and `flagged_build_steps()`.
+        """
+        src_fps = self.step_fingerprints(self.prepare_src_steps(), [])
+
+        upstream = src_fps[-1:]
+        for dep in sorted(self.dependencies, key=lambda p: p.name):
+            upstream.append(f'{dep.name}-{dep.version}:{dep.fingerprint()}')
+
+        return src_fps, self.step_fingerprints(self.flagged_build_steps(), upstream)
+
+    def fingerprint(self) -> str:
+        """
+        Fingerprint of the installed package, i.e. of its last step. It is computed once per
+        configuration, since every dependent package's fingerprint includes it.
+
+        Returns:
+            str: The fingerprint.
+        """
+        if self._fingerprint is None:
+            src_fps, build_fps = self.fingerprints()
+            self._fingerprint = (src_fps + build_fps)[-1] if src_fps + build_fps else f'{self.name}-{self.version}'
+        return self._fingerprint
+
+    def _stamp_fingerprint(self, step_name: StepName) -> str:
+        stamp = self.step_stamp.get(step_name)
+        return stamp.get('fingerprint') if isinstance(stamp, dict) else None
+
+    def is_built(self) -> bool:
+        """
+        Check whether all build steps of the package are up-to-date for the current build flag.
+
+        Returns:
+            bool: True if every build step has a stamp matching its fingerprint, False otherwise.
+        """
+        _, build_fps = self.fingerprints()
+        return all(self._stamp_fingerprint(step_name) == fp
+                   for (step_name, _), fp in zip(self.flagged_build_steps(), build_fps))
+
+    def mark_built(self) -> None:
+        """
+        Stamp all build steps of the package as executed, e.g. after restoring
+        the install directory from a cache.
+        """
+        now = time.time()
+        _, build_fps = self.fingerprints()
+        for (step_name, _), fp in zip(self.flagged_build_steps(), build_fps):
+            self.step_stamp[step_name] = {'fingerprint': fp, 'time': now}
+        self.save_stamp([step_name for step_name, _ in self.flagged_build_steps()])
+
+    def _make(self) -> bool:
         """
         Make the package
 
@@ -191,7 +507,16 @@ class BasePackage(ABC, ILog):
             bool: True if the package was made successfully, False otherwise.
         """
         self.info(f'Making package {self.name} {self.version}')
+        return self._prepare_source() and self._build()
+
+    def _prepare_source(self) -> bool:
+        """
+        Prepare the directories and run the source preparation steps. This does not depend
+        on other packages, so it can run ahead of the builds of the dependencies.
 
+        Returns:
+            bool: True if the source was prepared successfully, False otherwise.
+        """
         self.info("Preparing directories")
         try:
             self.prepare_directories()
@@ -200,67 +525,91 @@ class BasePackage(ABC, ILog):
             return False
 
         self.info(f'Preparing source for package {self.name}')
-        if not self._exec_steps(env_setup_cmds, self.prepare_src_steps(), add_flag=False):
-            return False
+        steps = self.prepare_src_steps()
+        with self.lock_source() as lock:
+            self.emit_lock_wait(lock, flag='')
+
+            # Another process may have prepared the source while we were waiting
+            self.reload_stamps()
+            return self._exec_steps(steps, self.step_fingerprints(steps, []))
 
+    def _build(self) -> bool:
+        """
+        Run the build steps in the environment of the dependencies, and evaluate the environment
+        setup of the package. The source must have been prepared with `_prepare_source`.
+
+        Returns:
+            bool: True if the package was built successfully, False otherwise.
+        """
         self.info(f'Building package {self.name}')
-        if not self._exec_steps(env_setup_cmds, self.build_steps(), add_flag=True):
-            return False
+        _, build_fps = self.fingerprints()
+        with self.lock_source(shared=True) as lock:
+            self.emit_lock_wait(lock)
+            if not self._exec_steps(self.flagged_build_steps(), build_fps, with_dependencies=True):
+                return False
 
         if not self.build_config.dry_run:
-            self.info(f'Examing environment setup commands')
-            if not self._run_cmds(self.setup_cmds()['sh']):
-                self.error(f'Failed to run environment setup commands')
+            try:
+                # Evaluated again, the package may have changed
+                self._setup_env = None
+                self.setup_env()
+            except Exception as e:
+                self.error(f'Failed to run environment setup commands: {e}')
                 return False
 
         return True
 
     def _exec_steps(self,
-                    env_setup_cmds: CmdList,
                     steps: list[tuple[StepName, CmdList]],
-                    add_flag: bool) -> bool:
+                    fingerprints: list[str],
+                    with_dependencies: bool = False) -> bool:
         """
-        Execute a list of steps
+        Execute a list of steps, starting from the first step whose stamp does not
+        match its fingerprint.
 
         Args:
             steps (list[tuple[StepName, CmdList]]): List of
                 `(step_name, step_commands)` tuples
+            fingerprints (list[str]): Fingerprint of each step, see `step_fingerprints`
+            with_dependencies (bool, optional): Run the steps in the environment of the dependencies,
+                see `dependency_env`. Defaults to False.
 
         Returns:
             bool: True if the steps were executed successfully, False otherwise.
         """
-        # Add build flag to step names
-        if add_flag:
-            steps = [(f'{self.build_flag}-{step_name}', cmd_list) for step_name, cmd_list in steps]
+        self._upgrade_legacy_stamps(steps, fingerprints)
 
         # Determine first step
         start_index = -1
-        if len(steps) == 1 and self.step_stamp[steps[0][0]] == 0:
-            start_index = 0
-        else:
-            for i in range(len(steps) - 1):
-                cur_step_name = steps[i][0]
-                next_step_name = steps[i + 1][0]
-
-                if self.step_stamp[cur_step_name] == 0:
-                    start_index = i
-                    break
-
-                if self.step_stamp[cur_step_name] > self.step_stamp[next_step_name]:
-                    start_index = i + 1
-                    break
+        for i, (step_name, _) in enumerate(steps):
+            if self._stamp_fingerprint(step_name) != fingerprints[i]:
+                start_index = i
+                break
 
-                self.info(f'Step {cur_step_name} is up-to-date')
+            self.info(f'Step {step_name} is up-to-date')
+            flag, step = StampStore.split_step_key(step_name, self.build_flag)
+            self.emit('step_skip', flag, step=step)
 
         if start_index == -1:
             self.info('All steps are up-to-date, skipping')
             return True
 
+        fingerprints = fingerprints[start_index:]
         steps = steps[start_index:]
 
+        env = None
+        if with_dependencies and not self.build_config.dry_run:
+            try:
+                env = self.dependency_env()
+            except Exception as e:
+                self.error(f'Failed to set up the environment of the dependencies: {e}')
+                return False
+
         # Run the steps
-        for step_name, cmd_list in steps:
+        for (step_name, cmd_list), fp in zip(steps, fingerprints):
             self.info(f'Running step {step_name}')
+            flag, step = StampStore.split_step_key(step_name, self.build_flag)
+            self.emit('step_start', flag, step=step)
 
             if self.build_config.dry_run:
                 self.info(f'Going to execute step {step_name}:')
@@ -270,24 +619,66 @@ class BasePackage(ABC, ILog):
                     self.info(f' $ {c}')
                 self.info(' $ -----------------------')
                 self.info('')
+                self.emit('step_end', flag, step=step, duration=0.0, ok=True)
 
             else:
                 # Run the commands
-                if not self._run_cmds(env_setup_cmds + cmd_list):
+                usage = {}
+                start = time.time()
+                ok = self._run_cmds(cmd_list, usage, env, self.build_dir / 'logs' / f'{step_name}.log.gz')
+                if usage:
+                    self.stamp_store.add_run(self.name, self.version, flag, step, usage | {'ok': ok})
+
+                self.emit('step_end', flag, step=step, duration=time.time() - start, ok=ok,
+                          data={k: v for k, v in usage.items() if k in ('user', 'sys', 'max_rss', 'written')})
+
+                if not ok:
                     self.error(f'Failed to run step {step_name}')
                     return False
                 else:
-                    self.step_stamp[step_name] = time.time()
-                    self.save_stamp()
+                    self.step_stamp[step_name] = {'fingerprint': fp, 'time': time.time()}
+                    self.save_stamp([step_name])
 
         return True
 
-    def _run_cmds(self, cmd_list: CmdList) -> bool:
+    def _upgrade_legacy_stamps(self, steps: list[tuple[StepName, CmdList]], fingerprints: list[str]) -> None:
+        """
+        Convert plain timestamps written by older versions to fingerprint stamps. Steps that
+        the old timestamp ordering considered up-to-date adopt their current fingerprint,
+        so upgrading does not rebuild anything.
+        """
+        stamps = [self.step_stamp.get(step_name) for step_name, _ in steps]
+        if not any(isinstance(s, (int, float)) for s in stamps) or any(isinstance(s, dict) for s in stamps):
+            return
+
+        times = [s or 0 for s in stamps]
+        n_up_to_date = 0
+        while n_up_to_date < len(times) and times[n_up_to_date] > 0 \
+                and (n_up_to_date == 0 or times[n_up_to_date - 1] <= times[n_up_to_date]):
+            n_up_to_date += 1
+
+        for i in range(len(steps)):
+            if i < n_up_to_date:
+                self.step_stamp[steps[i][0]] = {'fingerprint': fingerprints[i], 'time': times[i]}
+            else:
+                self.step_stamp.pop(steps[i][0], None)
+
+        if not self.build_config.dry_run:
+            self.save_stamp([step_name for step_name, _ in steps])
+
+    def _run_cmds(self, cmd_list: CmdList, usage: dict = None, env: dict[str, str] = None, log_path: Path = None) -> bool:
         """
         Execute a list of bash commands.
 
         Args:
             cmd_list (CmdList): The list of bash commands to be executed.
+            usage (dict, optional): Filled with the resources used by the commands: `start`, `wall`,
+                `user` and `sys` CPU seconds, `max_rss` (bytes, largest process) and `written`
+                (bytes written to storage). Defaults to None.
+            env (dict[str, str], optional): Environment to run the commands in. Defaults to None,
+                the current environment.
+            log_path (Path, optional): Write the output to this compressed log file instead of the
+                terminal, and print its last lines if the commands fail. Defaults to None.
         """
         # Write the bash commands to a file
         try:
@@ -299,51 +690,108 @@ class BasePackage(ABC, ILog):
             return False
 
         # Run the bash file
+        log = None
         try:
-            # proc = subprocess.Popen(['bash', str(self.tmp_bash_path)],
-            #                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            # self.watch_proc(proc)
-            proc = subprocess.run(['bash', str(self.tmp_bash_path)])
+            pass_fds = self.jobserver.pass_fds if self.jobserver is not None else ()
+            start = time.time()
+
+            if log_path is None:
+                proc = subprocess.Popen(['bash', str(self.tmp_bash_path)], env=(os.environ if env is None else env) | self._step_env(),
+                                        pass_fds=pass_fds)
+            else:
+                # Output goes through a pipe to a background writer, the terminal only gets the tail on failure
+                read_fd, write_fd = os.pipe()
+                try:
+                    proc = subprocess.Popen(['bash', str(self.tmp_bash_path)], env=(os.environ if env is None else env) | self._step_env(),
+                                            pass_fds=pass_fds, stdout=write_fd, stderr=write_fd)
+                except Exception:
+                    os.close(read_fd)
+                    raise
+                finally:
+                    os.close(write_fd)
+                log = StepLog(log_path, self.LOG_TAIL_LINES)
+                log.start(read_fd)
+
+            # wait4 accounts for the whole process tree, as long as every process is waited for by its parent
+            _, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+
+            if log is not None:
+                log.close()
+                if proc.returncode != 0:
+                    tail = log.tail()
+                    self.error(f'Last {len(tail)} lines of {log_path}:')
+                    for line in tail:
+                        self.error(f'  | {line}')
+
+            if usage is not None:
+                usage |= {
+                    'start': start,
+                    'wall': time.time() - start,
+                    'user': rusage.ru_utime,
+                    'sys': rusage.ru_stime,
+                    'max_rss': rusage.ru_maxrss * 1024,
+                    'written': rusage.ru_oublock * 512
+                }
+
             if proc.returncode != 0:
                 return False
             return True
 
         except Exception as e:
+            if log is not None:
+                log.close()
             self.error(f'Failed to run bash commands: {e}')
             return False
 
-    def save_stamp(self) -> None:
+    def _step_env(self) -> dict[str, str]:
         """
-        Save the step timestamps to the stamp file
-        """
-        with open(self.stamp_path, 'w') as f:
-            json.dump(self.step_stamp, f, indent=4)
+        Environment variables added to every step. Host-specific settings (caches, jobserver)
+        are passed this way instead of being written into the step commands, so that changing
+        them does not change the steps.
 
-    @staticmethod
-    def watch_proc(proc: subprocess.Popen, nlines: int = 10) -> None:
+        Returns:
+            dict[str, str]: Environment variables to add.
         """
-        Watch the output of a process
+        env = {'EXTMGR_GIT_CLONE_MODE': self.build_config.git_clone_mode}
 
-        Args:
-            proc (subprocess.Popen): The process to watch
-        """
-        last_lines = deque(maxlen=nlines)
+        # Fresh build trees are configured with the chosen generator, existing ones keep theirs
+        env['CMAKE_GENERATOR'] = self.cmake_generator()
 
-        while True:
-            line = proc.stdout.readline()
+        # `cmake --build` passes the parallel level on as `-j` for any generator. With a
+        # jobserver, the build tool must not get a `-j`, it takes its jobs from the jobserver.
+        if self.jobserver is not None:
+            env |= self.jobserver.env()
+        elif self.n_jobs not in (None, ''):
+            env['CMAKE_BUILD_PARALLEL_LEVEL'] = str(self.n_jobs)
 
-            if line:
-                last_lines.append(line)
+        if self.compiler_cache is not None:
+            base_dir = Path(os.path.commonpath([self.build_config.build_prefix.resolve(), self.external_prefix]))
+            env |= self.compiler_cache.env(self.build_dir, base_dir if base_dir != Path('/') else None)
 
-                sys.stdout.write("\033[F" * nlines)  # Move cursor up
-                for l in last_lines:
-                    print(l)
-                sys.stdout.flush()
+        if self.build_config.git_cache_dir is not None:
+            env['EXTMGR_GIT_CACHE'] = str(self.build_config.git_cache_dir.resolve())
 
-            if proc.poll() is not None:
-                break
+        if self.build_config.download_cache_dir is not None:
+            env['EXTMGR_DOWNLOAD_CACHE'] = str(self.build_config.download_cache_dir.resolve())
+
+        return env
 
-            time.sleep(0.1)
+    def save_stamp(self, step_names: list[StepName] = None) -> None:
+        """
+        Save step stamps to the stamp database, one atomic upsert per step. Steps
+        without a stamp are removed from the database.
+
+        Args:
+            step_names (list[StepName], optional): Steps to save. Defaults to all stamped steps.
+        """
+        step_names = list(self.step_stamp) if step_names is None else step_names
+        for step_name in step_names:
+            flag, step = StampStore.split_step_key(step_name, self.build_flag)
+            if step_name in self.step_stamp:
+                self.stamp_store.upsert(self.name, self.version, flag, step, self.step_stamp[step_name])
+            else:
+                self.stamp_store.delete(self.name, self.version, flag, step)
 
     ################################################################
     ####################### Helper functions #######################
@@ -372,6 +820,15 @@ class BasePackage(ABC, ILog):
         """
         Clone a git repository.
 
+        If `build_config.git_cache_dir` is set, a bare mirror of the repository is kept in it
+        (one per repository URL, shared by all versions and prefixes on the host) and the
+        source directory is cloned from the mirror, borrowing its objects through git
+        alternates. The mirror is only fetched when it does not know `tag` yet.
+
+        `build_config.git_clone_mode` can be `shallow` (only the commit of `tag`, which must
+        be a tag or branch name) or `blobless` (file contents fetched on checkout). Without
+        a mirror cache, both reduce the amount of data downloaded from the remote.
+
         Args:
             repo_url (str): URL of the git repository.
             tag (str): Tag to checkout.
@@ -387,18 +844,52 @@ class BasePackage(ABC, ILog):
                 f'    rm -rvf {self.source_dir}',
                 f'fi'
             ]
-        res += [f'git clone {repo_url} {self.source_dir}']
+
+        # Cache and clone mode are passed through the environment, see `_step_env`
+        mirror_name = f'{hashlib.sha1(repo_url.encode()).hexdigest()[:16]}-{Path(repo_url).stem}.git'
+        res += [
+            f'if [ -n "$EXTMGR_GIT_CACHE" ]; then',
+            f'    mirror="$EXTMGR_GIT_CACHE/{mirror_name}"',
+            f'    mkdir -p "$EXTMGR_GIT_CACHE"',
+            f'    (',
+            f'        flock 9',
+            f'        if [ ! -d "$mirror" ]; then',
+            f'            git clone --mirror {repo_url} "$mirror"',
+            f'        elif ! git -C "$mirror" rev-parse -q --verify "{tag}^{{commit}}" > /dev/null; then',
+            f'            git -C "$mirror" fetch origin',
+            f'        fi',
+            f'    ) 9> "$mirror.lock"',
+            f'    if [ "$EXTMGR_GIT_CLONE_MODE" = shallow ]; then',
+            f'        git clone --depth 1 --branch {tag} "file://$mirror" {self.source_dir}',
+            f'    else',
+            f'        git clone --shared --no-checkout "$mirror" {self.source_dir}',
+            f'    fi',
+            f'    git -C {self.source_dir} remote set-url origin {repo_url}',
+            f'elif [ "$EXTMGR_GIT_CLONE_MODE" = shallow ]; then',
+            f'    git clone --depth 1 --branch {tag} {repo_url} {self.source_dir}',
+            f'elif [ "$EXTMGR_GIT_CLONE_MODE" = blobless ]; then',
+            f'    git clone --filter=blob:none --no-checkout {repo_url} {self.source_dir}',
+            f'else',
+            f'    git clone {repo_url} {self.source_dir}',
+            f'fi'
+        ]
         res += [f'cd {self.source_dir}', f'git checkout {tag}', 'cd -']
         return res
 
-    def download_file(self, url: str, dest: Path = None, remove_exist: bool = False) -> CmdList:
+    def download_file(self, url: str, dest: Path = None, remove_exist: bool = False, sha256: str = None) -> CmdList:
         """
         Download a file.
 
+        If `build_config.download_cache_dir` is set, the file is downloaded once into a
+        host-wide cache (keyed by `sha256` if given, by URL otherwise) and hard-linked (or
+        copied with reflink if possible) to `dest`. Interrupted downloads are resumed, and
+        concurrent builds wait for each other instead of downloading the same file twice.
+
         Args:
             url (str): URL of the file.
             dest (Path, optional): Destination path to save the file. Defaults to None.
             remove_exist (bool, optional): Whether to remove the existing file. Defaults to False.
+            sha256 (str, optional): Expected SHA-256 checksum of the file. Defaults to None.
 
         Returns:
             CmdList: List of commands to download the file.
@@ -418,7 +909,39 @@ class BasePackage(ABC, ILog):
                 f'fi'
             ]
 
-        res += [f'wget {url} -O {file_path}']
+        if sha256 is None:
+            cache_key = f'by-url/{hashlib.sha256(url.encode()).hexdigest()[:16]}'
+            cached_is_valid = 'true'
+            verify_part, verify_dest = [], []
+        else:
+            cache_key = f'by-sha256/{sha256}'
+            cached_is_valid = f'echo "{sha256}  $cached" | sha256sum -c --status'
+            verify_part = [f'            echo "{sha256}  $cached.part" | sha256sum -c || {{ rm -f "$cached.part"; exit 1; }}']
+            verify_dest = [f'    echo "{sha256}  {file_path}" | sha256sum -c']
+
+        # Cache directory is passed through the environment, see `_step_env`
+        res += [
+            f'if [ -n "$EXTMGR_DOWNLOAD_CACHE" ]; then',
+            f'    cached="$EXTMGR_DOWNLOAD_CACHE/{cache_key}/{Path(url).name}"',
+            f'    mkdir -p "$(dirname "$cached")"',
+            f'    (',
+            f'        flock 9',
+            f'        if [ -f "$cached" ] && ! {cached_is_valid}; then',
+            f'            rm -f "$cached"',
+            f'        fi',
+            f'        if [ ! -f "$cached" ]; then',
+            f'            wget -c {url} -O "$cached.part"',
+            *verify_part,
+            f'            mv "$cached.part" "$cached"',
+            f'        fi',
+            f'    ) 9> "$cached.lock"',
+            f'    rm -f {file_path}',
+            f'    ln "$cached" {file_path} 2> /dev/null || cp --reflink=auto "$cached" {file_path}',
+            f'else',
+            f'    wget {url} -O {file_path}',
+            *verify_dest,
+            f'fi'
+        ]
 
         return res
 
@@ -452,12 +975,75 @@ class BasePackage(ABC, ILog):
         """
         return self.extract_archive(archive_path, self.source_dir, strip_components)
 
+    @staticmethod
+    @functools.cache
+    def ninja_version() -> str | None:
+        """
+        Version of the installed ninja, e.g. `1.13.1`.
+
+        Returns:
+            str | None: The version, None if ninja is not installed.
+        """
+        if shutil.which('ninja') is None:
+            return None
+        try:
+            return subprocess.check_output(['ninja', '--version'], text=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def cmake_generator(self) -> str:
+        """
+        The CMake generator of the package's build tree. CMake cannot change the generator of
+        a configured tree, so an existing tree keeps its generator (remove the build directory
+        to switch). New trees use `build_config.cmake_generator`, by default Ninja if it is
+        installed and Unix Makefiles otherwise.
+
+        Returns:
+            str: The generator name, e.g. `Ninja`.
+        """
+        try:
+            for line in (self.build_dir / 'CMakeCache.txt').read_text().splitlines():
+                if line.startswith('CMAKE_GENERATOR:INTERNAL='):
+                    return line.split('=', 1)[1]
+        except OSError:
+            pass
+
+        generator = self.build_config.cmake_generator
+        if generator in (None, 'Ninja') and self.ninja_version() is None:
+            return 'Unix Makefiles'
+        return generator or 'Ninja'
+
+    def joins_jobserver(self, jobserver: JobServer) -> bool:
+        """
+        Check whether the build tool of the package takes its jobs from a jobserver. GNU make
+        always does, ninja since version 1.13 and only with the `fifo` protocol (unless it
+        was built with support for the `pipe` protocol).
+
+        Args:
+            jobserver (JobServer): The jobserver.
+
+        Returns:
+            bool: True if the build tool joins the jobserver, False if it needs its own `-j`.
+        """
+        if self.cmake_generator() != 'Ninja':
+            return True
+
+        version = self.ninja_version() or ''
+        m = re.match(r'(\d+)\.(\d+)', version)
+        if m is None or (int(m[1]), int(m[2])) < (1, 13):
+            return False
+        return jobserver.style == 'fifo' or 'jobserver-pipe' in version
+
     def cmake_config(self, cmake_args: dict[str, str] = {}) -> CmdList:
         """
         Generates the CMake configuration command for the package.
         If `CMAKE_BUILD_TYPE` and `CMAKE_INSTALL_PREFIX` are not provided in `cmake_args`,
         they will be set to `self.build_config.cmake_build_type` and `self.install_dir` respectively.
 
+        The compiler launchers are set to the compiler cache of the build configuration, or removed
+        from the CMake cache without one, so turning the compiler cache on or off changes the step
+        and reconfigures the tree instead of keeping the launcher it was configured with.
+
         Args:
             cmake_args (dict[str, str], optional): Additional CMake arguments. Defaults to {}.
 
@@ -475,11 +1061,30 @@ class BasePackage(ABC, ILog):
         if 'CMAKE_INSTALL_PREFIX' not in cmake_args:
             res += f' -DCMAKE_INSTALL_PREFIX={self.install_dir}'
 
+        # The tool is looked up when the step runs, an empty launcher if it is not installed. The
+        # CUDA launcher is always removed, as projects without CUDA would warn about an unused
+        # variable; cmake then takes it from the environment again, see `CompilerCache.env`
+        tool = self.build_config.compiler_cache
+        for lang in ('C', 'CXX', 'CUDA'):
+            key = f'CMAKE_{lang}_COMPILER_LAUNCHER'
+            if key in cmake_args:
+                continue
+            if tool is None or lang == 'CUDA':
+                res += f' -U{key}'
+            else:
+                res += f' -D{key}="$(command -v {tool})"'
+
         return [res]
 
     def cmake_build(self, target: str = 'install') -> CmdList:
         """
-        Generate cmake build commands.
+        Generate cmake build commands, for any generator. The number of jobs is passed through
+        the environment (`CMAKE_BUILD_PARALLEL_LEVEL`, or the jobserver), see `_step_env`.
+
+        Installing from a Ninja tree is skipped if ninja has no work to do and all files of
+        the previous installation still exist, which avoids the cost of installing a large
+        package again when the step was only invalidated by a change that does not affect
+        the tree (e.g. a rebuilt dependency whose headers and libraries did not change).
 
         Args:
             target (str, optional): Target to build. Defaults to 'install'.
@@ -487,7 +1092,53 @@ class BasePackage(ABC, ILog):
         Returns:
             CmdList: List of cmake build commands.
         """
-        return [f'cmake --build {self.build_dir} --target {target} -- -j{self.build_config.n_jobs}']
+        build_cmd = f'cmake --build {self.build_dir} --target {target}'
+        if target != 'install':
+            return [build_cmd]
+
+        manifest = self.build_dir / 'install_manifest.txt'
+        return [
+            f'if [ -f {self.build_dir}/build.ninja ] && [ -f {manifest} ] \\',
+            f'        && ninja -C {self.build_dir} -n | grep -q "^ninja: no work to do" \\',
+            f'        && xargs -r -d "\\n" -a {manifest} ls -d > /dev/null 2>&1; then',
+            f'    echo "Build tree {self.build_dir} and its installation are up-to-date"',
+            f'else',
+            f'    {build_cmd}',
+            f'fi'
+        ]
+
+    @staticmethod
+    def export_envvars(paths: dict[str, list[str]], shell: Literal['sh', 'csh']) -> CmdList:
+        """
+        Prepend lists of paths to environment variables, with a single export per variable.
+
+        Args:
+            paths (dict[str, list[str]]): `{variable: [path]}`, the paths in the order they should appear.
+            shell (Literal['sh', 'csh']): The shell type.
+
+        Returns:
+            CmdList: List of commands.
+        """
+        res = []
+
+        for k, v in paths.items():
+            v = ':'.join(v)
+            if shell == 'sh':
+                res += ['export %s="%s${%s:+:$%s}"' % (k, v, k, k)]
+
+            elif shell == 'csh':
+                res += [
+                    'if ( $?%s ) then' % k,
+                    '    setenv %s "%s:$%s"' % (k, v, k),
+                    'else',
+                    '    setenv %s "%s"' % (k, v),
+                    'endif'
+                ]
+
+            else:
+                raise ValueError('Invalid shell type')
+
+        return res
 
     @staticmethod
     def append_envvar(key_value_paris: list[tuple[str]], shell: Literal['sh', 'csh']) -> CmdList:
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import re
+import shutil
+import time
+from pathlib import Path
+
+from .ILog import ILog
+from .Archive import Archive
+from .Fingerprint import Fingerprint
+from .BasePackage import BasePackage, CmdList
+
+
+class BuildCache(ILog):
+    def __init__(self, cache_dir: Path) -> None:
+        """
+        A local content-addressed cache of installed packages.
+
+        The cache key of a package is a hash of its recipe (the text of `prepare_src_steps()`
+        and `build_steps()`), the patch files the recipe refers to, the build flag and the
+        cache keys of its dependencies. Paths under the install/build prefixes are replaced
+        by placeholders before hashing, so the same package built into another prefix has
+        the same key.
+
+        Args:
+            cache_dir (Path): Directory where artifacts are stored.
+        """
+        super().__init__()
+
+        self.cache_dir = cache_dir.resolve()
+        self.archive = Archive()
+
+        # {(name, version, build_flag): cache_key}
+        self._keys: dict[tuple[str, str, str], str] = {}
+
+    @staticmethod
+    def normalize_cmds(package: BasePackage, cmd_list: CmdList) -> str:
+        """
+        Return the commands as a single text independent from prefixes and number of jobs.
+
+        Args:
+            package (BasePackage): The package owning the commands.
+            cmd_list (CmdList): The commands.
+
+        Returns:
+            str: Normalized text of the commands.
+        """
+        config = package.build_config
+        text = '\n'.join(cmd_list)
+
+        replacements = [
+            (str(config.build_prefix.resolve()), '@build_prefix@'),
+            (str(config.install_prefix.resolve()), '@install_prefix@'),
+            (str(config.patch_dir.resolve()), '@patch_dir@'),
+        ]
+        for old, new in sorted(replacements, key=lambda x: -len(x[0])):
+            text = text.replace(old, new)
+
+        return Fingerprint.strip_parallel_args(text)
+
+    def cache_key(self, package: BasePackage) -> str:
+        """
+        Compute the cache key of a configured package.
+
+        Args:
+            package (BasePackage): The package, `set_config` and `dependencies` must be set.
+
+        Returns:
+            str: Hex digest of the cache key.
+        """
+        node = (package.name, package.version, package.build_flag)
+        if node in self._keys:
+            return self._keys[node]
+
+        h = hashlib.sha256()
+        h.update(f'{package.name}\0{package.version}\0{package.build_flag}\0'.encode())
+
+        for step_name, cmd_list in package.prepare_src_steps() + package.build_steps():
+            h.update(f'{step_name}\0{self.normalize_cmds(package, cmd_list)}\0'.encode())
+
+            # Patch files referenced by the recipe
+            for patch_file in sorted(set(re.findall(rf'{re.escape(str(package.patch_dir))}/\S+', '\n'.join(cmd_list)))):
+                if Path(patch_file).is_file():
+                    h.update(Path(patch_file).name.encode() + b'\0' + Path(patch_file).read_bytes())
+
+        for dep in sorted(package.dependencies, key=lambda p: p.name):
+            h.update(f'{dep.name}\0{self.cache_key(dep)}\0'.encode())
+
+        self._keys[node] = h.hexdigest()
+        return self._keys[node]
+
+    def artifact_path(self, key: str) -> Path:
+        """
+        Path of the artifact of a cache key.
+        """
+        return self.cache_dir / key[:2] / f'{key}{self.archive.suffix}'
+
+    def _find_artifact(self, key: str) -> Path:
+        for suffix in ('.tar.zst', '.tar.gz'):
+            path = self.cache_dir / key[:2] / f'{key}{suffix}'
+            if path.exists():
+                return path
+        return None
+
+    def has(self, package: BasePackage) -> bool:
+        """
+        Check whether the cache holds an artifact of the package.
+        """
+        return self._find_artifact(self.cache_key(package)) is not None
+
+    def restore(self, package: BasePackage) -> bool:
+        """
+        Restore the install directory of a package from the cache.
+
+        Args:
+            package (BasePackage): The package to restore.
+
+        Returns:
+            bool: True if the package was restored, False if there is no artifact or restoring failed.
+        """
+        key = self.cache_key(package)
+        artifact = self._find_artifact(key)
+        if artifact is None:
+            return False
+
+        try:
+            meta = json.loads(artifact.with_name(f'{key}.json').read_text())
+
+            if package.install_dir.exists():
+                shutil.rmtree(package.install_dir)
+            self.archive.unpack(artifact, package.install_dir)
+
+            n_rewritten = self.archive.relocate(package.install_dir,
+                                                meta['install_prefix'],
+                                                str(package.external_prefix))
+            if n_rewritten:
+                self.debug(f'Relocated {n_rewritten} files of {package.name} {package.version}')
+
+        except Exception as e:
+            self.error(f'Failed to restore {package.name} {package.version} from cache: {e}')
+            shutil.rmtree(package.install_dir, ignore_errors=True)
+            return False
+
+        self.info(f'Restored {package.name} {package.version} from cache ({key[:12]})')
+        return True
+
+    def store(self, package: BasePackage) -> bool:
+        """
+        Store the install directory of a package in the cache.
+
+        Args:
+            package (BasePackage): The package to store.
+
+        Returns:
+            bool: True if the package was stored, False otherwise.
+        """
+        key = self.cache_key(package)
+        if self._find_artifact(key) is not None:
+            return True
+
+        try:
+            artifact = self.artifact_path(key)
+            artifact.parent.mkdir(parents=True, exist_ok=True)
+
+            # Metadata goes first, an artifact is only visible once it is complete
+            meta = {
+                'name': package.name,
+                'version': package.version,
+                'build_flag': package.build_flag,
+                'install_prefix': str(package.external_prefix),
+                'created': time.time()
+            }
+            artifact.with_name(f'{key}.json').write_text(json.dumps(meta, indent=4))
+            self.archive.pack(package.install_dir, artifact)
+
+        except Exception as e:
+            self.error(f'Failed to store {package.name} {package.version} in cache: {e}')
+            return False
+
+        self.info(f'Stored {package.name} {package.version} in cache ({key[:12]})')
+        return True
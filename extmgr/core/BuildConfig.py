@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from pathlib import Path
 from typing import Literal
 
@@ -14,7 +14,42 @@ class BuildConfig:
     build_flag: str
 
     n_jobs: int = 1
+    max_parallel_packages: int = 1
+    max_parallel_fetches: int = 4
+    use_jobserver: bool = True
+    cache_dir: Path = None
+    git_cache_dir: Path = None
+    git_clone_mode: Literal['full', 'shallow', 'blobless'] = 'full'
+    download_cache_dir: Path = None
     dry_run: bool = False
+    max_memory: int = None  # bytes, None to use the memory available when the build starts
+    compiler_cache: Literal['ccache', 'sccache'] = None
+    compiler_cache_dir: Path = None
+    compiler_cache_max_size: str = None
+    cmake_generator: Literal['Ninja', 'Unix Makefiles'] = None  # None for Ninja if it is installed
+    queue_dir: Path = None  # Publish the package builds to `main.py worker` processes through this directory
+
+    def to_dict(self) -> dict:
+        """
+        Return the configuration as a JSON-serializable dict, see `from_dict`.
+        """
+        res = {}
+        for f in fields(self):
+            v = getattr(self, f.name)
+            res[f.name] = str(v) if isinstance(v, Path) else v
+        return res
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BuildConfig':
+        """
+        Create a configuration from a dict written by `to_dict`. Unknown keys are ignored.
+        """
+        kwargs = {}
+        for f in fields(cls):
+            if f.name in data:
+                v = data[f.name]
+                kwargs[f.name] = Path(v) if f.type is Path and v is not None else v
+        return cls(**kwargs)
 
     def __str__(self) -> str:
         return self.build_flag
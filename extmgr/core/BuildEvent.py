@@ -0,0 +1,38 @@
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Literal
+
+EventKind = Literal['package_start', 'package_end', 'step_start', 'step_end', 'step_skip', 'cache_hit', 'lock_wait']
+
+
+@dataclass
+class BuildEvent:
+    """
+    Something that happened during a build, see `EventBus`.
+
+    `package_end` and `step_end` carry the `duration` since the matching start event and `ok`,
+    `lock_wait` is emitted once the lock is taken and carries the `duration` of the wait.
+    Events are emitted on the thread doing the work, so `thread` identifies a lane of the timeline.
+    """
+    kind: EventKind
+    package: str
+    version: str
+    flag: str = ''  # Empty for steps shared by all build flags, like the source preparation
+    step: str = None
+    duration: float = None  # seconds
+    ok: bool = None
+    data: dict[str, Any] = field(default_factory=dict)  # e.g. the resources used by a step, the path of a lock
+
+    time: float = field(default_factory=time.time)
+    thread: int = field(default_factory=threading.get_native_id)
+    thread_name: str = field(default_factory=lambda: threading.current_thread().name)
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Return the event as a JSON-serializable dict, without empty fields.
+
+        Returns:
+            dict[str, Any]: The event.
+        """
+        return {k: v for k, v in asdict(self).items() if v is not None and v != {}}
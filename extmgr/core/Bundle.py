@@ -0,0 +1,185 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .ILog import ILog
+from .Archive import Archive
+from .BuildConfig import BuildConfig
+from .BasePackage import BasePackage
+
+
+class Bundle(ILog):
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, bundle_dir: Path) -> None:
+        """
+        A relocatable bundle of an installed distribution.
+
+        A bundle is a directory holding one compressed archive per package (its `install_dir`
+        plus files under the install prefix it links to, e.g. Geant4 data), one archive of the
+        distribution's setup scripts and a `manifest.json`. Build and source directories are
+        never included. Absolute paths of the exporting prefix are rewritten when the bundle
+        is imported into another prefix.
+
+        Args:
+            bundle_dir (Path): The bundle directory.
+        """
+        super().__init__()
+
+        self.bundle_dir = bundle_dir.resolve()
+        self.archive = Archive()
+
+    @staticmethod
+    def _external_links(package: BasePackage) -> list[Path]:
+        """
+        Return the targets of symlinks in the install directory that point to other
+        locations under the install prefix.
+        """
+        res = []
+        for dirpath, dirnames, filenames in os.walk(package.install_dir):
+            for filename in dirnames + filenames:
+                path = Path(dirpath) / filename
+                if not path.is_symlink():
+                    continue
+
+                target = Path(os.readlink(path))
+                if not target.is_absolute() or not target.exists():
+                    continue
+
+                if target.is_relative_to(package.external_prefix) and not target.is_relative_to(package.install_dir):
+                    res.append(target)
+
+        return sorted(set(res))
+
+    def export_distribution(self, dist_name: str, packages: list[BasePackage], build_config: BuildConfig) -> bool:
+        """
+        Export the installed packages of a distribution and its setup scripts.
+
+        Args:
+            dist_name (str): The name of the distribution.
+            packages (list[BasePackage]): The configured packages of the distribution.
+            build_config (BuildConfig): The build configuration object.
+
+        Returns:
+            bool: True if the bundle was written successfully, False otherwise.
+        """
+        prefix = build_config.install_prefix.resolve()
+        setup_dir = Path('setup-scripts') / dist_name / build_config.build_flag
+
+        if not (prefix / setup_dir).is_dir():
+            self.error(f'Setup scripts {prefix / setup_dir} not found, is {dist_name} installed?')
+            return False
+
+        for package in packages:
+            if not package.is_built() or not package.install_dir.is_dir():
+                self.error(f'{package.name} {package.version} is not installed with {build_config.build_flag}')
+                return False
+
+        manifest = {
+            'distribution': dist_name,
+            'build_flag': build_config.build_flag,
+            'install_prefix': str(prefix),
+            'packages': [],
+            'setup_scripts': f'setup-scripts-{dist_name}-{build_config.build_flag}{self.archive.suffix}'
+        }
+
+        def export_package(package: BasePackage) -> dict:
+            members = [package.install_dir] + self._external_links(package)
+            archive_name = f'{package.name}-{package.version}-{package.build_flag}{self.archive.suffix}'
+
+            self.info(f'Packing {package.name} {package.version}')
+            self.archive.pack(prefix, self.bundle_dir / archive_name,
+                              members=[str(m.relative_to(prefix)) for m in members])
+
+            return {
+                'name': package.name,
+                'version': package.version,
+                'archive': archive_name,
+                'members': [str(m.relative_to(prefix)) for m in members]
+            }
+
+        try:
+            self.bundle_dir.mkdir(parents=True, exist_ok=True)
+
+            # Each archive is already compressed with several threads, a few packages in parallel is enough
+            with ThreadPoolExecutor(max_workers=min(4, max(1, len(packages)))) as pool:
+                manifest['packages'] = list(pool.map(export_package, packages))
+
+            self.archive.pack(prefix, self.bundle_dir / manifest['setup_scripts'], members=[str(setup_dir)])
+            (self.bundle_dir / self.MANIFEST).write_text(json.dumps(manifest, indent=4))
+
+        except Exception as e:
+            self.error(f'Failed to export distribution {dist_name}: {e}')
+            return False
+
+        self.info(f'Exported {dist_name} ({build_config.build_flag}) to {self.bundle_dir}')
+        return True
+
+    def read_manifest(self) -> dict:
+        """
+        Read the manifest of the bundle.
+
+        Returns:
+            dict: The manifest.
+        """
+        return json.loads((self.bundle_dir / self.MANIFEST).read_text())
+
+    def import_bundle(self, install_prefix: Path, packages: dict[tuple[str, str], BasePackage] = None) -> bool:
+        """
+        Unpack the bundle into an install prefix and rewrite the absolute paths of the
+        exporting prefix.
+
+        Args:
+            install_prefix (Path): The install prefix to unpack into.
+            packages (dict[tuple[str, str], BasePackage], optional): Configured packages,
+                keyed by `(name, version)`. Their build steps are stamped as done, so later
+                builds into this prefix reuse them. Defaults to None.
+
+        Returns:
+            bool: True if the bundle was imported successfully, False otherwise.
+        """
+        packages = {} if packages is None else packages
+        prefix = install_prefix.resolve()
+
+        try:
+            manifest = self.read_manifest()
+        except Exception as e:
+            self.error(f'Failed to read bundle manifest: {e}')
+            return False
+
+        old_prefix = manifest['install_prefix']
+
+        def import_archive(archive_name: str, members: list[str]) -> None:
+            self.archive.unpack(self.bundle_dir / archive_name, prefix)
+            for member in members:
+                n_rewritten = self.archive.relocate(prefix / member, old_prefix, str(prefix))
+                if n_rewritten:
+                    self.debug(f'Relocated {n_rewritten} files in {member}')
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, max(1, len(manifest['packages'])))) as pool:
+                futures = []
+                for pkg in manifest['packages']:
+                    self.info(f'Unpacking {pkg["name"]} {pkg["version"]}')
+                    futures.append(pool.submit(import_archive, pkg['archive'], pkg['members']))
+
+                setup_dir = str(Path('setup-scripts') / manifest['distribution'] / manifest['build_flag'])
+                futures.append(pool.submit(import_archive, manifest['setup_scripts'], [setup_dir]))
+
+                for future in futures:
+                    future.result()
+
+        except Exception as e:
+            self.error(f'Failed to import bundle {self.bundle_dir}: {e}')
+            return False
+
+        for pkg in manifest['packages']:
+            package = packages.get((pkg['name'], pkg['version']))
+            if package is None:
+                self.warn(f'Recipe of {pkg["name"]} {pkg["version"]} not found, its steps are not stamped')
+                continue
+            package.mark_built()
+
+        self.info(f'Imported {manifest["distribution"]} ({manifest["build_flag"]}) into {prefix}')
+        return True
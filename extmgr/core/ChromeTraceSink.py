@@ -0,0 +1,79 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from .BuildEvent import BuildEvent
+from .ILog import ILog
+
+
+class ChromeTraceSink(ILog):
+    def __init__(self, path: Path) -> None:
+        """
+        Build event subscriber writing a trace in the Trace Event Format, to be opened in
+        https://ui.perfetto.dev or `chrome://tracing`. Every build thread is a lane with its
+        packages and their steps nested in it, so idle lanes show where concurrency collapses.
+
+        Events are written as they arrive. The trace of an interrupted build lacks the closing
+        bracket of the event array, which both viewers accept.
+
+        Args:
+            path (Path): The output file, overwritten.
+        """
+        super().__init__()
+
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'w')
+        self._file.write('[')
+
+        self._start = time.time()
+        self._pid = os.getpid()
+        self._threads: set[int] = set()
+        self._n_events = 0
+
+    def __call__(self, event: BuildEvent) -> None:
+        if event.thread not in self._threads:
+            self._threads.add(event.thread)
+            self._write({'ph': 'M', 'name': 'thread_name', 'pid': self._pid, 'tid': event.thread,
+                         'args': {'name': event.thread_name}})
+
+        name = f'{event.package} ({event.flag})' if event.flag else event.package
+        args = {'version': event.version} | event.data
+        if event.ok is not None:
+            args['ok'] = event.ok
+
+        res = {'pid': self._pid, 'tid': event.thread, 'ts': self._timestamp(event.time), 'args': args}
+        if event.kind == 'package_start':
+            res |= {'ph': 'B', 'cat': 'package', 'name': name}
+        elif event.kind == 'package_end':
+            res |= {'ph': 'E', 'cat': 'package', 'name': name}
+        elif event.kind == 'step_start':
+            res |= {'ph': 'B', 'cat': 'step', 'name': event.step}
+        elif event.kind == 'step_end':
+            res |= {'ph': 'E', 'cat': 'step', 'name': event.step}
+        elif event.kind == 'lock_wait':
+            # Emitted when the wait is over
+            res |= {'ph': 'X', 'cat': 'lock', 'name': f'waiting for lock of {name}',
+                    'ts': self._timestamp(event.time - event.duration), 'dur': round(event.duration * 1e6)}
+        else:
+            step = f' {event.step}' if event.step else ''
+            res |= {'ph': 'i', 's': 't', 'cat': event.kind, 'name': f'{event.kind.replace("_", " ")}{step}'}
+
+        self._write(res)
+
+    def close(self) -> None:
+        """
+        Terminate the event array and close the output file.
+        """
+        if not self._file.closed:
+            self._file.write('\n]\n')
+            self._file.close()
+
+    def _timestamp(self, t: float) -> float:
+        # Microseconds since the trace started
+        return round((t - self._start) * 1e6, 1)
+
+    def _write(self, record: dict) -> None:
+        self._file.write((',\n' if self._n_events else '\n') + json.dumps(record, default=str))
+        self._n_events += 1
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Literal
+
+from .ILog import ILog
+
+
+class CompilerCache(ILog):
+    # ccache result names counted as hits and misses in a stats log
+    HITS = ('direct_cache_hit', 'preprocessed_cache_hit', 'remote_storage_hit')
+    MISSES = ('cache_miss',)
+
+    def __init__(self, tool: Literal['ccache', 'sccache'], cache_dir: Path = None, max_size: str = None) -> None:
+        """
+        A compiler cache (ccache or sccache) used as compiler launcher by all cmake builds.
+
+        The launcher is set by `BasePackage.cmake_config` from the build configuration, so turning
+        the cache on or off reconfigures the packages, and is also passed to the steps as the
+        `CMAKE_<LANG>_COMPILER_LAUNCHER` environment variables (honoured by CMake >= 3.17 when
+        configuring) for cmake commands written by the recipes themselves. The cache directory is
+        shared by all builds on the host and partitioned by toolchain (compiler, version and
+        target), and the cache tool evicts the least recently used entries beyond `max_size`.
+
+        Args:
+            tool (Literal['ccache', 'sccache']): The compiler cache tool.
+            cache_dir (Path, optional): Base cache directory. Defaults to `~/.cache/extmgr/<tool>`.
+            max_size (str, optional): Maximum cache size, e.g. `50G`. Defaults to None, the tool's default.
+        """
+        super().__init__()
+
+        self.tool = tool
+        self.max_size = max_size
+
+        if cache_dir is None:
+            cache_dir = Path.home() / '.cache' / 'extmgr' / tool
+        self.cache_dir = cache_dir.resolve() / self.toolchain_id()
+
+        self.executable = shutil.which(tool)
+        self._sccache_stats: dict = None
+
+    @property
+    def available(self) -> bool:
+        return self.executable is not None
+
+    @staticmethod
+    def toolchain_id() -> str:
+        """
+        Identify the C/C++ toolchain of the environment, e.g. `gcc-12.2.0-x86_64-linux-gnu-1a2b3c4d`.
+        Objects of different toolchains are never mixed in one cache partition.
+        """
+        cc = os.environ.get('CC', 'cc')
+        try:
+            version = subprocess.check_output([cc, '-dumpfullversion', '-dumpversion'], text=True).strip()
+            machine = subprocess.check_output([cc, '-dumpmachine'], text=True).strip()
+            banner = subprocess.check_output([cc, '--version'], text=True)
+        except (OSError, subprocess.CalledProcessError):
+            return 'unknown'
+
+        name = 'clang' if 'clang' in banner else 'gcc'
+        return f'{name}-{version}-{machine}-{hashlib.sha1(banner.encode()).hexdigest()[:8]}'
+
+    @staticmethod
+    def stats_log(build_dir: Path) -> Path:
+        return build_dir.resolve() / 'ccache-stats.log'
+
+    def env(self, build_dir: Path, base_dir: Path = None) -> dict[str, str]:
+        """
+        Environment variables that make cmake builds use the compiler cache.
+
+        Args:
+            build_dir (Path): The package build directory, the ccache stats log is written in it.
+            base_dir (Path, optional): Paths under it are rewritten to relative paths before hashing,
+                so builds in different prefixes can share cache entries. Defaults to None.
+
+        Returns:
+            dict[str, str]: Environment variables to add to the steps.
+        """
+        env = {f'CMAKE_{lang}_COMPILER_LAUNCHER': self.executable for lang in ('C', 'CXX', 'CUDA')}
+
+        if self.tool == 'ccache':
+            env |= {'CCACHE_DIR': str(self.cache_dir), 'CCACHE_STATSLOG': str(self.stats_log(build_dir))}
+            if base_dir is not None:
+                env['CCACHE_BASEDIR'] = str(base_dir)
+            if self.max_size is not None:
+                env['CCACHE_MAXSIZE'] = self.max_size
+        else:
+            env['SCCACHE_DIR'] = str(self.cache_dir)
+            if self.max_size is not None:
+                env['SCCACHE_CACHE_SIZE'] = self.max_size
+
+        return env
+
+    def start(self) -> None:
+        """
+        Create the cache directory and, for sccache, remember the server stats so that the
+        stats of this run can be reported.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.info(f'Using {self.tool} cache {self.cache_dir}' + (f' (max {self.max_size})' if self.max_size else ''))
+
+        if self.tool == 'sccache':
+            self._sccache_stats = self._read_sccache_stats()
+
+    def reset_stats(self, build_dir: Path) -> None:
+        """
+        Forget the stats of earlier builds of a package.
+        """
+        self.stats_log(build_dir).unlink(missing_ok=True)
+
+    def package_stats(self, build_dir: Path) -> tuple[int, int]:
+        """
+        Count the cache hits and misses of a package build from its ccache stats log.
+
+        Args:
+            build_dir (Path): The package build directory.
+
+        Returns:
+            tuple[int, int]: Number of hits and misses, `(0, 0)` if nothing was compiled or
+                the tool does not write stats logs (sccache).
+        """
+        hits = misses = 0
+        try:
+            lines = self.stats_log(build_dir).read_text().splitlines()
+        except OSError:
+            return hits, misses
+
+        for line in lines:
+            line = line.strip()
+            if line in self.HITS:
+                hits += 1
+            elif line in self.MISSES:
+                misses += 1
+        return hits, misses
+
+    def run_stats(self) -> tuple[int, int]:
+        """
+        Count the cache hits and misses of all compilations since `start`, for sccache.
+
+        Returns:
+            tuple[int, int]: Number of hits and misses.
+        """
+        before, after = self._sccache_stats or {}, self._read_sccache_stats()
+
+        def count(stats: dict, key: str) -> int:
+            value = stats.get('stats', {}).get(key, {})
+            return sum(value.get('counts', {}).values()) if isinstance(value, dict) else int(value or 0)
+
+        return (count(after, 'cache_hits') - count(before, 'cache_hits'),
+                count(after, 'cache_misses') - count(before, 'cache_misses'))
+
+    def _read_sccache_stats(self) -> dict:
+        try:
+            out = subprocess.check_output([self.executable, '--show-stats', '--stats-format', 'json'],
+                                          env=os.environ | {'SCCACHE_DIR': str(self.cache_dir)}, text=True)
+            return json.loads(out)
+        except (OSError, subprocess.CalledProcessError, json.JSONDecodeError) as e:
+            self.debug(f'Failed to read sccache stats: {e}')
+            return {}
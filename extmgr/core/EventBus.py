@@ -0,0 +1,63 @@
+import threading
+from typing import Callable
+
+from .BuildEvent import BuildEvent
+from .ILog import ILog
+
+Subscriber = Callable[[BuildEvent], None]
+
+
+class EventBus(ILog):
+    def __init__(self) -> None:
+        """
+        Delivers the build events of all threads to the subscribers, one event at a time, so
+        subscribers need no locking. A subscriber that raises is logged and dropped, observing
+        a build never fails it.
+        """
+        super().__init__()
+
+        self._subscribers: list[Subscriber] = []
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        """
+        Whether anyone is subscribed, so emitters can skip building events nobody receives.
+        """
+        return bool(self._subscribers)
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        """
+        Add a subscriber.
+
+        Args:
+            subscriber (Subscriber): Called with every event, e.g. a `JsonLinesSink` or `ChromeTraceSink`.
+        """
+        with self._lock:
+            self._subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        """
+        Remove a subscriber, if it is subscribed.
+
+        Args:
+            subscriber (Subscriber): The subscriber.
+        """
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def emit(self, event: BuildEvent) -> None:
+        """
+        Deliver an event to all subscribers.
+
+        Args:
+            event (BuildEvent): The event.
+        """
+        with self._lock:
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber(event)
+                except Exception as e:
+                    self.error(f'Dropping build event subscriber {subscriber!r}: {e}')
+                    self._subscribers.remove(subscriber)
@@ -1,11 +1,30 @@
 from collections import defaultdict
+from dataclasses import replace
+import copy
+from pathlib import Path
+import importlib
 import re
-from typing import Any
+import signal
+import threading
+import time
+from typing import Any, Literal
 
 from .ILog import ILog
 from .BuildConfig import BuildConfig
 from .BaseDistribution import BaseDistribution
 from .BasePackage import BasePackage, CmdList
+from .Scheduler import Scheduler, NodeKey
+from .JobServer import JobServer
+from .BuildCache import BuildCache
+from .Bundle import Bundle
+from .PackageRegistry import PackageRegistry
+from .HostResources import HostResources
+from .CompilerCache import CompilerCache
+from .StampStore import StampStore
+from .EventBus import EventBus
+from .WorkQueue import WorkQueue
+
+DIST_PYTHON_DIR = Path(__file__).resolve().parent.parent / 'distributions' / 'dist_python'
 
 
 class SingletonMeta(type):
@@ -19,14 +38,35 @@ class SingletonMeta(type):
 
 
 class Executor(ILog, metaclass=SingletonMeta):
+    # Duration estimates of packages without recorded builds, in seconds
+    SECONDS_PER_SOURCE_FILE = 1.0
+    DEFAULT_DURATION = 60.0
+    SOURCE_SUFFIXES = ('.c', '.cc', '.cpp', '.cxx', '.f', '.F', '.f90', '.F90')
+
+    # Memory estimates: part of the available memory builds may use, and memory per job
+    # of packages without `mem_per_job` or recorded builds
+    MEMORY_USAGE = 0.9
+    DEFAULT_MEM_PER_JOB = 1 << 30
+
+    # Recipe packages scanned for package classes, {module_name: directory}
+    RECIPE_ROOTS: dict[str, Path] = {'extmgr.distributions.dist_python': DIST_PYTHON_DIR}
+
+    # Modules registering distributions, imported when distributions are first needed
+    DIST_MODULES: list[str] = ['extmgr.distributions.dist_python']
+
     def __init__(self) -> None:
         super().__init__()
 
-        self.dists: dict[str, BaseDistribution] = {}
+        # {dist_name: {'packages': [(package_name, package_version)], 'dependencies': {package_name: [dependency_name]}}}
+        self.dist_specs: dict[str, dict] = {}
+        self._dists: dict[str, BaseDistribution] = {}
+        self._dists_loaded = False
+
+        # Packages are only imported and instantiated when a distribution needs them
+        self.registry = PackageRegistry(self.RECIPE_ROOTS)
 
-        # {package_name: {package_version: BasePackage}}
-        self.packages: dict[str, dict[str, BasePackage]] = None
-        self.update_packages()
+        # Build events of all packages, subscribe e.g. a `ChromeTraceSink` before building
+        self.events = EventBus()
 
     def add_package(self, package: BasePackage) -> None:
         """
@@ -35,77 +75,378 @@ class Executor(ILog, metaclass=SingletonMeta):
         Args:
             package (BasePackage): The package to be added.
         """
-        if package.name not in self.packages:
-            self.packages[package.name] = {}
+        self.registry.add(package)
+        self.debug(f'Added package {package.name} {package.version}')
+
+    def get_package(self, name: str, version: str) -> BasePackage:
+        """
+        Get a package, importing its recipe if needed.
 
-        if self.packages[package.name].get(package.version):
-            raise ValueError(f'Package {package.name} {package.version} already exists')
+        Args:
+            name (str): The name of the package.
+            version (str): The version of the package.
 
-        self.packages[package.name][package.version] = package
-        self.debug(f'Added package {package.name} {package.version}')
+        Returns:
+            BasePackage: The package, or None if it is not found.
+        """
+        if not self.registry.has(name, version):
+            return None
+        return self.registry.get(name, version)
+
+    def distribution_names(self) -> list[str]:
+        """
+        Return the names of all registered distributions, without importing any package.
+
+        Returns:
+            list[str]: The distribution names.
+        """
+        self._load_distributions()
+        return list(self.dist_specs)
+
+    def get_distribution(self, name: str) -> BaseDistribution:
+        """
+        Get a distribution, importing and instantiating its packages on first use.
+
+        Args:
+            name (str): The name of the distribution.
 
-    def make_distribution(self, name: str, build_config: BuildConfig) -> bool:
+        Returns:
+            BaseDistribution: The distribution, or None if it is not registered.
+        """
+        self._load_distributions()
+        if name not in self.dist_specs:
+            return None
+
+        if name not in self._dists:
+            spec = self.dist_specs[name]
+            dist = BaseDistribution(name)
+            for pkg_name, pkg_version in spec['packages']:
+                dist.add_package(self.registry.get(pkg_name, pkg_version), spec['dependencies'].get(pkg_name))
+            self._dists[name] = dist
+
+        return self._dists[name]
+
+    def _load_distributions(self) -> None:
+        if self._dists_loaded:
+            return
+
+        # Set first, the modules call `register_distribution` on this executor
+        self._dists_loaded = True
+        for module in self.DIST_MODULES:
+            importlib.import_module(module)
+
+    def make_distribution(self,
+                          name: str | list[str],
+                          build_config: BuildConfig | list[BuildConfig],
+                          packages: list[str] = None) -> bool:
         """
         Make the distribution.
 
+        With several build configurations (e.g. one per build type), all of them are built in
+        one schedule: the source of every package is prepared once, and the builds of the
+        build flags run as parallel branches sharing the jobs and memory budget. Host settings
+        (jobs, memory, caches, dry run, ...) are taken from the first configuration.
+
+        Several distributions are merged into one schedule as well, with every package version
+        they share built once per build flag (see `_merge_distributions`). The setup scripts of
+        all of them are written at the end.
+
+        A part of the distribution is built by passing `packages`, see `BaseDistribution.select`.
+        Their dependencies outside of it are only configured (for the environment and fingerprints
+        of the selected packages) and must have been built before; no other package is looked at,
+        and the setup scripts, which cover the whole distribution, are not rewritten.
+
         Args:
-            dist (BaseDistribution): The distribution to be made.
-            build_config (BuildConfig): The build configuration object.
+            name (str | list[str]): The name of the distribution, or of several distributions.
+            build_config (BuildConfig | list[BuildConfig]): The build configuration object, or one per build flag.
+            packages (list[str], optional): Names of the packages to build, in any of the distributions.
+                Defaults to None, all packages.
 
         Returns:
             bool: True if the distribution was made successfully, False otherwise.
         """
+        build_configs = [build_config] if isinstance(build_config, BuildConfig) else list(build_config)
+        build_config = build_configs[0]
+        names = [name] if isinstance(name, str) else list(dict.fromkeys(name))
+
         try:
-            if name not in self.dists:
-                self.error(f'Distribution {name} not found, did you forget to register it?')
+            dists: list[BaseDistribution] = []
+            for dist_name in names:
+                dist = self.get_distribution(dist_name)
+                if dist is None:
+                    self.error(f'Distribution {dist_name} not found, did you forget to register it?')
+                    return False
+                dists.append(dist)
+
+            try:
+                graph, origins = self._merge_distributions(dists)
+            except ValueError as e:
+                self.error(str(e))
                 return False
 
-            packages = self.dists[name].sorted_packages()
-            env_setup_cmds: CmdList = []
+            if len(dists) > 1:
+                self.info(f'Building {len(graph)} package versions for {len(dists)} distributions '
+                          f'with {sum(len(dist._packages) for dist in dists)} packages in total')
 
-            # Build each package
-            for package in packages:
-                self.info(f'Building package {package.name} {package.version}')
+            partial = packages is not None
+            unknown = [pkg_name for pkg_name in packages or [] if pkg_name not in {pkg_name for pkg_name, _ in graph}]
+            if unknown:
+                self.error(f'Package {", ".join(unknown)} not in distribution {", ".join(names)}')
+                return False
 
-                package.set_config(build_config)
-                if not package._make(env_setup_cmds):
-                    self.error(f'Failed to make package {package.name}')
+            # {(package_name, version)}
+            selected = {pv for pv in graph if pv[0] in packages} if partial else set(graph)
+
+            # Selected packages and their dependencies, the only packages configured
+            needed = set(selected)
+            stack = list(selected)
+            while stack:
+                for dep in graph[stack.pop()][1]:
+                    if dep not in needed:
+                        needed.add(dep)
+                        stack.append(dep)
+
+            all_nodes = self._configure_nodes(graph, build_configs, needed)
+
+            # Only the selected packages are scheduled
+            nodes = {key: package for key, package in all_nodes.items() if key[:2] in selected}
+            dependencies = {(pkg_name, version, flag): [(*dep, flag) for dep in graph[(pkg_name, version)][1] if dep in selected]
+                            for pkg_name, version, flag in nodes}
+
+            packages = list(nodes.values())
+
+            def label(package: BasePackage) -> str:
+                res = package.name if len(dists) == 1 else f'{package.name} {package.version}'
+                return res if len(build_configs) == 1 else f'{res} ({package.build_flag})'
+
+            if partial:
+                selected_names = sorted(n if len(dists) == 1 else f'{n} {v}' for n, v in selected)
+                self.info(f'Building {len(selected)} of {len(graph)} packages: {", ".join(selected_names)}')
+                # Other processes (e.g. workers) may have built them since the stamps were loaded.
+                # {key: labels of the selected packages needing it}
+                unbuilt: dict[tuple[str, str, str], list[str]] = {}
+                for key, package in all_nodes.items():
+                    if key not in nodes:
+                        package.reload_stamps()
+                        if not package.is_built():
+                            unbuilt[key] = []
+                for package in nodes.values():
+                    for dep in package.dependency_closure():
+                        if (dep.name, dep.version, dep.build_flag) in unbuilt:
+                            unbuilt[(dep.name, dep.version, dep.build_flag)].append(label(package))
+                if unbuilt:
+                    details = [f'{label(all_nodes[key])} (needed by {", ".join(users)})' for key, users in unbuilt.items()]
+                    self.error(f'Dependencies outside the selected packages are not built: {"; ".join(details)}. '
+                               f'Build them first, or select them too')
                     return False
 
-                # Append setup commands
-                new_env_setup_cmds = package.setup_cmds()['sh']
+            build_cache = BuildCache(build_config.cache_dir) if build_config.cache_dir is not None else None
+
+            # Sources are shared by all build flags, {(package_name, version)} prepared in this run
+            prefetched: set[tuple[str, str]] = set()
+
+            def prefetch_source(key: tuple[str, str], package: BasePackage) -> bool:
+                # No need to fetch sources of up-to-date packages or packages that will be restored from the cache
+                if package.is_built() or (build_cache is not None and build_cache.has(package)):
+                    return True
+
+                if (package.name, package.version) in prefetched:
+                    # Prepared for another build flag, only the directories of this build flag are missing
+                    try:
+                        package.prepare_directories()
+                    except Exception as e:
+                        self.error(f'Failed to make directories: {e}')
+                        return False
+                    return True
+
+                if not package._prepare_source():
+                    self.error(f'Failed to prepare source of package {package.name}')
+                    return False
+
+                prefetched.add((package.name, package.version))
+                return True
+
+            def build_package(key: tuple[str, str], package: BasePackage) -> bool:
+                self.info(f'Building package {package.name} {package.version}')
+
+                # Another process building the same package with the same flag is waited for,
+                # its stamps are reloaded afterwards so its result is reused
+                with package.lock_install() as lock:
+                    package.emit_lock_wait(lock)
+                    package.reload_stamps()
+
+                    if build_cache is not None and self._restore_from_cache(package, build_cache):
+                        package.emit('cache_hit')
+                        return True
+
+                    if (package.name, package.version) not in prefetched and not package.is_built() and not package._prepare_source():
+                        self.error(f'Failed to prepare source of package {package.name}')
+                        return False
+
+                    # The package's top-level make/ninja uses its implicit job slot. A package limited
+                    # to fewer jobs than the jobserver has (by memory or `max_jobs`) is built with its own
+                    # `-j` instead, and holds as many tokens so the total number of jobs is kept. So is a
+                    # package whose build tool cannot join the jobserver (ninja < 1.13), with its share of the
+                    # jobs, even if the share is the whole jobserver
+                    own_jobs = False
+                    if jobserver is not None:
+                        if not package.joins_jobserver(jobserver):
+                            share = max(1, jobserver.n_jobs // build_config.max_parallel_packages)
+                            package.n_jobs = min(int(package.n_jobs), share)
+                            own_jobs = True
+                        own_jobs = own_jobs or int(package.n_jobs) < jobserver.n_jobs
+
+                    tokens = []
+                    try:
+                        if own_jobs:
+                            package.jobserver = None
+                            with token_lock:
+                                tokens = [jobserver.acquire() for _ in range(int(package.n_jobs))]
+                        elif jobserver is not None:
+                            tokens = [jobserver.acquire()]
+
+                        if compiler_cache is not None:
+                            compiler_cache.reset_stats(package.build_dir)
+
+                        if not package._build():
+                            self.error(f'Failed to make package {package.name}')
+                            return False
+
+                        if compiler_cache is not None:
+                            compiler_cache_stats[label(package)] = compiler_cache.package_stats(package.build_dir)
+                    finally:
+                        for token in tokens:
+                            jobserver.release(token)
+                        package.jobserver = jobserver
+
+                    if build_cache is not None and not build_config.dry_run:
+                        build_cache.store(package)
+
                 if build_config.dry_run:
                     self.info('Add environment setup commands:')
                     self.info('')
                     self.info(' $ -----------------------')
-                    for c in new_env_setup_cmds:
+                    for c in package.setup_cmds()['sh']:
                         self.info(f' $ {c}')
                     self.info(' $ -----------------------')
                     self.info('')
 
-                env_setup_cmds += new_env_setup_cmds
-
-            # If dry run, print the full environment setup commands and return
-            if build_config.dry_run:
                 return True
 
-            # Make setup commands
-            setup_dir = build_config.install_prefix / 'setup-scripts' / name / build_config.build_flag
-            setup_dir.mkdir(parents=True, exist_ok=True)
+            def build_package_remote(key: tuple[str, str], package: BasePackage) -> bool:
+                # The worker builds the package alone, with its dependencies built here or by other workers.
+                # It gets their stamps with the job and returns its writes, only this process writes the database
+                needed = [(p.name, p.version) for p in [*package.dependency_closure(), package]]
+                job_id = queue.publish({'dist': origins[(package.name, package.version)],
+                                        'package': package.name,
+                                        'version': package.version,
+                                        'config': package.build_config.to_dict(),
+                                        'stamps': package.stamp_store.export(needed)})
+                self.info(f'Queued package {label(package)} as job {job_id}')
+
+                result = queue.wait(job_id)
+                if result is None:
+                    return False
 
-            setup_cmds: dict[str, CmdList] = defaultdict(list)
+                package.stamp_store.replay(result.get('stamps', []))
+                package.reload_stamps()
+                if not result.get('ok'):
+                    self.error(f'Failed to make package {label(package)} on worker {result.get("worker")}, '
+                               f'see the logs in {package.build_dir / "logs"}')
+                    return False
 
-            for package in packages:
-                for sh_type, cmds in package.setup_cmds().items():
-                    setup_cmds[sh_type] += [f'# {package.name} - {package.version}'] + cmds + ['']
+                self.info(f'Built package {label(package)} on worker {result.get("worker")} '
+                          f'in {Scheduler.format_duration(result.get("wall", 0))}')
+                return True
 
-            for sh_type, cmds in setup_cmds.items():
-                setup_file = setup_dir / f'{build_config.build_flag}.{sh_type}'
+            def build_package_traced(key: tuple[str, str], package: BasePackage) -> bool:
+                package.emit('package_start')
+                start = time.time()
+                ok = False
                 try:
-                    setup_file.write_text('\n'.join(cmds))
-                except Exception as e:
-                    self.error(f'Failed to write setup file {setup_file}: {e}')
+                    ok = build_package_remote(key, package) if queue is not None else build_package(key, package)
+                    return ok
+                finally:
+                    package.emit('package_end', duration=time.time() - start, ok=ok)
+
+            # A bare `-j` means one job per usable CPU, never an unbounded `make -j`
+            n_jobs = HostResources.cpus() if str(build_config.n_jobs) == '' else int(build_config.n_jobs)
+
+            # Distributed builds only prepare the sources here, workers build with their own resources
+            queue: WorkQueue = None
+            if build_config.queue_dir is not None and not build_config.dry_run:
+                queue = WorkQueue(build_config.queue_dir)
+                self.info(f'Publishing package builds to workers through {queue.path}')
+
+            jobserver: JobServer = None
+            token_lock = threading.Lock()
+            if build_config.use_jobserver and not build_config.dry_run and queue is None:
+                jobserver = JobServer(n_jobs)
+                jobserver.start()
+                self.info(f'Sharing {n_jobs} jobs among all packages through a {jobserver.style} jobserver')
+
+            if build_config.cmake_generator == 'Ninja' and BasePackage.ninja_version() is None:
+                self.warn('ninja not found, configuring new build trees with Unix Makefiles')
+
+            memory_budget: int = None
+            if queue is None:
+                memory_budget = build_config.max_memory
+                if memory_budget is None:
+                    memory_budget = int(HostResources.memory_available() * self.MEMORY_USAGE)
+                self.info(f'Admitting builds into {memory_budget / 2**30:.1f} GiB of memory')
+
+            compiler_cache: CompilerCache = None
+            compiler_cache_stats: dict[str, tuple[int, int]] = {}
+            if build_config.compiler_cache is not None and not build_config.dry_run and queue is None:
+                compiler_cache = CompilerCache(build_config.compiler_cache,
+                                               build_config.compiler_cache_dir,
+                                               build_config.compiler_cache_max_size)
+                if compiler_cache.available:
+                    compiler_cache.start()
+                else:
+                    self.warn(f'{build_config.compiler_cache} not found, building without compiler cache')
+                    compiler_cache = None
+
+            for package in packages:
+                package.jobserver = jobserver
+                package.compiler_cache = compiler_cache
+                package.events = self.events
+
+            try:
+                scheduler = Scheduler(nodes=nodes,
+                                      dependencies=dependencies,
+                                      max_parallel=build_config.max_parallel_packages,
+                                      n_jobs=n_jobs,
+                                      max_parallel_fetches=build_config.max_parallel_fetches,
+                                      durations=self._estimate_durations(nodes),
+                                      memory_budget=memory_budget,
+                                      mem_per_job=self._estimate_mem_per_job(nodes),
+                                      shared_jobs=jobserver is not None)
+                if not scheduler.run(build_package_traced, prefetch_source, queue.cancel if queue is not None else None):
                     return False
+            finally:
+                for package in packages:
+                    package.jobserver = None
+                    package.compiler_cache = None
+                    package.events = None
+                if jobserver is not None:
+                    jobserver.close()
+                if compiler_cache is not None:
+                    self._report_compiler_cache(compiler_cache, compiler_cache_stats)
+
+            # If dry run, print the full environment setup commands and return
+            if build_config.dry_run:
+                return True
+
+            if partial:
+                self.info('Partial build, the setup scripts are not updated')
+                return True
+
+            for dist in dists:
+                for config in build_configs:
+                    if not self._write_setup_scripts(dist.name, config, [nodes[(pkg.name, pkg.version, config.build_flag)]
+                                                                         for pkg in dist.sorted_packages()]):
+                        return False
 
         except KeyboardInterrupt:
             self.error('Interrupted by user')
@@ -113,6 +454,465 @@ class Executor(ILog, metaclass=SingletonMeta):
 
         return True
 
+    def _merge_distributions(self, dists: list[BaseDistribution]) \
+            -> tuple[dict[tuple[str, str], tuple[BasePackage, list[tuple[str, str]]]], dict[tuple[str, str], str]]:
+        """
+        Merge the dependency graphs of distributions into one graph of package versions. A package
+        version in several distributions is one node, built once into the shared prefix, so it
+        must depend on the same versions of the same packages in all of them.
+
+        Args:
+            dists (list[BaseDistribution]): The distributions.
+
+        Raises:
+            ValueError: If a package version has different dependencies in two distributions.
+
+        Returns:
+            tuple: `{(package_name, version): (package, [(dependency_name, dependency_version)])}` sorted
+                by dependencies, and `{(package_name, version): distribution_name}` with the first
+                distribution containing each package version.
+        """
+        graph: dict[tuple[str, str], tuple[BasePackage, list[tuple[str, str]]]] = {}
+        origins: dict[tuple[str, str], str] = {}
+
+        # Each distribution is sorted, so every package version comes after its dependencies
+        # when it is first seen, and they are the same in later distributions
+        for dist in dists:
+            for package in dist.sorted_packages():
+                pv = (package.name, package.version)
+                deps = [(dep, dist._packages[dep].version) for dep in dist._dependencies[package.name]]
+
+                if pv not in graph:
+                    graph[pv] = (package, deps)
+                    origins[pv] = dist.name
+                elif sorted(graph[pv][1]) != sorted(deps):
+                    raise ValueError(f'Package {package.name} {package.version} depends on '
+                                     f'{", ".join(f"{d} {v}" for d, v in sorted(graph[pv][1])) or "nothing"} in distribution {origins[pv]} '
+                                     f'but on {", ".join(f"{d} {v}" for d, v in sorted(deps)) or "nothing"} in distribution {dist.name}, '
+                                     f'they cannot be built into one prefix')
+
+        return graph, origins
+
+    def _configure_nodes(self,
+                         graph: dict[tuple[str, str], tuple[BasePackage, list[tuple[str, str]]]],
+                         build_configs: list[BuildConfig],
+                         needed: set[tuple[str, str]] = None) -> dict[tuple[str, str, str], BasePackage]:
+        """
+        Configure the packages of a graph for every build configuration and set their dependencies.
+        Fingerprints include those of the dependencies, so this must be done before any stamp of
+        the packages is checked or written.
+
+        Args:
+            graph (dict): The graph, see `_merge_distributions`.
+            build_configs (list[BuildConfig]): The build configurations, one per build flag.
+            needed (set[tuple[str, str]], optional): Only configure these `(package_name, version)`,
+                they must include their dependencies. Defaults to None, all packages.
+
+        Returns:
+            dict[tuple[str, str, str], BasePackage]: `{(package_name, version, build_flag): package}`.
+                The first build flag uses the distributions' packages, the others shallow copies of them,
+                everything that depends on the build flag is set by `set_config`.
+        """
+        res: dict[tuple[str, str, str], BasePackage] = {}
+        for i, config in enumerate(build_configs):
+            for pv, (package, _) in graph.items():
+                if needed is not None and pv not in needed:
+                    continue
+                package = package if i == 0 else copy.copy(package)
+                package.set_config(config)
+                res[(*pv, config.build_flag)] = package
+
+        for (pkg_name, version, flag), package in res.items():
+            package.dependencies = [res[(*dep, flag)] for dep in graph[(pkg_name, version)][1]]
+
+        return res
+
+    def work(self, queue_dir: Path, overrides: dict[str, Any] = None, idle_timeout: float = None) -> bool:
+        """
+        Work on the package builds published by distributed builds (see `BuildConfig.queue_dir`)
+        until interrupted, or until no job came for `idle_timeout` seconds.
+
+        Every job is built like a partial build of its one package, with the build configuration
+        of the job. The recipes must be the same as the coordinator's, and the install prefix
+        shared with it. The prefix's stamp database is never opened: the stamps come with the job,
+        and the stamps and step runs written are returned to the coordinator, see `StampStore.detached`.
+
+        Args:
+            queue_dir (Path): The queue directory of the coordinator.
+            overrides (dict[str, Any], optional): `BuildConfig` fields replacing the job's, e.g. the worker's
+                own `n_jobs` or `max_memory`. Defaults to None.
+            idle_timeout (float, optional): Seconds without a job after which to stop. Defaults to None, never.
+
+        Returns:
+            bool: True if all jobs succeeded, False otherwise.
+        """
+        queue = WorkQueue(queue_dir)
+        overrides = (overrides or {}) | {'queue_dir': None, 'max_parallel_packages': 1}
+        self.info(f'Working on jobs of {queue.path} as {WorkQueue.worker_name()}')
+
+        # make_distribution handles interrupts itself, the worker must stop after the current job
+        stopping = threading.Event()
+
+        def on_signal(signum, frame) -> None:
+            stopping.set()
+            signal.default_int_handler(signum, frame)
+
+        previous_handlers = {signum: signal.signal(signum, on_signal) for signum in (signal.SIGINT, signal.SIGTERM)}
+
+        all_ok = True
+        idle_since = time.time()
+        try:
+            while not stopping.is_set():
+                job = queue.claim()
+                if job is None:
+                    if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                        self.info(f'No job for {idle_timeout:.0f}s, stopping')
+                        break
+                    time.sleep(queue.poll_interval)
+                    continue
+
+                ok = self._work_on(queue, job, overrides)
+                all_ok = all_ok and ok
+                idle_since = time.time()
+
+        except KeyboardInterrupt:
+            self.info('Interrupted, stopping')
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+        return all_ok and not stopping.is_set()
+
+    def _work_on(self, queue: WorkQueue, job: dict, overrides: dict[str, Any]) -> bool:
+        """
+        Build the package of a claimed job and report the result.
+
+        Args:
+            queue (WorkQueue): The queue the job was claimed from.
+            job (dict): The job, see `make_distribution`.
+            overrides (dict[str, Any]): `BuildConfig` fields replacing the job's.
+
+        Returns:
+            bool: True if the package was built successfully, False otherwise.
+        """
+        self.info(f'Job {job["id"]}: package {job["package"]} {job["version"]} of distribution {job["dist"]}')
+
+        # The claim is touched while the package builds, so the coordinator knows the worker is alive
+        stop_heartbeat = threading.Event()
+
+        def heartbeat() -> None:
+            while not stop_heartbeat.wait(queue.stale_after / 4):
+                queue.touch(job['id'])
+
+        threading.Thread(target=heartbeat, name=f'heartbeat-{job["id"]}', daemon=True).start()
+
+        start = time.time()
+        ok = False
+        journal = []
+        try:
+            config = replace(BuildConfig.from_dict(job['config']), **overrides)
+            dist = self.get_distribution(job['dist'])
+            package = dist._packages.get(job['package']) if dist is not None else None
+            if package is None or package.version != job['version']:
+                self.error(f'Package {job["package"]} {job["version"]} of distribution {job["dist"]} not found, '
+                           f'are the recipes the same as the coordinator\'s?')
+            else:
+                with StampStore.detached(config.install_prefix, job.get('stamps', [])) as stamp_store:
+                    journal = stamp_store.journal
+                    ok = self.make_distribution(job['dist'], config, [job['package']])
+        except Exception as e:
+            self.error(f'Failed to run job {job["id"]}: {e}')
+        finally:
+            stop_heartbeat.set()
+            queue.finish(job['id'], {'ok': ok, 'wall': time.time() - start, 'stamps': journal})
+
+        self.info(f'Job {job["id"]}: {"done" if ok else "failed"} after {Scheduler.format_duration(time.time() - start)}')
+        return ok
+
+    def _write_setup_scripts(self, name: str, build_config: BuildConfig, packages: list[BasePackage]) -> bool:
+        """
+        Write the setup scripts of a distribution for one build flag.
+
+        The `setup_envvars` of all packages are combined into one export per variable, with the
+        paths of every package before those of its dependencies (as if the packages were set up
+        one after another in dependency order) and without duplicates. They are followed by the
+        `setup_cmds` of packages without `setup_envvars`, e.g. sourcing a script of the package,
+        which therefore see the environment of all other packages.
+
+        Args:
+            name (str): The name of the distribution.
+            build_config (BuildConfig): The build configuration of the build flag.
+            packages (list[BasePackage]): The configured packages, sorted by dependencies.
+
+        Returns:
+            bool: True if the setup scripts were written successfully, False otherwise.
+        """
+        setup_dir = build_config.install_prefix / 'setup-scripts' / name / build_config.build_flag
+        setup_dir.mkdir(parents=True, exist_ok=True)
+
+        # {variable: [path]}
+        paths: dict[str, list[str]] = {}
+        raw_cmds: dict[str, CmdList] = defaultdict(list)
+        header = [f'# {package.name} - {package.version}' for package in packages] + ['']
+
+        for package in packages:
+            envvars = package.setup_envvars()
+            for k, v in envvars:
+                paths.setdefault(k, []).insert(0, v)
+
+            if not envvars:
+                for sh_type, cmds in package.setup_cmds().items():
+                    raw_cmds[sh_type] += [f'# {package.name} - {package.version}'] + cmds + ['']
+
+        paths = {k: list(dict.fromkeys(v)) for k, v in paths.items()}
+
+        setup_cmds: dict[str, CmdList] = {}
+        for sh_type in ['sh', 'csh'] + [t for t in raw_cmds if t not in ('sh', 'csh')]:
+            exports = BasePackage.export_envvars(paths, sh_type) if sh_type in ('sh', 'csh') else []
+            setup_cmds[sh_type] = header + exports + [''] + raw_cmds[sh_type]
+
+        for sh_type, cmds in setup_cmds.items():
+            setup_file = setup_dir / f'{build_config.build_flag}.{sh_type}'
+            try:
+                setup_file.write_text('\n'.join(cmds))
+            except Exception as e:
+                self.error(f'Failed to write setup file {setup_file}: {e}')
+                return False
+
+        return True
+
+    def _report_compiler_cache(self, compiler_cache: CompilerCache, stats: dict[str, tuple[int, int]]) -> None:
+        """
+        Print the compiler cache hits and misses of the packages built in this run.
+
+        Args:
+            compiler_cache (CompilerCache): The compiler cache.
+            stats (dict[str, tuple[int, int]]): `(hits, misses)` of each built package.
+        """
+        stats = {name: hm for name, hm in stats.items() if sum(hm) > 0}
+        if compiler_cache.tool == 'sccache':
+            stats = {'(all packages)': compiler_cache.run_stats()}
+
+        if not stats:
+            return
+
+        self.info(f'{compiler_cache.tool} hits / misses:')
+        for name, (hits, misses) in stats.items():
+            self.info(f'  {name:<24} {hits:>7} / {misses:<7} ({100 * hits / max(1, hits + misses):.0f}% hits)')
+
+    def _estimate_durations(self, nodes: dict[NodeKey, BasePackage]) -> dict[NodeKey, float]:
+        """
+        Estimate how long each package takes to build, for critical path scheduling. Up-to-date
+        packages take no time. Otherwise the estimate is taken from, in order:
+
+        1. recorded executions of the package's steps with the same version and build flag,
+        2. recorded executions of other versions or build flags of the package,
+        3. the number of source files, if the source is already prepared,
+        4. `DEFAULT_DURATION`.
+
+        Args:
+            nodes (dict[NodeKey, BasePackage]): The configured packages, by scheduler node.
+
+        Returns:
+            dict[NodeKey, float]: Estimated duration of each package in seconds, by node.
+        """
+        packages = list(nodes.values())
+
+        # {(package, version, flag): total mean wall time of the steps}
+        totals: dict[tuple[str, str, str], float] = defaultdict(float)
+        for st in packages[0].stamp_store.run_stats() if packages else []:
+            totals[(st['package'], st['version'], st['flag'])] += st['wall']
+
+        res: dict[NodeKey, float] = {}
+        for key, package in nodes.items():
+            if package.is_built():
+                res[key] = 0.0
+                continue
+
+            prepare = totals.get((package.name, package.version, ''), 0.0)
+            if (package.name, package.version, package.build_flag) in totals:
+                res[key] = prepare + totals[(package.name, package.version, package.build_flag)]
+                continue
+
+            others = [t for (name, _, flag), t in totals.items() if name == package.name and flag != '']
+            if others:
+                res[key] = prepare + sum(others) / len(others)
+                continue
+
+            if package.source_dir.is_dir():
+                n_sources = sum(1 for path in package.source_dir.rglob('*') if path.suffix in self.SOURCE_SUFFIXES)
+                if n_sources > 0:
+                    res[key] = n_sources * self.SECONDS_PER_SOURCE_FILE
+                    continue
+
+            res[key] = self.DEFAULT_DURATION
+
+        return res
+
+    def _estimate_mem_per_job(self, nodes: dict[NodeKey, BasePackage]) -> dict[NodeKey, int]:
+        """
+        Estimate the peak memory of one job of each package, for memory admission. It is
+        the package's `mem_per_job` if set, otherwise the largest process recorded in
+        previous builds of any version of the package, otherwise `DEFAULT_MEM_PER_JOB`.
+
+        Args:
+            nodes (dict[NodeKey, BasePackage]): The configured packages, by scheduler node.
+
+        Returns:
+            dict[NodeKey, int]: Estimated memory per job in bytes, by node.
+        """
+        packages = list(nodes.values())
+
+        recorded: dict[str, int] = defaultdict(int)
+        for st in packages[0].stamp_store.run_stats() if packages else []:
+            if st['flag'] != '' and st['max_rss']:
+                recorded[st['package']] = max(recorded[st['package']], st['max_rss'])
+
+        return {key: package.mem_per_job or recorded.get(package.name) or self.DEFAULT_MEM_PER_JOB
+                for key, package in nodes.items()}
+
+    def _restore_from_cache(self, package: BasePackage, build_cache: BuildCache) -> bool:
+        """
+        Restore a package that has not been built yet from the build cache.
+
+        Args:
+            package (BasePackage): The package to restore.
+            build_cache (BuildCache): The build cache.
+
+        Returns:
+            bool: True if the package was restored (or would be, in dry run), False otherwise.
+        """
+        if package.is_built() or not build_cache.has(package):
+            return False
+
+        if package.build_config.dry_run:
+            self.info(f'Going to restore {package.name} {package.version} from cache')
+            return True
+
+        try:
+            package.prepare_directories()
+        except Exception as e:
+            self.error(f'Failed to make directories: {e}')
+            return False
+
+        if not build_cache.restore(package):
+            return False
+
+        package.mark_built()
+        return True
+
+    def export_distribution(self, name: str, build_config: BuildConfig, bundle_dir: Path) -> bool:
+        """
+        Export an installed distribution to a relocatable bundle.
+
+        Args:
+            name (str): The name of the distribution.
+            build_config (BuildConfig): The build configuration the distribution was built with.
+            bundle_dir (Path): The bundle directory to write.
+
+        Returns:
+            bool: True if the bundle was written successfully, False otherwise.
+        """
+        dist = self.get_distribution(name)
+        if dist is None:
+            self.error(f'Distribution {name} not found, did you forget to register it?')
+            return False
+
+        graph, _ = self._merge_distributions([dist])
+        nodes = self._configure_nodes(graph, [build_config])
+        packages = [nodes[(package.name, package.version, build_config.build_flag)] for package in dist.sorted_packages()]
+
+        return Bundle(bundle_dir).export_distribution(name, packages, build_config)
+
+    def import_bundle(self, bundle_dir: Path, build_config: BuildConfig) -> bool:
+        """
+        Import a bundle written by `export_distribution` into the install prefix of `build_config`.
+
+        Args:
+            bundle_dir (Path): The bundle directory.
+            build_config (BuildConfig): The build configuration, its build flag is replaced
+                by the one of the bundle.
+
+        Returns:
+            bool: True if the bundle was imported successfully, False otherwise.
+        """
+        bundle = Bundle(bundle_dir)
+        try:
+            manifest = bundle.read_manifest()
+        except Exception as e:
+            self.error(f'Failed to read bundle manifest: {e}')
+            return False
+
+        build_config = replace(build_config, build_flag=manifest['build_flag'])
+
+        # The stamps must match what `make_distribution` computes, with the fingerprints of the dependencies
+        packages: dict[tuple[str, str], BasePackage] = {}
+        dist = self.get_distribution(manifest['distribution'])
+        if dist is None:
+            self.warn(f'Distribution {manifest["distribution"]} is not registered, the imported packages are not stamped')
+        else:
+            graph, _ = self._merge_distributions([dist])
+            nodes = self._configure_nodes(graph, [build_config])
+            packages = {(pkg_name, version): package for (pkg_name, version, _), package in nodes.items()}
+
+        return bundle.import_bundle(build_config.install_prefix, packages)
+
+    def report(self,
+               install_prefix: Path,
+               build_flag: str = None,
+               sort_by: Literal['wall', 'cpu', 'max_rss', 'written'] = 'wall',
+               top: int = 20) -> bool:
+        """
+        Print the packages and steps using the most resources, from the step executions
+        recorded in the stamp database of an install prefix.
+
+        Args:
+            install_prefix (Path): The install prefix.
+            build_flag (str, optional): Only consider this build flag. Defaults to None.
+            sort_by (Literal['wall', 'cpu', 'max_rss', 'written'], optional): Ranking key. Defaults to 'wall'.
+            top (int, optional): Number of packages and steps to print. Defaults to 20.
+
+        Returns:
+            bool: True if any step execution was found, False otherwise.
+        """
+        steps = StampStore.for_prefix(install_prefix, readonly=True).run_stats(build_flag)
+        if not steps:
+            self.error(f'No step executions recorded in {install_prefix / StampStore.DB_NAME}')
+            return False
+
+        # Mean resources of a full build of each package, peak memory of its largest step
+        packages: dict[tuple[str, str], dict] = {}
+        for st in steps:
+            pkg = packages.setdefault((st['package'], st['version']), {
+                'package': st['package'], 'version': st['version'], 'step': '(all steps)',
+                'runs': 0, 'wall': 0, 'cpu': 0, 'max_rss': 0, 'written': 0
+            })
+            pkg['runs'] = max(pkg['runs'], st['runs'])
+            pkg['wall'] += st['wall']
+            pkg['cpu'] += st['cpu']
+            pkg['max_rss'] = max(pkg['max_rss'], st['max_rss'])
+            pkg['written'] += st['written']
+
+        def fmt_bytes(n: float) -> str:
+            for unit in ('B', 'KiB', 'MiB', 'GiB'):
+                if n < 1024:
+                    return f'{n:.1f} {unit}'
+                n /= 1024
+            return f'{n:.1f} TiB'
+
+        def print_table(title: str, rows: list[dict]) -> None:
+            self.info('')
+            self.info(title)
+            self.info(f'{"package":<32} {"step":<36} {"runs":>5} {"wall":>10} {"cpu":>10} {"max rss":>12} {"written":>12}')
+            for row in sorted(rows, key=lambda r: r[sort_by], reverse=True)[:top]:
+                step = row['step'] if row.get('flag', '') == '' else f'{row["flag"]}-{row["step"]}'
+                self.info(f'{row["package"] + " " + row["version"]:<32} {step:<36} {row["runs"]:>5} {row["wall"]:>9.1f}s {row["cpu"]:>9.1f}s '
+                          f'{fmt_bytes(row["max_rss"]):>12} {fmt_bytes(row["written"]):>12}')
+
+        print_table(f'Top packages by {sort_by} (mean per build):', list(packages.values()))
+        print_table(f'Top steps by {sort_by} (mean per execution):', steps)
+        return True
+
     def register_distribution(self, name: str, packages: list[tuple[str, str]], dependencies: dict[str, list[str]] = None) -> None:
         """
         Register a distribution.
@@ -133,12 +933,12 @@ class Executor(ILog, metaclass=SingletonMeta):
         if dependencies is None:
             dependencies = {}
 
-        if name in self.dists:
+        if name in self.dist_specs:
             raise ValueError(f'Distribution {name} already exists')
 
-        # Check packages existence
+        # Check packages existence, from the index only
         for pkg_name, pkg_version in packages:
-            if pkg_name not in self.packages or pkg_version not in self.packages[pkg_name]:
+            if not self.registry.has(pkg_name, pkg_version):
                 raise ValueError(f'Package {pkg_name} {pkg_version} not found')
 
         # Check dependencies existence
@@ -149,51 +949,14 @@ class Executor(ILog, metaclass=SingletonMeta):
                     raise ValueError(
                         f'Dependency {dep} not found in distribution {name}. Dependency must be a member of the distribution')
 
-        # Create the distribution
-        dist = BaseDistribution(name)
-        for pkg_name, pkg_version in packages:
-            dist.add_package(self.packages[pkg_name][pkg_version], dependencies.get(pkg_name))
-
-        self.dists[name] = dist
+        # The distribution is created when it is first used
+        self.dist_specs[name] = {'packages': list(packages), 'dependencies': dict(dependencies)}
         self.debug(f'Registered distribution {name}')
 
     def update_packages(self) -> None:
         """
-        Searches for packages and retrieves all subclasses of the BasePackage class.
-        Only classes that have a name and version method are considered.
-
-        Returns:
-            dict: A dictionary containing all subclasses of BasePackage, grouped by package name and version.
+        Rebuild the package index by importing all recipe modules, e.g. after adding
+        recipes while the executor is running. Otherwise the index is rebuilt automatically
+        when recipe files change.
         """
-
-        def get_subclasses(cls, res: dict[str, dict[str, BasePackage]] = {}) -> dict[str, dict[str, BasePackage]]:
-            """
-            Recursively retrieves all subclasses of the given class.
-
-            Args:
-                cls (type): The class to retrieve subclasses from.
-
-            Returns:
-                dict: A dictionary containing all subclasses.
-            """
-            try:
-                pkg = cls()
-                pkg.name, pkg.version
-                self.debug(f'Found package: {pkg.name} {pkg.version}')
-                if pkg.name not in res:
-                    res[pkg.name] = {}
-
-                if pkg.version in res[pkg.name]:
-                    raise ValueError(f'Package {pkg.name} {pkg.version} already exists')
-                res[pkg.name][pkg.version] = pkg
-
-            except (AttributeError, NotImplementedError, TypeError):
-                pass
-
-            subclasses = cls.__subclasses__()
-            for subclass in subclasses:
-                res |= get_subclasses(subclass)
-
-            return res
-
-        self.packages = get_subclasses(BasePackage)
+        self.registry.rebuild()
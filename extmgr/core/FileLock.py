@@ -0,0 +1,178 @@
+import errno
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+from .ILog import ILog
+
+
+class FileLock(ILog):
+    def __init__(self, path: Path, shared: bool = False, stale_after: float = 600) -> None:
+        """
+        An advisory lock on a file, shared between threads and processes (also on other
+        hosts, if the file system supports locks).
+
+        The lock is taken with `flock`, so the kernel releases it when the holding process
+        exits, even if it crashes, and a stale lock never has to be removed by hand. On
+        file systems without `flock` support, the lock is the exclusive creation of
+        `<path>.owner` instead. The holder touches that file every `stale_after / 4` seconds,
+        and waiters steal it when it was not touched for `stale_after` seconds or when its
+        holder is a dead process on this host. Shared locks are exclusive in that mode.
+
+        Args:
+            path (Path): The lock file, created if needed.
+            shared (bool, optional): Take a shared (read) lock instead of an exclusive one. Defaults to False.
+            stale_after (float, optional): Seconds after which an untouched owner file is stale. Defaults to 600.
+        """
+        super().__init__()
+
+        self.path = path
+        self.shared = shared
+        self.stale_after = stale_after
+
+        # Seconds the last `acquire` waited for another holder
+        self.waited = 0.0
+
+        self._fd: int = None
+        self._owner_path = path.with_name(path.name + '.owner')
+        self._heartbeat: threading.Event = None
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+    @staticmethod
+    def owner_info() -> dict:
+        """
+        Description of the current process, written into lock files for waiters.
+        """
+        return {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}
+
+    def acquire(self, poll_interval: float = 1) -> None:
+        """
+        Take the lock, waiting until it is free.
+
+        Args:
+            poll_interval (float, optional): Seconds between checks of a stale owner file. Defaults to 1.
+        """
+        self.waited = 0.0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o664)
+
+        op = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            try:
+                fcntl.flock(fd, op | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.info(f'Waiting for {self.path}, locked by {self._describe_owner(fd)}')
+                start = time.time()
+                fcntl.flock(fd, op)
+                self.waited = time.time() - start
+                self.info(f'Got {self.path} after {self.waited:.1f}s')
+
+        except OSError as e:
+            os.close(fd)
+            if e.errno not in (errno.ENOLCK, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+            self.debug(f'flock is not supported for {self.path}, falling back to owner files')
+            self._acquire_owner_file(poll_interval)
+            return
+
+        if not self.shared:
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, json.dumps(self.owner_info()).encode(), 0)
+        self._fd = fd
+
+    def release(self) -> None:
+        """
+        Release the lock. The lock file itself is kept, removing it could let two
+        processes lock different files of the same path.
+        """
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+        if self._heartbeat is not None:
+            self._heartbeat.set()
+            self._heartbeat = None
+            self._owner_path.unlink(missing_ok=True)
+
+    ################################################################
+    ####################### Helper functions #######################
+    ################################################################
+
+    def _describe_owner(self, fd: int) -> str:
+        try:
+            owner = json.loads(os.pread(fd, 4096, 0) or b'{}')
+            return f'process {owner["pid"]} on {owner["host"]} since {time.ctime(owner["time"])}'
+        except Exception:
+            return 'another process'
+
+    def _owner_is_stale(self) -> bool:
+        """
+        Check whether the owner file was left by a holder that is gone.
+        """
+        try:
+            st = self._owner_path.stat()
+            owner = json.loads(self._owner_path.read_text() or '{}')
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+        if time.time() - st.st_mtime > self.stale_after:
+            return True
+
+        if owner.get('host') == socket.gethostname():
+            try:
+                os.kill(owner['pid'], 0)
+            except ProcessLookupError:
+                return True
+            except (PermissionError, KeyError, TypeError):
+                pass
+
+        return False
+
+    def _acquire_owner_file(self, poll_interval: float) -> None:
+        waiting = False
+        start = time.time()
+        while True:
+            try:
+                fd = os.open(self._owner_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o664)
+                break
+            except FileExistsError:
+                pass
+
+            if self._owner_is_stale():
+                self.warn(f'Stealing stale lock {self._owner_path}')
+                self._owner_path.unlink(missing_ok=True)
+                continue
+
+            if not waiting:
+                self.info(f'Waiting for {self._owner_path}')
+                waiting = True
+            time.sleep(poll_interval)
+
+        if waiting:
+            self.waited = time.time() - start
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(self.owner_info()))
+
+        # Keep the owner file fresh while the lock is held
+        self._heartbeat = threading.Event()
+
+        def heartbeat(stop: threading.Event) -> None:
+            while not stop.wait(self.stale_after / 4):
+                try:
+                    os.utime(self._owner_path)
+                except OSError:
+                    return
+
+        threading.Thread(target=heartbeat, args=(self._heartbeat,), daemon=True).start()
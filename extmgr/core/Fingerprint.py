@@ -0,0 +1,106 @@
+import hashlib
+import re
+import threading
+from pathlib import Path
+
+
+class Fingerprint:
+    """
+    Content hashes of build steps. The fingerprint of a step covers its commands, the
+    content of the input files they refer to and the fingerprints of everything upstream
+    of it, so it changes whenever anything that can change the step's result changes.
+    """
+
+    # {(path, mtime_ns, size): sha256}, so unchanged files are only hashed once per process
+    _file_digests: dict[tuple[str, int, int], str] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def strip_parallel_args(text: str) -> str:
+        """
+        Remove `-jN` style arguments (and the `--` before them) from commands,
+        the number of jobs does not change what is built.
+
+        Args:
+            text (str): Command text.
+
+        Returns:
+            str: Command text without parallel arguments.
+        """
+        return re.sub(r'(\s+--)?\s+-j\d*(?=\s|$)', '', text)
+
+    @classmethod
+    def file_digest(cls, path: Path) -> str:
+        """
+        SHA-256 of a file, computed by streaming and cached by path, mtime and size.
+
+        Args:
+            path (Path): The file.
+
+        Returns:
+            str: Hex digest of the file content.
+        """
+        st = path.stat()
+        key = (str(path), st.st_mtime_ns, st.st_size)
+
+        with cls._lock:
+            if key in cls._file_digests:
+                return cls._file_digests[key]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+
+        with cls._lock:
+            cls._file_digests[key] = h.hexdigest()
+        return h.hexdigest()
+
+    @staticmethod
+    def referenced_files(text: str, exclude: list[Path]) -> list[Path]:
+        """
+        Find the existing regular files referred to by absolute paths in commands.
+
+        Args:
+            text (str): Command text.
+            exclude (list[Path]): Directories whose files are outputs of the build, not inputs.
+
+        Returns:
+            list[Path]: Sorted list of referenced input files.
+        """
+        res = set()
+        for token in re.findall(r'/[^\s\'"$;|&<>()`]+', text):
+            path = Path(token)
+            if any(path.is_relative_to(d) for d in exclude):
+                continue
+            try:
+                if path.is_file():
+                    res.add(path)
+            except OSError:
+                continue
+        return sorted(res)
+
+    @classmethod
+    def step(cls, step_name: str, cmd_list: list[str], upstream: list[str], exclude: list[Path]) -> str:
+        """
+        Compute the fingerprint of one step.
+
+        Args:
+            step_name (str): The step name.
+            cmd_list (list[str]): The step commands.
+            upstream (list[str]): Fingerprints the step depends on (previous step, dependency packages).
+            exclude (list[Path]): Directories not considered as inputs, see `referenced_files`.
+
+        Returns:
+            str: Hex digest of the step fingerprint.
+        """
+        text = cls.strip_parallel_args('\n'.join(cmd_list))
+
+        h = hashlib.sha256()
+        h.update(f'{step_name}\0{text}\0'.encode())
+        for path in cls.referenced_files(text, exclude):
+            h.update(f'{path}\0{cls.file_digest(path)}\0'.encode())
+        for fp in upstream:
+            h.update(f'{fp}\0'.encode())
+
+        return h.hexdigest()
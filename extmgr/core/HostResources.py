@@ -0,0 +1,106 @@
+import os
+from pathlib import Path
+
+
+class HostResources:
+    """
+    CPUs and memory usable by builds on this host, taking the CPU affinity and the
+    cgroup (v2 or v1) limits of the current process into account, e.g. in containers
+    and batch jobs.
+    """
+
+    CGROUP_ROOT = Path('/sys/fs/cgroup')
+
+    @staticmethod
+    def _read_int(path: Path) -> int | None:
+        try:
+            text = path.read_text().strip()
+        except OSError:
+            return None
+        return int(text) if text.isdigit() else None
+
+    @classmethod
+    def _cgroup_dirs(cls) -> list[Path]:
+        """
+        Directories of the cgroups of the current process and their ancestors, innermost first.
+        """
+        res = []
+        try:
+            lines = Path('/proc/self/cgroup').read_text().splitlines()
+        except OSError:
+            return res
+
+        for line in lines:
+            _, controllers, path = line.split(':', 2)
+            if controllers == '':
+                base = cls.CGROUP_ROOT  # v2
+            elif 'memory' in controllers.split(',') or 'cpu' in controllers.split(','):
+                base = cls.CGROUP_ROOT / controllers  # v1
+            else:
+                continue
+
+            d = base / path.lstrip('/')
+            while d.is_relative_to(base):
+                res.append(d)
+                if d == base:
+                    break
+                d = d.parent
+        return res
+
+    @staticmethod
+    def _meminfo() -> dict[str, int]:
+        res = {}
+        try:
+            for line in Path('/proc/meminfo').read_text().splitlines():
+                key, value = line.split(':', 1)
+                res[key] = int(value.split()[0]) * 1024
+        except (OSError, ValueError):
+            pass
+        return res
+
+    @classmethod
+    def cpus(cls) -> int:
+        """
+        Number of CPUs this process may use.
+
+        Returns:
+            int: The number of CPUs, at least 1.
+        """
+        n = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+        for d in cls._cgroup_dirs():
+            try:
+                quota, period = (int(x) for x in (d / 'cpu.max').read_text().split())
+            except (OSError, ValueError):
+                # No v2 limit ('max'), or cgroup v1
+                quota, period = cls._read_int(d / 'cpu.cfs_quota_us'), cls._read_int(d / 'cpu.cfs_period_us')
+            if quota and period:
+                n = min(n, max(1, quota // period))
+
+        return max(1, n)
+
+    @classmethod
+    def memory_total(cls) -> int:
+        """
+        Memory this process may use in bytes: the physical memory or the cgroup limit, whichever is lower.
+        """
+        total = cls._meminfo().get('MemTotal', 0)
+        for d in cls._cgroup_dirs():
+            limit = cls._read_int(d / 'memory.max') or cls._read_int(d / 'memory.limit_in_bytes')
+            if limit is not None and 0 < limit < total:
+                total = limit
+        return total
+
+    @classmethod
+    def memory_available(cls) -> int:
+        """
+        Memory that can be allocated right now without swapping in bytes: `MemAvailable`,
+        or what is left below the cgroup limit, whichever is lower.
+        """
+        available = cls._meminfo().get('MemAvailable', 0)
+        for d in cls._cgroup_dirs():
+            limit = cls._read_int(d / 'memory.max') or cls._read_int(d / 'memory.limit_in_bytes')
+            usage = cls._read_int(d / 'memory.current') or cls._read_int(d / 'memory.usage_in_bytes')
+            if limit is not None and usage is not None and 0 < limit < (1 << 60):
+                available = min(available, max(0, limit - usage))
+        return available
@@ -0,0 +1,145 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Literal
+
+from .ILog import ILog
+
+
+class JobServer(ILog):
+    def __init__(self, n_jobs: int, style: Literal['fifo', 'pipe'] = None) -> None:
+        """
+        A GNU make compatible jobserver shared by all builds launched by extmgr.
+
+        The jobserver holds `n_jobs` tokens. Every running package build takes one token for
+        the implicit job slot of its top-level `make`/`ninja`, and the build tools take the
+        other tokens from the jobserver. Therefore at most `n_jobs` compile jobs run at the
+        same time, no matter how many packages are building.
+
+        Args:
+            n_jobs (int): Total number of jobs.
+            style (Literal['fifo', 'pipe'], optional): Jobserver protocol. `fifo` is understood by
+                GNU make >= 4.4 and ninja >= 1.13, `pipe` by older GNU make. Defaults to None,
+                which picks `fifo` if the installed make supports it.
+        """
+        super().__init__()
+
+        if n_jobs < 1:
+            raise ValueError(f'Invalid number of jobs for jobserver: {n_jobs}')
+
+        self.n_jobs = n_jobs
+        self.style = self.detect_style() if style is None else style
+
+        self._fifo_dir: Path = None
+        self._fifo_path: Path = None
+        self._read_fd: int = None
+        self._write_fd: int = None
+
+    def __enter__(self) -> 'JobServer':
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @staticmethod
+    def detect_style() -> Literal['fifo', 'pipe']:
+        """
+        Detect which jobserver protocol the installed GNU make understands.
+
+        Returns:
+            Literal['fifo', 'pipe']: `fifo` for GNU make >= 4.4, `pipe` otherwise.
+        """
+        if shutil.which('make') is None:
+            return 'fifo'
+
+        try:
+            out = subprocess.check_output(['make', '--version'], text=True)
+            major, minor = re.search(r'(\d+)\.(\d+)', out).groups()
+            return 'fifo' if (int(major), int(minor)) >= (4, 4) else 'pipe'
+        except Exception:
+            return 'pipe'
+
+    def start(self) -> None:
+        """
+        Create the jobserver and fill it with tokens.
+        """
+        if self.style == 'fifo':
+            self._fifo_dir = Path(tempfile.mkdtemp(prefix='extmgr-jobserver-'))
+            self._fifo_path = self._fifo_dir / 'fifo'
+            os.mkfifo(self._fifo_path, 0o600)
+            self._read_fd = self._write_fd = os.open(self._fifo_path, os.O_RDWR)
+        else:
+            self._read_fd, self._write_fd = os.pipe()
+            os.set_inheritable(self._read_fd, True)
+            os.set_inheritable(self._write_fd, True)
+
+        os.write(self._write_fd, b'+' * self.n_jobs)
+        self.debug(f'Started {self.style} jobserver with {self.n_jobs} tokens')
+
+    def close(self) -> None:
+        """
+        Close the jobserver and remove its fifo.
+        """
+        for fd in {self._read_fd, self._write_fd}:
+            if fd is not None:
+                os.close(fd)
+        self._read_fd = self._write_fd = None
+
+        if self._fifo_dir is not None:
+            shutil.rmtree(self._fifo_dir, ignore_errors=True)
+            self._fifo_dir = self._fifo_path = None
+
+    def acquire(self) -> bytes:
+        """
+        Take a token from the jobserver, blocking until one is available.
+
+        Returns:
+            bytes: The token, which must be given back with `release`.
+        """
+        while True:
+            try:
+                token = os.read(self._read_fd, 1)
+            except InterruptedError:
+                continue
+            if token:
+                return token
+
+    def release(self, token: bytes) -> None:
+        """
+        Give a token back to the jobserver.
+
+        Args:
+            token (bytes): Token returned by `acquire`.
+        """
+        os.write(self._write_fd, token)
+
+    @property
+    def auth(self) -> str:
+        """
+        The `--jobserver-auth` value understood by the build tools.
+        """
+        if self.style == 'fifo':
+            return f'fifo:{self._fifo_path}'
+        return f'{self._read_fd},{self._write_fd}'
+
+    @property
+    def pass_fds(self) -> tuple[int, ...]:
+        """
+        File descriptors that must be inherited by child processes.
+        """
+        if self.style == 'fifo':
+            return ()
+        return (self._read_fd, self._write_fd)
+
+    def env(self) -> dict[str, str]:
+        """
+        Environment variables that connect `make` and `ninja` to the jobserver.
+
+        Returns:
+            dict[str, str]: Environment variables to add to the child environment.
+        """
+        return {'MAKEFLAGS': f'-j{self.n_jobs} --jobserver-auth={self.auth}'}
@@ -0,0 +1,32 @@
+import json
+from pathlib import Path
+
+from .BuildEvent import BuildEvent
+from .ILog import ILog
+
+
+class JsonLinesSink(ILog):
+    def __init__(self, path: Path) -> None:
+        """
+        Build event subscriber writing one JSON object per event and line, for analysis with
+        e.g. `jq` or pandas. Lines are flushed as they are written, so the file can be followed
+        during the build.
+
+        Args:
+            path (Path): The output file, overwritten.
+        """
+        super().__init__()
+
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'w', buffering=1)
+
+    def __call__(self, event: BuildEvent) -> None:
+        self._file.write(json.dumps(event.to_dict(), default=str) + '\n')
+
+    def close(self) -> None:
+        """
+        Close the output file.
+        """
+        if not self._file.closed:
+            self._file.close()
@@ -0,0 +1,242 @@
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import threading
+from pathlib import Path
+
+from .ILog import ILog
+from .BasePackage import BasePackage
+
+
+class PackageRegistry(ILog):
+    INDEX_FORMAT = 1
+
+    def __init__(self, roots: dict[str, Path], index_path: Path = None) -> None:
+        """
+        Registry of package recipes. Recipe modules are found under the given root packages,
+        and an index `{(name, version): (module, class)}` of the packages they define is
+        cached on disk. A module is only imported, and its package only instantiated, when
+        the package is requested.
+
+        The index is kept as long as the recipe files are unchanged. Files are compared by
+        mtime and size first and by their SHA-256 if those differ, and any change of the
+        content (or an added or removed file) rebuilds the whole index, since recipes may
+        inherit from classes in other files.
+
+        Args:
+            roots (dict[str, Path]): Recipe root packages, `{module_name: directory}`.
+                `__init__.py` files are not scanned for recipes.
+            index_path (Path, optional): Path of the index cache. Defaults to
+                `$XDG_CACHE_HOME/extmgr/package-index.json`.
+        """
+        super().__init__()
+
+        self.roots = {module: path.resolve() for module, path in roots.items()}
+
+        if index_path is None:
+            cache_home = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'))
+            index_path = cache_home / 'extmgr' / 'package-index.json'
+        self.index_path = index_path
+
+        self._lock = threading.RLock()
+
+        # {(name, version): (module, class)}
+        self._index: dict[tuple[str, str], tuple[str, str]] = None
+
+        # {(name, version): BasePackage}, every package is instantiated once
+        self._instances: dict[tuple[str, str], BasePackage] = {}
+
+        # Packages added with `add`
+        self._added: set[tuple[str, str]] = set()
+
+    ################################################################
+    ####################### Public functions #######################
+    ################################################################
+
+    def has(self, name: str, version: str) -> bool:
+        """
+        Check whether a package version is known, without importing it.
+        """
+        with self._lock:
+            return (name, version) in self._instances or (name, version) in self._load_index()
+
+    def get(self, name: str, version: str) -> BasePackage:
+        """
+        Return the package instance of a version, importing its recipe module if needed.
+
+        Args:
+            name (str): Package name.
+            version (str): Package version.
+
+        Raises:
+            KeyError: If the package version is unknown.
+
+        Returns:
+            BasePackage: The package.
+        """
+        with self._lock:
+            if (name, version) in self._instances:
+                return self._instances[(name, version)]
+
+            module_name, class_name = self._load_index()[(name, version)]
+            cls = getattr(importlib.import_module(module_name), class_name)
+            package = cls()
+            if (package.name, package.version) != (name, version):
+                raise KeyError(f'Index entry of {name} {version} is outdated, run again to rebuild it')
+
+            self._instances[(name, version)] = package
+            return package
+
+    def add(self, package: BasePackage) -> None:
+        """
+        Add a package instance that is not defined under the recipe roots.
+
+        Raises:
+            ValueError: If the package version already exists.
+        """
+        with self._lock:
+            if self.has(package.name, package.version):
+                raise ValueError(f'Package {package.name} {package.version} already exists')
+            self._instances[(package.name, package.version)] = package
+            self._added.add((package.name, package.version))
+
+    def versions(self) -> dict[str, list[str]]:
+        """
+        Return the known versions of every package, without importing them.
+
+        Returns:
+            dict[str, list[str]]: `{name: [version]}`.
+        """
+        with self._lock:
+            res: dict[str, list[str]] = {}
+            for name, version in sorted(set(self._load_index()) | set(self._instances)):
+                res.setdefault(name, []).append(version)
+            return res
+
+    def rebuild(self) -> None:
+        """
+        Rebuild the index by importing all recipe modules.
+        """
+        with self._lock:
+            files = self._scan_files()
+            self._index = self._build_index(files)
+            self._save_index(files)
+
+    ################################################################
+    ####################### Helper functions #######################
+    ################################################################
+
+    def _scan_files(self) -> dict[str, dict]:
+        """
+        Find the recipe modules under the roots.
+
+        Returns:
+            dict[str, dict]: `{path: {'module': ..., 'mtime_ns': ..., 'size': ...}}`.
+        """
+        res = {}
+        for root_module, root_dir in self.roots.items():
+            for dirpath, dirnames, filenames in os.walk(root_dir):
+                dirnames[:] = sorted(d for d in dirnames if not d.startswith(('.', '__')))
+                for filename in sorted(filenames):
+                    if not filename.endswith('.py') or filename == '__init__.py':
+                        continue
+
+                    path = Path(dirpath) / filename
+                    st = path.stat()
+                    module = '.'.join([root_module, *path.relative_to(root_dir).with_suffix('').parts])
+                    res[str(path)] = {'module': module, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+        return res
+
+    @staticmethod
+    def _file_hash(path: str) -> str:
+        return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+    def _load_index(self) -> dict[tuple[str, str], tuple[str, str]]:
+        """
+        Load the cached index, rebuilding it if any recipe file changed.
+        """
+        if self._index is not None:
+            return self._index
+
+        files = self._scan_files()
+
+        try:
+            cached = json.loads(self.index_path.read_text())
+            if cached.get('format') != self.INDEX_FORMAT or cached.get('roots') != {k: str(v) for k, v in self.roots.items()} \
+                    or set(cached['files']) != set(files):
+                raise ValueError('recipe files changed')
+
+            touched = False
+            for path, info in files.items():
+                old = cached['files'][path]
+                if (old['mtime_ns'], old['size']) == (info['mtime_ns'], info['size']):
+                    info['sha256'] = old['sha256']
+                    continue
+
+                # A checkout or touch changes the mtime but not the content
+                info['sha256'] = self._file_hash(path)
+                if info['sha256'] != old['sha256']:
+                    raise ValueError(f'{path} changed')
+                touched = True
+
+            self._index = {(name, version): (module, cls) for name, version, module, cls in cached['packages']}
+            if touched:
+                self._save_index(files)
+            return self._index
+
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.debug(f'Rebuilding package index: {e}')
+
+        self._index = self._build_index(files)
+        self._save_index(files)
+        return self._index
+
+    def _build_index(self, files: dict[str, dict]) -> dict[tuple[str, str], tuple[str, str]]:
+        """
+        Import all recipe modules and index the packages their classes define. Classes that
+        cannot be instantiated (abstract base recipes) are skipped.
+        """
+        res: dict[tuple[str, str], tuple[str, str]] = {}
+        for info in files.values():
+            module = importlib.import_module(info['module'])
+            for class_name, cls in inspect.getmembers(module, inspect.isclass):
+                if cls.__module__ != module.__name__ or not issubclass(cls, BasePackage):
+                    continue
+
+                try:
+                    package = cls()
+                    key = (package.name, package.version)
+                except (AttributeError, NotImplementedError, TypeError):
+                    continue
+
+                if key in res or key in self._added:
+                    raise ValueError(f'Package {key[0]} {key[1]} already exists')
+
+                self.debug(f'Found package: {key[0]} {key[1]}')
+                res[key] = (module.__name__, class_name)
+                self._instances.setdefault(key, package)
+
+        return res
+
+    def _save_index(self, files: dict[str, dict]) -> None:
+        for path, info in files.items():
+            if 'sha256' not in info:
+                info['sha256'] = self._file_hash(path)
+
+        data = {
+            'format': self.INDEX_FORMAT,
+            'roots': {k: str(v) for k, v in self.roots.items()},
+            'files': files,
+            'packages': [[name, version, module, cls] for (name, version), (module, cls) in sorted(self._index.items())]
+        }
+
+        # The index is only a cache, failing to write it is not an error
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.index_path.with_name(f'{self.index_path.name}.{os.getpid()}.tmp')
+            tmp_path.write_text(json.dumps(data, indent=1))
+            tmp_path.replace(self.index_path)
+        except OSError as e:
+            self.debug(f'Failed to write package index {self.index_path}: {e}')
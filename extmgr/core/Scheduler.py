@@ -0,0 +1,355 @@
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Hashable
+
+from .ILog import ILog
+from .BasePackage import BasePackage
+from .HostResources import HostResources
+
+NodeKey = Hashable
+
+
+class Scheduler(ILog):
+    def __init__(self,
+                 nodes: dict[NodeKey, BasePackage],
+                 dependencies: dict[NodeKey, list[NodeKey]],
+                 max_parallel: int = 1,
+                 n_jobs: int | str = 1,
+                 max_parallel_fetches: int = 1,
+                 durations: dict[NodeKey, float] = None,
+                 memory_budget: int = None,
+                 mem_per_job: dict[NodeKey, int] = None,
+                 shared_jobs: bool = False) -> None:
+        """
+        Schedule package builds over a dependency graph. Every package whose dependencies
+        are finished is considered ready, and up to `max_parallel` ready packages are built
+        at the same time.
+
+        Ready packages are started longest remaining critical path first: the priority of a
+        node is its estimated duration plus the longest chain of estimated durations of the
+        nodes depending on it. So long dependency chains start early and short packages fill
+        the gaps.
+
+        With a `memory_budget`, packages are admitted by memory: a package is only given as
+        many jobs as keep the worst case of all running jobs (see `_worst_case_memory`) within
+        the budget. If not even one job fits, or the host is short of memory right now, launches
+        are held back until running packages finish. `BasePackage.max_jobs` caps the jobs of a
+        package in any case.
+
+        Optionally, the sources of all packages are prefetched by a separate pool of
+        `max_parallel_fetches` workers, ahead of and concurrently with the builds. A package
+        is only built once its dependencies are finished and its source is prefetched.
+
+        Args:
+            nodes (dict[NodeKey, BasePackage]): The packages to build, keyed by node.
+            dependencies (dict[NodeKey, list[NodeKey]]): The dependencies of each node.
+            max_parallel (int, optional): Maximum number of packages built at the same time. Defaults to 1.
+            n_jobs (int | str, optional): Total number of jobs shared by running packages. Defaults to 1.
+            max_parallel_fetches (int, optional): Maximum number of sources prefetched at the same time. Defaults to 1.
+            durations (dict[NodeKey, float], optional): Estimated duration of each node in seconds. Defaults to None,
+                which weights all nodes equally.
+            memory_budget (int, optional): Memory in bytes shared by all builds. Defaults to None, no limit.
+            mem_per_job (dict[NodeKey, int], optional): Estimated peak memory of one job of each node in bytes.
+                Required with `memory_budget`. Defaults to None.
+            shared_jobs (bool, optional): Jobs are shared through a jobserver, so every package may use all
+                `n_jobs` instead of a split of them. Defaults to False.
+        """
+        super().__init__()
+
+        self.nodes = nodes
+        self.dependencies = {key: list(dependencies.get(key, [])) for key in nodes}
+        self.max_parallel = max(1, int(max_parallel))
+        self.n_jobs = n_jobs
+        self.max_parallel_fetches = max(1, int(max_parallel_fetches))
+
+        # {node: [dependent_node]}
+        self.dependents: dict[NodeKey, list[NodeKey]] = {key: [] for key in nodes}
+        for key, deps in self.dependencies.items():
+            for dep in deps:
+                if dep not in self.nodes:
+                    raise ValueError(f'Dependency {dep} of {key} is not scheduled')
+                self.dependents[dep].append(key)
+
+        durations = {} if durations is None else durations
+        self.durations = {key: float(durations.get(key, 1.0)) for key in nodes}
+
+        self.memory_budget = memory_budget
+        self.mem_per_job = {} if mem_per_job is None else mem_per_job
+        self.shared_jobs = shared_jobs
+
+        # {node: (max jobs, memory per job)} of running nodes
+        self.reserved: dict[NodeKey, tuple[int, int]] = {}
+
+        # {node: estimated duration of the longest chain starting with it}
+        self.priority: dict[NodeKey, float] = self._critical_paths()
+
+    def _critical_paths(self) -> dict[NodeKey, float]:
+        """
+        Compute the length of the longest chain of estimated durations from each node
+        to the end of the graph.
+
+        Returns:
+            dict[NodeKey, float]: The critical path length of each node.
+        """
+        res: dict[NodeKey, float] = {}
+        n_left = {key: len(deps) for key, deps in self.dependents.items()}
+        stack = [key for key, n in n_left.items() if n == 0]
+        while stack:
+            key = stack.pop()
+            res[key] = self.durations[key] + max((res[d] for d in self.dependents[key]), default=0.0)
+            for dep in self.dependencies[key]:
+                n_left[dep] -= 1
+                if n_left[dep] == 0:
+                    stack.append(dep)
+
+        if len(res) != len(self.nodes):
+            raise ValueError("The graph has a cycle!")
+
+        return res
+
+    def critical_path(self) -> list[NodeKey]:
+        """
+        Return the chain of nodes with the longest total estimated duration.
+
+        Returns:
+            list[NodeKey]: The nodes of the critical path, dependencies first.
+        """
+        roots = [key for key, deps in self.dependencies.items() if not deps]
+        if not roots:
+            return []
+
+        path = [max(roots, key=lambda k: self.priority[k])]
+        while self.dependents[path[-1]]:
+            path.append(max(self.dependents[path[-1]], key=lambda k: self.priority[k]))
+        return path
+
+    @staticmethod
+    def format_duration(seconds: float) -> str:
+        """
+        Format a duration as `12.3s`, `4m05s` or `1h02m`.
+        """
+        if seconds < 60:
+            return f'{seconds:.1f}s'
+        if seconds < 3600:
+            return f'{int(seconds // 60)}m{int(seconds % 60):02d}s'
+        return f'{int(seconds // 3600)}h{int(seconds % 3600 // 60):02d}m'
+
+    def predict_makespan(self) -> float:
+        """
+        Predict the total build time by simulating the schedule with the estimated durations,
+        ignoring source preparation.
+
+        Returns:
+            float: The predicted makespan in seconds.
+        """
+        in_degree = {key: len(deps) for key, deps in self.dependencies.items()}
+        ready = [key for key in self.nodes if in_degree[key] == 0]
+        running: list[tuple[float, NodeKey]] = []  # (finish time, node)
+        now = 0.0
+
+        while ready or running:
+            ready.sort(key=lambda k: self.priority[k], reverse=True)
+            while ready and len(running) < self.max_parallel:
+                key = ready.pop(0)
+                running.append((now + self.durations[key], key))
+
+            running.sort(key=lambda item: item[0])
+            now, key = running.pop(0)
+            for dependent in self.dependents[key]:
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    ready.append(dependent)
+
+        return now
+
+    def _job_share(self, n_running: int, n_ready: int) -> int | str:
+        """
+        Split the jobs budget across the packages that are (or are about to be) running.
+
+        Args:
+            n_running (int): Number of running packages, including the one being launched.
+            n_ready (int): Number of packages still waiting in the ready set.
+
+        Returns:
+            int | str: Number of jobs for the package being launched. An empty string means unlimited.
+        """
+        if self.n_jobs is None or self.n_jobs == '':
+            return ''
+
+        n_slots = min(self.max_parallel, n_running + n_ready)
+        return max(1, int(self.n_jobs) // max(1, n_slots))
+
+    def _worst_case_memory(self, reservations: list[tuple[int, int]]) -> int:
+        """
+        Peak memory if all running packages run as many jobs as they may at the same time.
+        With shared jobs, there are at most `n_jobs` jobs in total, and the worst case gives
+        them to the packages with the largest memory per job first.
+
+        Args:
+            reservations (list[tuple[int, int]]): `(max jobs, memory per job)` of each package.
+
+        Returns:
+            int: The worst case memory in bytes.
+        """
+        jobs_left = int(self.n_jobs) if self.shared_jobs else None
+        total = 0
+        for n, mem_per_job in sorted(reservations, key=lambda r: r[1], reverse=True):
+            if jobs_left is not None:
+                n = min(n, jobs_left)
+                jobs_left -= n
+            total += n * mem_per_job
+        return total
+
+    def _admit(self, key: NodeKey, n_running: int, n_ready: int) -> int | str:
+        """
+        Decide how many jobs a ready node is launched with.
+
+        Args:
+            key (NodeKey): The node to launch.
+            n_running (int): Number of running nodes, including this one.
+            n_ready (int): Number of nodes still waiting in the ready set.
+
+        Returns:
+            int | str: Number of jobs, an empty string for unlimited, or 0 if the node has to wait.
+        """
+        n_jobs = self.n_jobs if self.shared_jobs else self._job_share(n_running, n_ready)
+        max_jobs = self.nodes[key].max_jobs
+
+        if self.memory_budget is None:
+            if max_jobs is None:
+                return n_jobs
+            return max_jobs if n_jobs in (None, '') else min(int(n_jobs), max_jobs)
+
+        mem_per_job = self.mem_per_job[key]
+        n = int(n_jobs) if n_jobs not in (None, '') else self.memory_budget // mem_per_job
+        if max_jobs is not None:
+            n = min(n, max_jobs)
+
+        reservations = list(self.reserved.values())
+        while n > 0 and self._worst_case_memory(reservations + [(n, mem_per_job)]) > self.memory_budget:
+            n -= 1
+
+        if self.reserved:
+            if n < 1:
+                return 0
+            if HostResources.memory_available() < mem_per_job:
+                self.debug(f'Holding back {self.nodes[key].name}, host is short of memory')
+                return 0
+
+        # A node is always launched when nothing else is running, with one job at least
+        return max(1, n)
+
+    def run(self,
+            build_func: Callable[[NodeKey, BasePackage], bool],
+            prefetch_func: Callable[[NodeKey, BasePackage], bool] = None,
+            cancel_func: Callable[[], None] = None) -> bool:
+        """
+        Build all nodes, respecting dependencies.
+
+        Args:
+            build_func (Callable[[NodeKey, BasePackage], bool]): Function that builds one node and
+                returns True on success.
+            prefetch_func (Callable[[NodeKey, BasePackage], bool], optional): Function that prepares
+                the source of one node and returns True on success. Defaults to None.
+            cancel_func (Callable[[], None], optional): Called when interrupted, to stop running builds
+                that an interrupt does not stop, e.g. waits for remote builds. Defaults to None.
+
+        Returns:
+            bool: True if all nodes were built successfully, False otherwise.
+        """
+        in_degree = {key: len(deps) for key, deps in self.dependencies.items()}
+        ready = [key for key in self.nodes if in_degree[key] == 0]
+        running: dict[Future, NodeKey] = {}
+        fetching: dict[Future, NodeKey] = {}
+        fetched = set() if prefetch_func is not None else set(self.nodes)
+        n_finished = 0
+        failed = False
+
+        makespan = self.predict_makespan()
+        path = self.critical_path()
+        self.info(f'Predicted makespan: {self.format_duration(makespan)} with {self.max_parallel} parallel packages, '
+                  f'critical path: {" -> ".join(self.nodes[k].name for k in path)} '
+                  f'({self.format_duration(sum(self.durations[k] for k in path))})')
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as pool, \
+                ThreadPoolExecutor(max_workers=self.max_parallel_fetches) as fetch_pool:
+            try:
+                # A node's priority is higher than the ones of its dependents, so sources on the
+                # critical path are fetched first and dependencies before their dependents
+                if prefetch_func is not None:
+                    for key in sorted(self.nodes, key=lambda k: self.priority[k], reverse=True):
+                        fetching[fetch_pool.submit(prefetch_func, key, self.nodes[key])] = key
+
+                while ready or running or fetching:
+                    # Launch as many ready nodes with prefetched sources as allowed, longest critical path first
+                    launchable = sorted((key for key in ready if key in fetched),
+                                        key=lambda k: self.priority[k], reverse=True)
+                    throttled = False
+                    while launchable and not failed and len(running) < self.max_parallel:
+                        key = launchable[0]
+                        n_jobs = self._admit(key, len(running) + 1, len(ready) - 1)
+                        if n_jobs == 0:
+                            throttled = True
+                            break
+
+                        launchable.pop(0)
+                        ready.remove(key)
+                        package = self.nodes[key]
+                        package.n_jobs = n_jobs
+                        if self.memory_budget is not None:
+                            self.reserved[key] = (int(n_jobs), self.mem_per_job[key])
+
+                        self.debug(f'Launching {package} with {package.n_jobs or "unlimited"} jobs')
+                        running[pool.submit(build_func, key, package)] = key
+
+                    if failed and not running:
+                        for future in fetching:
+                            future.cancel()
+                        break
+
+                    if not running and not fetching:
+                        break
+
+                    # Memory is checked again from time to time while launches are held back
+                    done, _ = wait(list(running) + list(fetching), timeout=5 if throttled else None,
+                                   return_when=FIRST_COMPLETED)
+                    for future in done:
+                        is_fetch = future in fetching
+                        key = fetching.pop(future) if is_fetch else running.pop(future)
+                        if not is_fetch:
+                            self.reserved.pop(key, None)
+                        try:
+                            ok = future.result()
+                        except Exception as e:
+                            self.error(f'Unexpected error while {"fetching" if is_fetch else "building"} '
+                                       f'{self.nodes[key]}: {e}')
+                            ok = False
+
+                        if not ok:
+                            failed = True
+                            continue
+
+                        if is_fetch:
+                            fetched.add(key)
+                            continue
+
+                        n_finished += 1
+                        for dependent in self.dependents[key]:
+                            in_degree[dependent] -= 1
+                            if in_degree[dependent] == 0:
+                                ready.append(dependent)
+
+            except KeyboardInterrupt:
+                for future in list(running) + list(fetching):
+                    future.cancel()
+                if cancel_func is not None:
+                    cancel_func()
+                raise
+
+        if failed:
+            self.error('Stopped scheduling new packages after a failure')
+            return False
+
+        if n_finished != len(self.nodes):
+            raise ValueError("The graph has a cycle!")
+
+        return True
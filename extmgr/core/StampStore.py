@@ -0,0 +1,390 @@
+import json
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from .ILog import ILog
+
+
+class StampStore(ILog):
+    DB_NAME = 'step_stamps.db'
+
+    # Build flags of `main.py`, `<arch>-<os>-<compiler>-<type>`; the architecture is empty where
+    # `platform.processor()` is
+    FLAG_PATTERN = re.compile(r'([^-]*-[^-]+-[^-]+-(?:opt|dbg|rwd))-(.+)')
+
+    # {db_path: StampStore}, one store per install prefix and process
+    _stores: dict[Path, 'StampStore'] = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, db_path: Path, readonly: bool = False, detached: bool = False) -> None:
+        """
+        Step stamps of all packages under an install prefix, kept in a single SQLite
+        database in WAL mode. Every step is written with its own atomic upsert, so builds of
+        the same version with different build flags (in several threads or processes) can
+        share the prefix safely.
+
+        All stamps are loaded once when the store is opened. Stamps of older versions
+        (`<name>/<version>/step_stamp.json`) are migrated into the database.
+
+        Args:
+            db_path (Path): Path of the database file.
+            readonly (bool, optional): Never create or write the database, e.g. for dry runs. Defaults to False.
+            detached (bool, optional): Never open the database, record all writes in `journal` instead,
+                see `detached`. Defaults to False.
+        """
+        super().__init__()
+
+        self.db_path = db_path
+        self.readonly = readonly
+
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection = None
+
+        # {(package, version): {step_key: {'fingerprint': ..., 'time': ...}}}
+        self._stamps: dict[tuple[str, str], dict[str, dict]] = defaultdict(dict)
+
+        # Writes of a detached store, `[operation, package, version, flag, step, value]`, see `replay`
+        self.journal: list[list] = [] if detached else None
+
+        if not detached:
+            self._open()
+
+    @classmethod
+    def for_prefix(cls, install_prefix: Path, readonly: bool = False) -> 'StampStore':
+        """
+        Return the store of an install prefix, opening it on first use.
+
+        Args:
+            install_prefix (Path): The install prefix.
+            readonly (bool, optional): See `__init__`. Defaults to False.
+
+        Returns:
+            StampStore: The store.
+        """
+        db_path = install_prefix.resolve() / cls.DB_NAME
+        with cls._stores_lock:
+            store = cls._stores.get(db_path)
+            if store is None or (store.readonly and not readonly):
+                store = cls(db_path, readonly)
+                cls._stores[db_path] = store
+            return store
+
+    @classmethod
+    @contextmanager
+    def detached(cls, install_prefix: Path, stamps: list[list]) -> Iterator['StampStore']:
+        """
+        Use a detached store for an install prefix in this process, e.g. in a distributed build
+        worker: SQLite databases must not be written from several hosts (the WAL index lives in
+        shared memory, and locks are unreliable on network file systems). The store starts with
+        the given stamps and records its writes in `journal`, for the coordinator to `replay`.
+
+        Args:
+            install_prefix (Path): The install prefix.
+            stamps (list[list]): `[package, version, stamps]` of the packages the build needs, see `export`.
+
+        Yields:
+            StampStore: The detached store, returned by `for_prefix` until the context is left.
+        """
+        db_path = install_prefix.resolve() / cls.DB_NAME
+        store = cls(db_path, detached=True)
+        for package, version, package_stamps in stamps:
+            store._stamps[(package, version)] = dict(package_stamps)
+
+        with cls._stores_lock:
+            previous = cls._stores.get(db_path)
+            cls._stores[db_path] = store
+        try:
+            yield store
+        finally:
+            with cls._stores_lock:
+                if previous is None:
+                    cls._stores.pop(db_path, None)
+                else:
+                    cls._stores[db_path] = previous
+
+    ################################################################
+    ####################### Public functions #######################
+    ################################################################
+
+    def stamps_of(self, package: str, version: str, refresh: bool = False) -> dict[str, dict]:
+        """
+        Return the stamps of a package version, keyed like `BasePackage.step_stamp`.
+
+        Args:
+            package (str): Package name.
+            version (str): Package version.
+            refresh (bool, optional): Re-read the stamps from the database, e.g. after waiting
+                for another process. Defaults to False.
+
+        Returns:
+            dict[str, dict]: A copy of the stamps.
+        """
+        with self._lock:
+            if refresh and self._conn is not None:
+                rows = self._conn.execute('SELECT package, version, flag, step, fingerprint, time FROM stamps '
+                                          'WHERE package = ? AND version = ?', (package, version)).fetchall()
+                self._stamps[(package, version)] = {}
+                self._add_rows(rows)
+
+            return dict(self._stamps[(package, version)])
+
+    def upsert(self, package: str, version: str, flag: str, step: str, stamp: dict | float) -> None:
+        """
+        Insert or replace the stamp of one step.
+
+        Args:
+            package (str): Package name.
+            version (str): Package version.
+            flag (str): Build flag, empty for steps shared by all build flags.
+            step (str): Step name, without build flag.
+            stamp (dict | float): `{'fingerprint': ..., 'time': ...}`, or a legacy timestamp.
+        """
+        fingerprint, time = (stamp.get('fingerprint'), stamp.get('time')) if isinstance(stamp, dict) else (None, stamp)
+
+        with self._lock:
+            self._stamps[(package, version)][self.step_key(flag, step)] = stamp
+            if self.journal is not None:
+                self.journal.append(['upsert', package, version, flag, step, stamp])
+            if self._conn is not None and not self.readonly:
+                with self._conn:
+                    self._conn.execute('INSERT INTO stamps (package, version, flag, step, fingerprint, time) '
+                                       'VALUES (?, ?, ?, ?, ?, ?) '
+                                       'ON CONFLICT (package, version, flag, step) '
+                                       'DO UPDATE SET fingerprint = excluded.fingerprint, time = excluded.time',
+                                       (package, version, flag, step, fingerprint, time))
+
+    def delete(self, package: str, version: str, flag: str, step: str) -> None:
+        """
+        Delete the stamp of one step.
+        """
+        with self._lock:
+            self._stamps[(package, version)].pop(self.step_key(flag, step), None)
+            if self.journal is not None:
+                self.journal.append(['delete', package, version, flag, step, None])
+            if self._conn is not None and not self.readonly:
+                with self._conn:
+                    self._conn.execute('DELETE FROM stamps WHERE package = ? AND version = ? AND flag = ? AND step = ?',
+                                       (package, version, flag, step))
+
+    def query(self, package: str = None, version: str = None, flag: str = None) -> list[tuple]:
+        """
+        Query stamps, e.g. for status reports.
+
+        Args:
+            package (str, optional): Filter by package name. Defaults to None.
+            version (str, optional): Filter by package version. Defaults to None.
+            flag (str, optional): Filter by build flag. Defaults to None.
+
+        Returns:
+            list[tuple]: `(package, version, flag, step, fingerprint, time)` rows.
+        """
+        if self._conn is None:
+            return []
+
+        conditions, params = [], []
+        for column, value in (('package', package), ('version', version), ('flag', flag)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+
+        sql = 'SELECT package, version, flag, step, fingerprint, time FROM stamps'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+
+        with self._lock:
+            return self._conn.execute(sql + ' ORDER BY package, version, flag, time', params).fetchall()
+
+    def add_run(self, package: str, version: str, flag: str, step: str, usage: dict) -> None:
+        """
+        Record the resources used by one execution of a step, see `BasePackage._run_cmds`.
+
+        Args:
+            package (str): Package name.
+            version (str): Package version.
+            flag (str): Build flag, empty for steps shared by all build flags.
+            step (str): Step name, without build flag.
+            usage (dict): `start`, `wall`, `user`, `sys`, `max_rss`, `written` and `ok`.
+        """
+        if self.journal is not None:
+            with self._lock:
+                self.journal.append(['run', package, version, flag, step, usage])
+        if self._conn is None or self.readonly:
+            return
+
+        with self._lock, self._conn:
+            self._conn.execute('INSERT INTO step_runs (package, version, flag, step, start, wall, user, sys, max_rss, written, ok) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (package, version, flag, step, usage['start'], usage['wall'], usage['user'], usage['sys'],
+                                usage['max_rss'], usage['written'], int(usage['ok'])))
+
+    def export(self, packages: list[tuple[str, str]]) -> list[list]:
+        """
+        Return the stamps of some package versions, to start a detached store with, see `detached`.
+
+        Args:
+            packages (list[tuple[str, str]]): `(package, version)` of the packages.
+
+        Returns:
+            list[list]: `[package, version, stamps]` per package, JSON-serializable.
+        """
+        with self._lock:
+            return [[package, version, dict(self._stamps[(package, version)])] for package, version in packages]
+
+    def replay(self, journal: list[list]) -> None:
+        """
+        Apply the writes recorded by a detached store, see `detached`.
+
+        Args:
+            journal (list[list]): The `journal` of the detached store.
+        """
+        for operation, package, version, flag, step, value in journal:
+            if operation == 'upsert':
+                self.upsert(package, version, flag, step, value)
+            elif operation == 'delete':
+                self.delete(package, version, flag, step)
+            elif operation == 'run':
+                self.add_run(package, version, flag, step, value)
+            else:
+                self.warn(f'Ignoring unknown stamp operation {operation!r} for {package} {version}')
+
+    def run_stats(self, flag: str = None) -> list[dict]:
+        """
+        Statistics of the successful executions of every step, across runs.
+
+        Args:
+            flag (str, optional): Only steps of this build flag (and the shared steps). Defaults to None.
+
+        Returns:
+            list[dict]: One dict per step with its key, `runs`, `last` (start time) and the mean
+                `wall`, `cpu` and `written` and maximum `max_rss` of its executions.
+        """
+        if self._conn is None:
+            return []
+
+        sql = ('SELECT package, version, flag, step, COUNT(*), MAX(start), AVG(wall), AVG(user + sys), MAX(max_rss), AVG(written) '
+               'FROM step_runs WHERE ok = 1')
+        params = []
+        if flag is not None:
+            sql += ' AND flag IN (?, \'\')'
+            params.append(flag)
+        sql += ' GROUP BY package, version, flag, step'
+
+        with self._lock:
+            try:
+                rows = self._conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError:
+                # Database written before step runs were recorded
+                return []
+
+        keys = ['package', 'version', 'flag', 'step', 'runs', 'last', 'wall', 'cpu', 'max_rss', 'written']
+        return [dict(zip(keys, row)) for row in rows]
+
+    @staticmethod
+    def step_key(flag: str, step: str) -> str:
+        """
+        Key of a step in `BasePackage.step_stamp`: build steps are prefixed by the build flag.
+        """
+        return f'{flag}-{step}' if flag else step
+
+    @classmethod
+    def split_step_key(cls, key: str, build_flag: str = None, known_flags: list[str] = None) -> tuple[str, str]:
+        """
+        Split a step key into `(flag, step)`.
+
+        Args:
+            key (str): The step key.
+            build_flag (str, optional): The build flag, if known. Otherwise the key is matched against
+                `known_flags`, or without them against the `<arch>-<os>-<compiler>-<type>` form of
+                build flags, see `FLAG_PATTERN`. Defaults to None.
+            known_flags (list[str], optional): All build flags the key may have, e.g. those installed. Defaults to None.
+
+        Returns:
+            tuple[str, str]: The build flag (empty for shared steps) and the step name.
+        """
+        if build_flag and key.startswith(f'{build_flag}-'):
+            return build_flag, key[len(build_flag) + 1:]
+
+        if build_flag is None and known_flags is not None:
+            # Longest first, a flag may start like another one
+            for flag in sorted(known_flags, key=len, reverse=True):
+                if key.startswith(f'{flag}-'):
+                    return flag, key[len(flag) + 1:]
+
+        elif build_flag is None:
+            m = cls.FLAG_PATTERN.fullmatch(key)
+            if m is not None:
+                return m[1], m[2]
+
+        return '', key
+
+    ################################################################
+    ####################### Helper functions #######################
+    ################################################################
+
+    def _open(self) -> None:
+        """
+        Open (and create) the database, load all stamps and migrate legacy JSON stamps.
+        """
+        if self.readonly and not self.db_path.exists():
+            self._migrate_json()
+            return
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        uri = f'file:{self.db_path}?mode=ro' if self.readonly else f'file:{self.db_path}'
+        self._conn = sqlite3.connect(uri, uri=True, timeout=60, check_same_thread=False)
+
+        if not self.readonly:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS stamps ('
+                                   'package TEXT NOT NULL, version TEXT NOT NULL, flag TEXT NOT NULL, step TEXT NOT NULL, '
+                                   'fingerprint TEXT, time REAL, '
+                                   'PRIMARY KEY (package, version, flag, step))')
+                self._conn.execute('CREATE TABLE IF NOT EXISTS step_runs ('
+                                   'package TEXT NOT NULL, version TEXT NOT NULL, flag TEXT NOT NULL, step TEXT NOT NULL, '
+                                   'start REAL, wall REAL, user REAL, sys REAL, max_rss INTEGER, written INTEGER, ok INTEGER)')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS step_runs_key ON step_runs (package, version, flag, step)')
+
+        self._add_rows(self._conn.execute('SELECT package, version, flag, step, fingerprint, time FROM stamps').fetchall())
+        self._migrate_json()
+
+    def _add_rows(self, rows: list[tuple]) -> None:
+        for package, version, flag, step, fingerprint, time in rows:
+            stamp = {'fingerprint': fingerprint, 'time': time} if fingerprint is not None else time
+            self._stamps[(package, version)][self.step_key(flag, step)] = stamp
+
+    def _migrate_json(self) -> None:
+        """
+        Import `<name>/<version>/step_stamp.json` files written by older versions. Migrated
+        files are renamed to `step_stamp.json.migrated`.
+        """
+        prefix = self.db_path.parent
+        if not prefix.is_dir():
+            return
+
+        for json_path in prefix.glob('*/*/step_stamp.json'):
+            package, version = json_path.parent.parent.name, json_path.parent.name
+            # Every build flag has its install directory next to the source
+            flags = [p.name for p in json_path.parent.iterdir() if p.is_dir() and p.name != 'src']
+            try:
+                stamps = json.loads(json_path.read_text())
+            except Exception as e:
+                self.error(f'Failed to migrate stamp file {json_path}: {e}, please check it or remove it!')
+                raise RuntimeError('Failed to load stamp file')
+
+            for key, stamp in stamps.items():
+                flag, step = self.split_step_key(key, known_flags=flags)
+                if self.readonly:
+                    self._stamps[(package, version)].setdefault(key, stamp)
+                else:
+                    self.upsert(package, version, flag, step, stamp)
+
+            if not self.readonly:
+                json_path.rename(json_path.with_name('step_stamp.json.migrated'))
+                self.info(f'Migrated {json_path} to {self.db_path}')
@@ -0,0 +1,99 @@
+import gzip
+import os
+import select
+import threading
+from collections import deque
+from pathlib import Path
+
+from .ILog import ILog
+
+
+class StepLog(ILog):
+    # Compression level of the log files, fast compression keeps up with any build output
+    COMPRESS_LEVEL = 1
+    READ_SIZE = 1 << 16
+
+    # Seconds to wait for output after the step exited, e.g. from a daemon it started that still holds the pipe
+    DRAIN_TIMEOUT = 0.5
+
+    def __init__(self, path: Path, tail_lines: int = 50) -> None:
+        """
+        The output of a step, written to a gzip-compressed log file by a background thread.
+        The last `tail_lines` lines are also kept in memory, to be shown if the step fails.
+
+        Args:
+            path (Path): Path of the log file, e.g. `<build_dir>/logs/<step>.log.gz`.
+            tail_lines (int, optional): Number of lines kept in memory. Defaults to 50.
+        """
+        super().__init__()
+
+        self.path = path
+        self._tail: deque[str] = deque(maxlen=tail_lines)
+        self._partial = b''
+
+        self._fd: int = None
+        self._thread: threading.Thread = None
+        self._stop = threading.Event()
+
+    def start(self, fd: int) -> None:
+        """
+        Start reading the output of a step.
+
+        Args:
+            fd (int): Read end of the pipe the step writes to. It is closed by `close`.
+        """
+        self._fd = fd
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name=f'log-{self.path.name}', daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """
+        Wait until all output of the exited step is written, then close the log.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def tail(self) -> list[str]:
+        """
+        Return the last lines of the output.
+
+        Returns:
+            list[str]: The lines, without line endings.
+        """
+        res = list(self._tail)
+        if self._partial:
+            res = (res + [self._partial.decode(errors='replace')])[-self._tail.maxlen:]
+        return res
+
+    def _run(self) -> None:
+        try:
+            with gzip.open(self.path, 'wb', compresslevel=self.COMPRESS_LEVEL) as f:
+                while True:
+                    # Blocks until output arrives; after the step exited, only until the pipe is drained
+                    ready, _, _ = select.select([self._fd], [], [], self.DRAIN_TIMEOUT)
+                    if not ready:
+                        if self._stop.is_set():
+                            break
+                        continue
+
+                    data = os.read(self._fd, self.READ_SIZE)
+                    if not data:
+                        break
+
+                    f.write(data)
+                    self._add_lines(data)
+
+        except OSError as e:
+            self.error(f'Failed to write log {self.path}: {e}')
+
+    def _add_lines(self, data: bytes) -> None:
+        lines = (self._partial + data).replace(b'\r\n', b'\n').split(b'\n')
+        self._partial = lines.pop()
+        for line in lines[-self._tail.maxlen:]:
+            self._tail.append(line.rsplit(b'\r', 1)[-1].decode(errors='replace'))
@@ -0,0 +1,195 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from .ILog import ILog
+
+
+class WorkQueue(ILog):
+    STATES = ('pending', 'claimed', 'done', 'failed')
+
+    def __init__(self, path: Path, stale_after: float = 300, poll_interval: float = 0.5) -> None:
+        """
+        A queue of build jobs in a directory on a shared file system, between a coordinator
+        publishing jobs and worker processes on any host that can see the directory.
+
+        Every job is a JSON file moving through the directories `pending/`, `claimed/` and
+        `done/` or `failed/`. Each move is an atomic rename, so exactly one worker claims a
+        job and readers never see a partial file. Workers touch the claimed file while they
+        work on it; a claim that was not touched for `stale_after` seconds (its worker died)
+        is put back into `pending/` by the coordinator waiting for it.
+
+        Args:
+            path (Path): The queue directory, created if needed.
+            stale_after (float, optional): Seconds after which an untouched claim is stale. Defaults to 300.
+            poll_interval (float, optional): Seconds between checks of the directories. Defaults to 0.5.
+        """
+        super().__init__()
+
+        self.path = path
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+
+        # Set to stop waiting for jobs, see `cancel`
+        self._cancelled = threading.Event()
+
+        # Jobs published by this process and not finished yet
+        self._published: set[str] = set()
+        self._lock = threading.Lock()
+
+        for state in self.STATES:
+            (self.path / state).mkdir(parents=True, exist_ok=True)
+
+    def _job_path(self, state: str, job_id: str) -> Path:
+        return self.path / state / f'{job_id}.json'
+
+    def _write(self, state: str, job_id: str, data: dict) -> None:
+        # Written under a name no reader looks at, then renamed into place
+        tmp_path = self.path / state / f'.{job_id}.{os.getpid()}.tmp'
+        tmp_path.write_text(json.dumps(data, indent=1, default=str))
+        tmp_path.rename(self._job_path(state, job_id))
+
+    ################################################################
+    ######################### Coordinator ##########################
+    ################################################################
+
+    def publish(self, job: dict) -> str:
+        """
+        Publish a job for the workers.
+
+        Args:
+            job (dict): The job, JSON-serializable.
+
+        Returns:
+            str: The job id. Ids sort in publishing order, workers take the oldest job first.
+        """
+        job_id = f'{time.time():.6f}-{uuid.uuid4().hex[:8]}'
+        self._write('pending', job_id, job | {'id': job_id, 'published': time.time(), 'by': self.worker_name()})
+        with self._lock:
+            self._published.add(job_id)
+        return job_id
+
+    def wait(self, job_id: str) -> dict:
+        """
+        Wait until a job is finished, putting it back into the queue if its worker died.
+
+        Args:
+            job_id (str): The job id returned by `publish`.
+
+        Returns:
+            dict: The result reported by the worker, with `ok`, or None if waiting was cancelled.
+        """
+        try:
+            while not self._cancelled.wait(self.poll_interval):
+                for state in ('done', 'failed'):
+                    path = self._job_path(state, job_id)
+                    try:
+                        result = json.loads(path.read_text())
+                    except FileNotFoundError:
+                        continue
+                    path.unlink(missing_ok=True)
+                    return result
+
+                self._requeue_if_stale(job_id)
+            return None
+
+        finally:
+            with self._lock:
+                self._published.discard(job_id)
+
+    def cancel(self) -> None:
+        """
+        Stop all waits and withdraw the jobs of this process that no worker claimed yet.
+        Claimed jobs are finished by their workers.
+        """
+        self._cancelled.set()
+        with self._lock:
+            for job_id in self._published:
+                self._job_path('pending', job_id).unlink(missing_ok=True)
+            self._published.clear()
+
+    def _requeue_if_stale(self, job_id: str) -> None:
+        claimed_path = self._job_path('claimed', job_id)
+        try:
+            age = time.time() - claimed_path.stat().st_mtime
+        except FileNotFoundError:
+            return
+
+        if age > self.stale_after:
+            try:
+                owner = json.loads(claimed_path.read_text()).get('worker', 'a worker')
+                claimed_path.rename(self._job_path('pending', job_id))
+            except (FileNotFoundError, json.JSONDecodeError):
+                return
+            self.warn(f'Job {job_id} was claimed by {owner} but not touched for {age:.0f}s, queued again')
+
+    ################################################################
+    ############################ Worker ############################
+    ################################################################
+
+    @staticmethod
+    def worker_name() -> str:
+        """
+        Name of the current process in the queue, `<host>:<pid>`.
+        """
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def claim(self) -> dict:
+        """
+        Claim the oldest pending job.
+
+        Returns:
+            dict: The job, or None if no job is pending.
+        """
+        for path in sorted((self.path / 'pending').glob('*.json')):
+            job_id = path.stem
+            claimed_path = self._job_path('claimed', job_id)
+            try:
+                # A rename keeps the modification time, a job that waited longer than `stale_after`
+                # would look stale as soon as it is claimed, and be queued (and built) again
+                os.utime(path)
+                # Only one of the workers trying this succeeds
+                path.rename(claimed_path)
+            except FileNotFoundError:
+                continue
+
+            try:
+                job = json.loads(claimed_path.read_text())
+            except (FileNotFoundError, json.JSONDecodeError) as e:
+                self.error(f'Dropping unreadable job {job_id}: {e}')
+                claimed_path.unlink(missing_ok=True)
+                continue
+
+            # Rewritten in place, the coordinator can tell who works on it
+            claimed_path.write_text(json.dumps(job | {'worker': self.worker_name(), 'claimed': time.time()}, indent=1))
+            return job
+
+        return None
+
+    def touch(self, job_id: str) -> None:
+        """
+        Show that the worker of a claimed job is alive, see `stale_after`.
+
+        Args:
+            job_id (str): The job id.
+        """
+        try:
+            os.utime(self._job_path('claimed', job_id))
+        except FileNotFoundError:
+            pass
+
+    def finish(self, job_id: str, result: dict) -> None:
+        """
+        Report the result of a claimed job to the coordinator.
+
+        Args:
+            job_id (str): The job id.
+            result (dict): The result, with `ok`.
+        """
+        self._write('done' if result.get('ok') else 'failed', job_id,
+                    result | {'id': job_id, 'worker': self.worker_name(), 'finished': time.time()})
+        self._job_path('claimed', job_id).unlink(missing_ok=True)
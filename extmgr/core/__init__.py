@@ -2,4 +2,20 @@ from .BuildConfig import BuildConfig
 from .BasePackage import BasePackage, StepName, CmdList
 from .BaseDistribution import BaseDistribution
 from .ILog import ILog
+from .JobServer import JobServer
+from .Scheduler import Scheduler
+from .Archive import Archive
+from .BuildCache import BuildCache
+from .Bundle import Bundle
+from .PackageRegistry import PackageRegistry
+from .HostResources import HostResources
+from .CompilerCache import CompilerCache
+from .StepLog import StepLog
+from .StampStore import StampStore
+from .FileLock import FileLock
+from .WorkQueue import WorkQueue
+from .BuildEvent import BuildEvent, EventKind
+from .EventBus import EventBus
+from .JsonLinesSink import JsonLinesSink
+from .ChromeTraceSink import ChromeTraceSink
 from .Executor import Executor
@@ -1,5 +1,5 @@
-from . import boss_externals
-from . import examples
+# Package recipes under this directory are found by `Executor().registry`,
+# they are only imported when a distribution needs them
 from extmgr.core import Executor
 
 distributions = [
@@ -29,7 +29,6 @@ distributions = [
 ]
 
 dist_executor = Executor()
-# dist_executor.update_packages()
 
 
 for dist in distributions:
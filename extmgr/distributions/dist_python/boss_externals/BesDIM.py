@@ -36,16 +36,12 @@ class BesDIM(BasePackage):
             ('build', build_cmds)
         ]
 
-    def setup_cmds(self) -> dict[str, list[str]]:
-        env_to_append = [("INCLUDE", f"{self.install_dir}/include"),
-                         ("LIB", f"{self.install_dir}/lib64"),
-                         ("LD_LIBRARY_PATH", f"{self.install_dir}/lib64")]
-
-        sh_cmds = self.append_envvar(env_to_append, 'sh')
-        csh_cmds = self.append_envvar(env_to_append, 'csh')
-
-        return {'sh': sh_cmds,
-                'csh': csh_cmds}
+    def setup_envvars(self) -> list[tuple[str, str]]:
+        return [
+            ("INCLUDE", f"{self.install_dir}/include"),
+            ("LIB", f"{self.install_dir}/lib64"),
+            ("LD_LIBRARY_PATH", f"{self.install_dir}/lib64")
+        ]
 
 
 class BesDIM_v20r20(BesDIM):
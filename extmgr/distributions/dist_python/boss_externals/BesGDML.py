@@ -35,19 +35,13 @@ class BesGDML(BasePackage):
             ('build', build_cmds)
         ]
 
-    def setup_cmds(self) -> dict[str, list[str]]:
-        env_to_append = [
+    def setup_envvars(self) -> list[tuple[str, str]]:
+        return [
             ("PATH", f"{self.install_dir}/include"),
             ("LIB", f"{self.install_dir}/lib64"),
             ("LD_LIBRARY_PATH", f"{self.install_dir}/lib64")
         ]
 
-        sh_cmds = self.append_envvar(env_to_append, shell='sh')
-        csh_cmds = self.append_envvar(env_to_append, shell='csh')
-
-        return {'sh': sh_cmds,
-                'csh': csh_cmds}
-
 
 class BesGDML_2_8_1(BesGDML):
     @property
@@ -48,7 +48,8 @@ class BesGeant4(BasePackage):
 
     def build_steps(self) -> list[tuple[str, CmdList]]:
         cmake_args = {
-            "GEANT4_INSTALL_DATA": 'OFF' if self.data_dir.exists() else 'ON',
+            # Decided when the step runs, so the step does not change once the data is installed
+            "GEANT4_INSTALL_DATA": f'$([ -d {self.data_dir} ] && echo OFF || echo ON)',
             "GEANT4_USE_GDML": 'ON',
             "GEANT4_USE_SYSTEM_CLHEP": 'ON'
         }
@@ -41,18 +41,14 @@ class Gaudi(BasePackage):
             ('build', build_cmds)
         ]
 
-    def setup_cmds(self) -> dict[str, list[str]]:
-        env_to_append = [("INCLUDE", f"{self.install_dir}/include"),
-                         ("LIB", f"{self.install_dir}/lib64"),
-                         ("PATH", f"{self.install_dir}/bin"),
-                         ("LD_LIBRARY_PATH", f"{self.install_dir}/lib64"),
-                         ("PYTHONPATH", f"{self.install_dir}/python")]
-
-        sh_cmds = self.append_envvar(env_to_append, 'sh')
-        csh_cmds = self.append_envvar(env_to_append, 'csh')
-
-        return {'sh': sh_cmds,
-                'csh': csh_cmds}
+    def setup_envvars(self) -> list[tuple[str, str]]:
+        return [
+            ("INCLUDE", f"{self.install_dir}/include"),
+            ("LIB", f"{self.install_dir}/lib64"),
+            ("PATH", f"{self.install_dir}/bin"),
+            ("LD_LIBRARY_PATH", f"{self.install_dir}/lib64"),
+            ("PYTHONPATH", f"{self.install_dir}/python")
+        ]
 
 
 class Gaudi_v38r2(Gaudi):
@@ -1,6 +0,0 @@
-from .BesAlist import BesAlist
-from .BesDIM import BesDIM_v20r20
-from .BesGDML import BesGDML_2_8_1
-from .BesGeant4 import BesGeant4_10_7_2
-from .CERNLIB import CERNLIB_2006120
-from .Gaudi import Gaudi_v38r2
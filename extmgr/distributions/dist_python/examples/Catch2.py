@@ -32,20 +32,14 @@ class Catch2(BasePackage):
             ('build', build_cmds)
         ]
 
-    def setup_cmds(self) -> dict[str, list[str]]:
-        env_to_append: list[tuple[str, str]] = [
+    def setup_envvars(self) -> list[tuple[str, str]]:
+        return [
             ("INCLUDE", f"{self.install_dir}/include"),
             ("LIB", f"{self.install_dir}/lib64"),
             ("LD_LIBRARY_PATH", f"{self.install_dir}/lib64"),
             ("CMAKE_PREFIX_PATH", f"{self.install_dir}/lib64/cmake/Catch2")
         ]
 
-        sh_cmds = self.append_envvar(env_to_append, shell='sh')
-        csh_cmds = self.append_envvar(env_to_append, shell='csh')
-
-        return {'sh': sh_cmds,
-                'csh': csh_cmds}
-
 
 class Catch2_v3_7_1(Catch2):
     @property
@@ -1,4 +0,0 @@
-from .Catch2 import Catch2_v3_5_4
-from .Catch2 import Catch2_v3_7_1
-from .fmt import Fmt_10_2_1
-from .fmt import Fmt_11_0_2
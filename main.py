@@ -1,8 +1,10 @@
 import argparse
+import dataclasses
 import os
 import logging
 import platform
 import subprocess
+import sys
 from pathlib import Path
 from typing import Literal
 
@@ -36,91 +38,417 @@ def pos_int(value) -> str:
     return str(ivalue)
 
 
+def pos_count(value) -> int:
+    try:
+        ivalue = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+
+    if ivalue <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+
+    return ivalue
+
+
+def pos_size(value) -> int:
+    units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+    number, unit = value.rstrip('iBb'), ''
+    if number[-1:].upper() in units:
+        number, unit = number[:-1], number[-1].upper()
+
+    try:
+        ivalue = int(float(number) * units[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a memory size")
+
+    if ivalue <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive memory size")
+
+    return ivalue
+
+
+BUILD_TYPES: dict[str, Literal['Release', 'Debug', 'RelWithDebInfo']] = {
+    'opt': 'Release',
+    'dbg': 'Debug',
+    'rwd': 'RelWithDebInfo'
+}
+
+
+def build_type_list(value) -> list[str]:
+    res = [v.strip() for v in value.split(',') if v.strip() != '']
+    for v in res:
+        if v not in BUILD_TYPES:
+            raise argparse.ArgumentTypeError(f"{v} is not a build type, choose from {', '.join(BUILD_TYPES)}")
+
+    if len(res) == 0:
+        raise argparse.ArgumentTypeError("no build type given")
+
+    return list(dict.fromkeys(res))
+
+
+def name_list(value) -> list[str]:
+    res = [v.strip() for v in value.split(',') if v.strip() != '']
+    if len(res) == 0:
+        raise argparse.ArgumentTypeError("no package given")
+
+    return list(dict.fromkeys(res))
+
+
+def add_build_type_args(parser: argparse.ArgumentParser, matrix: bool = False) -> None:
+    build_type_group = parser.add_argument_group('build type')
+    build_type_mutex = build_type_group.add_mutually_exclusive_group()
+
+    build_type_mutex.add_argument('-opt', '--release',
+                                  help="build release version",
+                                  action='store_true',
+                                  default=False,
+                                  dest='build_type_opt')
+
+    build_type_mutex.add_argument('-dbg', '--debug',
+                                  help="build debug version",
+                                  action='store_true',
+                                  default=False,
+                                  dest='build_type_dbg')
+
+    build_type_mutex.add_argument('-rwd', '--relwithdebinfo',
+                                  help="build release with debug info",
+                                  action='store_true',
+                                  default=False,
+                                  dest='build_type_rwd')
+
+    if matrix:
+        build_type_mutex.add_argument('--build-types',
+                                      help="build several types in one schedule, e.g. opt,dbg,rwd",
+                                      type=build_type_list,
+                                      dest='build_types',
+                                      metavar='TYPES')
+
+
+# Distribution names come from the registered specs, no package is imported for them
+dist_names = extmgr.core.Executor().distribution_names()
+
 parser = argparse.ArgumentParser(
     prog="python3 main.py",
     description="build external distributions",
 )
 
-parser.add_argument('-p', '--prefix',
-                    help='installations prefix',
-                    type=str,
-                    dest='prefix',
-                    action='store',
-                    required=True)
-
-parser.add_argument('-d', '--dist',
-                    help='distribution to build',
-                    type=str,
-                    dest='dist',
-                    action='store',
-                    choices=list(extmgr.core.Executor().dists.keys()),
-                    required=True)
-
-parser.add_argument('-j', '--jobs',
-                    help='number of processors to use',
-                    type=pos_int,
-                    default=1,
-                    nargs='?',
-                    const='',
-                    dest='jobs',
-                    action='store')
-
-parser.add_argument('--build-dir',
-                    help="build directory",
-                    type=str,
-                    default="build",
-                    dest='build_dir',
-                    action="store")
-
-parser.add_argument('--patch-dir',
-                    help="patches directory",
-                    type=str,
-                    dest='patch_dir',
-                    action="store")
-
-parser.add_argument('--dry-run',
-                    help="only show the commands to be executed",
-                    action="store_true",
-                    default=False,
-                    dest='dry_run')
-
-build_type_group = parser.add_argument_group('build type')
-build_type_mutex = build_type_group.add_mutually_exclusive_group()
-
-build_type_mutex.add_argument('-opt', '--release',
-                              help="build release version",
-                              action='store_true',
-                              default=False,
-                              dest='build_type_opt')
-
-build_type_mutex.add_argument('-dbg', '--debug',
-                              help="build debug version",
-                              action='store_true',
-                              default=False,
-                              dest='build_type_dbg')
-
-build_type_mutex.add_argument('-rwd', '--relwithdebinfo',
-                              help="build release with debug info",
-                              action='store_true',
-                              default=False,
-                              dest='build_type_rwd')
-
-
-args = parser.parse_args()
-
-target_dist = args.dist
-njobs = args.jobs
+subparsers = parser.add_subparsers(dest='command', metavar='{build,worker,export,import,report}')
+
+# build
+build_parser = subparsers.add_parser('build', help='build a distribution (default command)')
+
+build_parser.add_argument('-p', '--prefix',
+                          help='installations prefix',
+                          type=str,
+                          dest='prefix',
+                          action='store',
+                          required=True)
+
+build_parser.add_argument('-d', '--dist',
+                          help='distributions to build; several distributions are built in one schedule, '
+                               'with the package versions they share built once',
+                          type=str,
+                          nargs='+',
+                          dest='dist',
+                          action='store',
+                          choices=dist_names,
+                          required=True)
+
+select_group = build_parser.add_argument_group('package selection',
+                                              'build a part of the distribution; packages it depends on must be built already, '
+                                              'nothing else is looked at. Several selectors select their intersection')
+
+select_group.add_argument('--only',
+                          help="comma-separated packages to build, and nothing else: their dependencies must be built "
+                               "already (use --until to build a package with what it needs)",
+                          type=name_list,
+                          metavar='PACKAGES',
+                          dest='only',
+                          action="store")
+
+select_group.add_argument('--from',
+                          help="comma-separated packages to build with everything that depends on them",
+                          type=name_list,
+                          metavar='PACKAGES',
+                          dest='from_',
+                          action="store")
+
+select_group.add_argument('--until',
+                          help="comma-separated packages to build with everything they depend on",
+                          type=name_list,
+                          metavar='PACKAGES',
+                          dest='until',
+                          action="store")
+
+build_parser.add_argument('-j', '--jobs',
+                          help='number of processors to use, all usable CPUs if no number is given',
+                          type=pos_int,
+                          default=1,
+                          nargs='?',
+                          const='',
+                          dest='jobs',
+                          action='store')
+
+build_parser.add_argument('--max-parallel-packages',
+                          help='maximum number of packages to build at the same time, jobs are split among them '
+                               '(default: 1, or the number of build types; 16 jobs in the queue with --distributed)',
+                          type=pos_count,
+                          dest='max_parallel_packages',
+                          action='store')
+
+build_parser.add_argument('--max-parallel-fetches',
+                          help='maximum number of package sources (clone, download, extract, patch) prepared at the same time',
+                          type=pos_count,
+                          default=4,
+                          dest='max_parallel_fetches',
+                          action='store')
+
+build_parser.add_argument('--max-memory',
+                          help='memory the builds may use, e.g. 32G; packages and jobs are admitted so that their '
+                               'estimated peak memory fits (default: 90%% of the memory available at start)',
+                          type=pos_size,
+                          dest='max_memory',
+                          action='store')
+
+build_parser.add_argument('--no-jobserver',
+                          help="pass -j to each package build instead of sharing the jobs through a jobserver",
+                          action="store_false",
+                          default=True,
+                          dest='use_jobserver')
+
+build_parser.add_argument('--build-dir',
+                          help="build directory",
+                          type=str,
+                          default="build",
+                          dest='build_dir',
+                          action="store")
+
+build_parser.add_argument('--patch-dir',
+                          help="patches directory",
+                          type=str,
+                          dest='patch_dir',
+                          action="store")
+
+build_parser.add_argument('--cache-dir',
+                          help="binary build cache directory, packages found in it are restored instead of rebuilt",
+                          type=str,
+                          dest='cache_dir',
+                          action="store")
+
+build_parser.add_argument('--git-cache-dir',
+                          help="directory of bare git mirrors shared by all clones on this host",
+                          type=str,
+                          dest='git_cache_dir',
+                          action="store")
+
+build_parser.add_argument('--git-clone-mode',
+                          help="full history, only the checked out commit (shallow), or file contents on demand (blobless)",
+                          type=str,
+                          choices=['full', 'shallow', 'blobless'],
+                          default='full',
+                          dest='git_clone_mode',
+                          action="store")
+
+build_parser.add_argument('--download-cache-dir',
+                          help="directory of downloaded archives shared by all builds on this host",
+                          type=str,
+                          dest='download_cache_dir',
+                          action="store")
+
+build_parser.add_argument('--compiler-cache',
+                          help="compile through ccache or sccache, set as CMAKE_<LANG>_COMPILER_LAUNCHER",
+                          type=str,
+                          choices=['ccache', 'sccache'],
+                          dest='compiler_cache',
+                          action="store")
+
+build_parser.add_argument('--compiler-cache-dir',
+                          help="compiler cache directory shared by all builds on this host (default: ~/.cache/extmgr/<tool>), "
+                               "partitioned by toolchain",
+                          type=str,
+                          dest='compiler_cache_dir',
+                          action="store")
+
+build_parser.add_argument('--compiler-cache-max-size',
+                          help="maximum size of the compiler cache, e.g. 50G; least recently used entries are evicted",
+                          type=str,
+                          dest='compiler_cache_max_size',
+                          action="store")
+
+build_parser.add_argument('-G', '--generator',
+                          help="CMake generator of new build trees (default: Ninja if installed, Unix Makefiles otherwise); "
+                               "existing build trees keep their generator",
+                          type=str,
+                          choices=['Ninja', 'Unix Makefiles'],
+                          dest='cmake_generator',
+                          action="store")
+
+build_parser.add_argument('--distributed',
+                          help="publish the package builds to `worker` processes (on any host sharing the prefix) "
+                               "through this queue directory (default: <prefix>/queue); sources are still prepared here",
+                          type=str,
+                          metavar='QUEUE_DIR',
+                          nargs='?',
+                          const='',
+                          dest='queue_dir',
+                          action="store")
+
+build_parser.add_argument('--events',
+                          help="write the build events (package and step start/end, skipped steps, cache hits, "
+                               "lock waits) to this file, one JSON object per line",
+                          type=str,
+                          dest='events_path',
+                          action="store")
+
+build_parser.add_argument('--trace',
+                          help="write a timeline of the build to this file, to be opened in https://ui.perfetto.dev "
+                               "or chrome://tracing",
+                          type=str,
+                          dest='trace_path',
+                          action="store")
+
+build_parser.add_argument('--dry-run',
+                          help="only show the commands to be executed",
+                          action="store_true",
+                          default=False,
+                          dest='dry_run')
+
+add_build_type_args(build_parser, matrix=True)
+
+# worker
+worker_parser = subparsers.add_parser('worker', help='build the packages published by `build --distributed`')
+
+worker_parser.add_argument('-p', '--prefix',
+                           help='installations prefix, shared with the coordinator',
+                           type=str,
+                           dest='prefix',
+                           action='store',
+                           required=True)
+
+worker_parser.add_argument('--queue-dir',
+                           help='queue directory of the coordinator (default: <prefix>/queue)',
+                           type=str,
+                           dest='queue_dir',
+                           action='store')
+
+worker_parser.add_argument('-j', '--jobs',
+                           help='number of processors to use, all usable CPUs if no number is given '
+                                '(default: the number of the coordinator)',
+                           type=pos_int,
+                           nargs='?',
+                           const='',
+                           dest='jobs',
+                           action='store')
+
+worker_parser.add_argument('--max-memory',
+                           help='memory the builds may use, e.g. 32G (default: 90%% of the memory available when a build starts)',
+                           type=pos_size,
+                           dest='max_memory',
+                           action='store')
+
+worker_parser.add_argument('--idle-timeout',
+                           help='stop after this many seconds without a job (default: never)',
+                           type=float,
+                           dest='idle_timeout',
+                           action='store')
+
+# export
+export_parser = subparsers.add_parser('export', help='export an installed distribution to a relocatable bundle')
+
+export_parser.add_argument('-p', '--prefix',
+                           help='installations prefix',
+                           type=str,
+                           dest='prefix',
+                           action='store',
+                           required=True)
+
+export_parser.add_argument('-d', '--dist',
+                           help='distribution to export',
+                           type=str,
+                           dest='dist',
+                           action='store',
+                           choices=dist_names,
+                           required=True)
+
+export_parser.add_argument('-o', '--output',
+                           help='bundle directory to write',
+                           type=str,
+                           dest='bundle_dir',
+                           action='store',
+                           required=True)
+
+add_build_type_args(export_parser)
+
+# import
+import_parser = subparsers.add_parser('import', help='import a bundle into an installations prefix')
+
+import_parser.add_argument('-p', '--prefix',
+                           help='installations prefix',
+                           type=str,
+                           dest='prefix',
+                           action='store',
+                           required=True)
+
+import_parser.add_argument('-i', '--input',
+                           help='bundle directory to import',
+                           type=str,
+                           dest='bundle_dir',
+                           action='store',
+                           required=True)
+
+# report
+report_parser = subparsers.add_parser('report', help='rank packages and steps by the resources they used in past builds')
+
+report_parser.add_argument('-p', '--prefix',
+                           help='installations prefix',
+                           type=str,
+                           dest='prefix',
+                           action='store',
+                           required=True)
+
+report_parser.add_argument('--sort',
+                           help='ranking key: wall time, cpu time, peak memory or bytes written',
+                           type=str,
+                           choices=['wall', 'cpu', 'max_rss', 'written'],
+                           default='wall',
+                           dest='sort_by',
+                           action='store')
+
+report_parser.add_argument('--top',
+                           help='number of packages and steps to show',
+                           type=int,
+                           default=20,
+                           dest='top',
+                           action='store')
+
+report_parser.add_argument('--all-flags',
+                           help='include all build flags instead of the selected build type only',
+                           action='store_true',
+                           default=False,
+                           dest='all_flags')
+
+add_build_type_args(report_parser)
+
+
+# `build` is the default command
+argv = sys.argv[1:]
+if len(argv) == 0 or (argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help')):
+    argv = ['build'] + argv
+
+args = parser.parse_args(argv)
+
 install_prefix = Path(args.prefix).resolve()
-build_dir = Path(args.build_dir).resolve()
-patch_dir = (Path(__file__).parent / 'patches').resolve() if args.patch_dir is None else Path(args.patch_dir).resolve()
 
-cmake_build_type: Literal['Release', 'Debug', 'RelWithDebInfo'] = 'Release'
-if args.build_type_opt:
-    cmake_build_type = 'Release'
-elif args.build_type_dbg:
-    cmake_build_type = 'Debug'
-elif args.build_type_rwd:
-    cmake_build_type = 'RelWithDebInfo'
+build_type_aliases = ['opt']
+if getattr(args, 'build_types', None):
+    build_type_aliases = args.build_types
+elif getattr(args, 'build_type_opt', False):
+    build_type_aliases = ['opt']
+elif getattr(args, 'build_type_dbg', False):
+    build_type_aliases = ['dbg']
+elif getattr(args, 'build_type_rwd', False):
+    build_type_aliases = ['rwd']
 
 
 ##############################################################################
@@ -144,31 +472,160 @@ except Exception as e:
     logger.error(f"Failed to get OS release info: {e}")
     exit(1)
 
-build_type_alias = {
-    'Release': 'opt',
-    'Debug': 'dbg',
-    'RelWithDebInfo': 'rwd'
-}[cmake_build_type]
-
-build_flag = f'{platform.processor()}-{os_alias}-{gcc_version}-{build_type_alias}'
-
-build_config = extmgr.BuildConfig(
-    patch_dir=patch_dir,
-    build_prefix=build_dir,
-    install_prefix=install_prefix,
-    cmake_build_type=cmake_build_type,
-    build_flag=build_flag,
-    n_jobs=njobs,
-    dry_run=args.dry_run
-)
+# {build_flag: cmake_build_type}, the first one is used by commands that take a single build type
+build_flags = {f'{platform.processor()}-{os_alias}-{gcc_version}-{alias}': BUILD_TYPES[alias] for alias in build_type_aliases}
+
+build_flag, cmake_build_type = next(iter(build_flags.items()))
 
-logger.info(f"Distribution: {target_dist}")
-logger.info(f"Install Prefix: {install_prefix}")
-logger.info(f"Build Directory: {build_dir}")
-logger.info(f"Number of jobs: {njobs}")
-logger.info(f"Patches Directory: {patch_dir}")
-logger.info(f"CMake Build Type: {cmake_build_type}")
-logger.info(f"Build Flag: {build_flag}")
 
-pkg_executor = extmgr.Executor()
-pkg_executor.make_distribution(target_dist, build_config)
+##############################################################################
+################################ Run command #################################
+##############################################################################
+pkg_executor = extmgr.core.Executor()
+
+if args.command == 'build':
+    target_dists = list(dict.fromkeys(args.dist))
+    njobs = args.jobs
+    build_dir = Path(args.build_dir).resolve()
+    cache_dir = Path(args.cache_dir).resolve() if args.cache_dir is not None else None
+    git_cache_dir = Path(args.git_cache_dir).resolve() if args.git_cache_dir is not None else None
+    download_cache_dir = Path(args.download_cache_dir).resolve() if args.download_cache_dir is not None else None
+    compiler_cache_dir = Path(args.compiler_cache_dir).resolve() if args.compiler_cache_dir is not None else None
+    patch_dir = (Path(__file__).parent / 'patches').resolve() if args.patch_dir is None else Path(args.patch_dir).resolve()
+
+    queue_dir = None
+    if args.queue_dir is not None:
+        queue_dir = Path(args.queue_dir).resolve() if args.queue_dir != '' else install_prefix / 'queue'
+
+    # Several build types are built as parallel branches of one schedule, distributed builds keep
+    # enough jobs in the queue for several workers
+    max_parallel_packages = args.max_parallel_packages
+    if max_parallel_packages is None:
+        max_parallel_packages = 16 if queue_dir is not None else len(build_flags)
+
+    build_config = extmgr.BuildConfig(
+        patch_dir=patch_dir,
+        build_prefix=build_dir,
+        install_prefix=install_prefix,
+        cmake_build_type=cmake_build_type,
+        build_flag=build_flag,
+        n_jobs=njobs,
+        max_parallel_packages=max_parallel_packages,
+        max_parallel_fetches=args.max_parallel_fetches,
+        use_jobserver=args.use_jobserver,
+        cache_dir=cache_dir,
+        git_cache_dir=git_cache_dir,
+        git_clone_mode=args.git_clone_mode,
+        download_cache_dir=download_cache_dir,
+        dry_run=args.dry_run,
+        max_memory=args.max_memory,
+        compiler_cache=args.compiler_cache,
+        compiler_cache_dir=compiler_cache_dir,
+        compiler_cache_max_size=args.compiler_cache_max_size,
+        cmake_generator=args.cmake_generator,
+        queue_dir=queue_dir
+    )
+
+    logger.info(f"Distribution: {', '.join(target_dists)}")
+    logger.info(f"Install Prefix: {install_prefix}")
+    logger.info(f"Build Directory: {build_dir}")
+    logger.info(f"Number of jobs: {njobs or 'all CPUs'}")
+    logger.info(f"Max Memory: {f'{args.max_memory / 2**30:.1f} GiB' if args.max_memory else 'available memory'}")
+    logger.info(f"Max Parallel Packages: {max_parallel_packages}")
+    logger.info(f"Max Parallel Fetches: {args.max_parallel_fetches}")
+    logger.info(f"Patches Directory: {patch_dir}")
+    logger.info(f"Build Cache: {cache_dir}")
+    logger.info(f"Git Cache: {git_cache_dir} ({args.git_clone_mode} clones)")
+    logger.info(f"Download Cache: {download_cache_dir}")
+    logger.info(f"Compiler Cache: {args.compiler_cache} {compiler_cache_dir or ''}")
+    logger.info(f"CMake Generator: {args.cmake_generator or 'Ninja if installed'}")
+    logger.info(f"CMake Build Type: {', '.join(build_flags.values())}")
+    logger.info(f"Build Flag: {', '.join(build_flags)}")
+    logger.info(f"Distributed Queue: {queue_dir}")
+
+    build_configs = [dataclasses.replace(build_config, build_flag=flag, cmake_build_type=build_type)
+                     for flag, build_type in build_flags.items()]
+
+    # Package selection
+    selected_packages = None
+    if args.only is not None or args.from_ is not None or args.until is not None:
+        # Each distribution selects among its own packages
+        dist_packages = {d: {p.name for p in pkg_executor.get_distribution(d).sorted_packages()} for d in target_dists}
+        unknown = [p for p in (args.only or []) + (args.from_ or []) + (args.until or [])
+                   if not any(p in names for names in dist_packages.values())]
+        if unknown:
+            logger.error(f"Package {', '.join(unknown)} not in distribution {', '.join(target_dists)}")
+            exit(1)
+
+        def in_dist(names: list[str], dist_name: str) -> list[str]:
+            return None if names is None else [p for p in names if p in dist_packages[dist_name]]
+
+        selected_packages = list(dict.fromkeys(
+            p for d in target_dists
+            for p in pkg_executor.get_distribution(d).select(in_dist(args.only, d), in_dist(args.from_, d), in_dist(args.until, d))))
+
+        if len(selected_packages) == 0:
+            logger.error("No package selected")
+            exit(1)
+        logger.info(f"Packages: {', '.join(selected_packages)}")
+
+    sinks = []
+    if args.events_path is not None:
+        sinks.append(extmgr.core.JsonLinesSink(Path(args.events_path).resolve()))
+        logger.info(f"Build Events: {sinks[-1].path}")
+    if args.trace_path is not None:
+        sinks.append(extmgr.core.ChromeTraceSink(Path(args.trace_path).resolve()))
+        logger.info(f"Build Trace: {sinks[-1].path}")
+
+    for sink in sinks:
+        pkg_executor.events.subscribe(sink)
+    try:
+        ok = pkg_executor.make_distribution(target_dists, build_configs, selected_packages)
+    finally:
+        for sink in sinks:
+            pkg_executor.events.unsubscribe(sink)
+            sink.close()
+
+elif args.command == 'worker':
+    queue_dir = Path(args.queue_dir).resolve() if args.queue_dir is not None else install_prefix / 'queue'
+
+    # Host settings of the worker replace the coordinator's
+    overrides = {'max_memory': args.max_memory}
+    if args.jobs is not None:
+        overrides['n_jobs'] = args.jobs
+
+    logger.info(f"Install Prefix: {install_prefix}")
+    logger.info(f"Queue Directory: {queue_dir}")
+    logger.info(f"Number of jobs: {'coordinator' if args.jobs is None else args.jobs or 'all CPUs'}")
+    ok = pkg_executor.work(queue_dir, overrides, args.idle_timeout)
+
+elif args.command == 'report':
+    logger.info(f"Install Prefix: {install_prefix}")
+    ok = pkg_executor.report(install_prefix,
+                             build_flag=None if args.all_flags else build_flag,
+                             sort_by=args.sort_by,
+                             top=args.top)
+
+else:
+    # Export and import only need the install prefix and the build flag
+    build_config = extmgr.BuildConfig(
+        patch_dir=(Path(__file__).parent / 'patches').resolve(),
+        build_prefix=Path('build').resolve(),
+        install_prefix=install_prefix,
+        cmake_build_type=cmake_build_type,
+        build_flag=build_flag
+    )
+
+    bundle_dir = Path(args.bundle_dir).resolve()
+
+    logger.info(f"Install Prefix: {install_prefix}")
+    logger.info(f"Bundle Directory: {bundle_dir}")
+
+    if args.command == 'export':
+        logger.info(f"Distribution: {args.dist}")
+        logger.info(f"Build Flag: {build_flag}")
+        ok = pkg_executor.export_distribution(args.dist, build_config, bundle_dir)
+    else:
+        ok = pkg_executor.import_bundle(bundle_dir, build_config)
+
+exit(0 if ok else 1)
@@ -0,0 +1,90 @@
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from extmgr.core import BuildConfig, BuildEvent, Executor, PackageRegistry  # noqa: E402
+from benchmarks.synthetic import write_recipes  # noqa: E402
+
+
+@pytest.fixture
+def executor():
+    """
+    The executor, with its registry and distributions restored after the test.
+    """
+    ex = Executor()
+    ex.distribution_names()
+
+    saved = ex.registry, dict(ex.dist_specs), dict(ex._dists)
+    yield ex
+    ex.registry, ex.dist_specs, ex._dists = saved
+
+
+@pytest.fixture
+def synthetic_dist(executor, tmp_path):
+    """
+    Register a distribution of synthetic packages, see `benchmarks/synthetic.py`.
+    Returns a function `(dag, step_kind='true') -> dist_name`.
+    """
+    def register(dag: dict[str, list[str]], step_kind: str = 'true') -> str:
+        module = f'test_recipes_{uuid.uuid4().hex[:8]}'
+        recipes = write_recipes(tmp_path / 'recipes' / module, dag, step_kind)
+        sys.path.insert(0, str(recipes.parent))
+
+        executor.registry = PackageRegistry(Executor.RECIPE_ROOTS | {module: recipes}, tmp_path / f'{module}.json')
+        executor.register_distribution(module, [(name, '1.0') for name in dag], dag)
+        return module
+
+    return register
+
+
+def restart(executor: Executor) -> None:
+    """
+    Forget all package instances, like a new `main.py` run.
+    """
+    executor.registry = PackageRegistry(executor.registry.roots, executor.registry.index_path)
+    executor._dists.clear()
+
+
+def make_config(prefix: Path, build_flag: str = 't-opt', cmake_build_type: str = 'Release', **kwargs) -> BuildConfig:
+    return BuildConfig(patch_dir=prefix / 'patches',
+                       build_prefix=prefix / 'build',
+                       install_prefix=prefix / 'install',
+                       cmake_build_type=cmake_build_type,
+                       build_flag=build_flag,
+                       **kwargs)
+
+
+class EventRecorder:
+    """
+    Build event subscriber keeping all events.
+    """
+    def __init__(self) -> None:
+        self.events: list[BuildEvent] = []
+
+    def __call__(self, event: BuildEvent) -> None:
+        self.events.append(event)
+
+    def of_kind(self, kind: str) -> list[BuildEvent]:
+        return [e for e in self.events if e.kind == kind]
+
+
+def build(executor: Executor, dist: str, *configs: BuildConfig) -> set[tuple[str, str, str]]:
+    """
+    Build a distribution in a new registry, like a new `main.py` run.
+
+    Returns:
+        set[tuple[str, str, str]]: `(package, flag, step)` of the steps that ran.
+    """
+    restart(executor)
+    recorder = EventRecorder()
+    executor.events.subscribe(recorder)
+    try:
+        assert executor.make_distribution(dist, list(configs))
+    finally:
+        executor.events.unsubscribe(recorder)
+    return {(e.package, e.flag, e.step) for e in recorder.of_kind('step_start')}
@@ -0,0 +1,28 @@
+from conftest import EventRecorder, make_config, restart
+
+
+def test_export_import_then_rebuild_runs_nothing(executor, synthetic_dist, tmp_path):
+    dist = synthetic_dist({'pkga': [], 'pkgb': ['pkga'], 'pkgc': ['pkga', 'pkgb']})
+
+    config = make_config(tmp_path / 'a')
+    assert executor.make_distribution(dist, config)
+
+    # Every command runs in a new process
+    restart(executor)
+    assert executor.export_distribution(dist, config, tmp_path / 'bundle')
+
+    restart(executor)
+    imported = make_config(tmp_path / 'b')
+    assert executor.import_bundle(tmp_path / 'bundle', imported)
+
+    restart(executor)
+
+    recorder = EventRecorder()
+    executor.events.subscribe(recorder)
+    try:
+        assert executor.make_distribution(dist, imported)
+    finally:
+        executor.events.unsubscribe(recorder)
+
+    assert recorder.of_kind('step_start') == []
+    assert len(recorder.of_kind('package_end')) == 3
@@ -0,0 +1,20 @@
+from conftest import make_config
+
+
+def test_compiler_cache_choice_changes_the_config_step(executor, tmp_path):
+    package = executor.get_distribution('local720')._packages['BesAlist']
+
+    steps, fingerprints = {}, {}
+    for tool in (None, 'ccache', 'sccache'):
+        package.set_config(make_config(tmp_path, compiler_cache=tool))
+        steps[tool] = dict(package.build_steps())
+        fingerprints[tool] = package.fingerprints()
+
+    assert '-UCMAKE_C_COMPILER_LAUNCHER -UCMAKE_CXX_COMPILER_LAUNCHER' in steps[None]['config'][0]
+    assert '-DCMAKE_CXX_COMPILER_LAUNCHER="$(command -v ccache)"' in steps['ccache']['config'][0]
+
+    # Sources are shared, every build step from the configuration on is redone
+    src_fps = {tool: fps[0] for tool, fps in fingerprints.items()}
+    config_fps = {tool: fps[1][0] for tool, fps in fingerprints.items()}
+    assert len(set(map(tuple, src_fps.values()))) == 1
+    assert len(set(config_fps.values())) == 3
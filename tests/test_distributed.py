@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import textwrap
+import time
+
+from extmgr.core import StampStore, WorkQueue
+
+from conftest import REPO_DIR, EventRecorder, make_config, restart
+
+WORKER = '''
+import sqlite3, sys
+sys.path[:0] = [{repo!r}, {recipes!r}]
+
+def no_database(*args, **kwargs):
+    raise RuntimeError('workers must not open the stamp database')
+sqlite3.connect = no_database
+
+from pathlib import Path
+from extmgr.core import Executor, PackageRegistry
+
+ex = Executor()
+ex.distribution_names()
+ex.registry = PackageRegistry(Executor.RECIPE_ROOTS | {{{dist!r}: Path({recipes!r}) / {dist!r}}}, Path({index!r}))
+ex.register_distribution({dist!r}, [(name, '1.0') for name in {dag!r}], {dag!r})
+sys.exit(0 if ex.work(Path({queue!r}), idle_timeout=2) else 1)
+'''
+
+
+def test_workers_return_stamps_to_the_coordinator(executor, synthetic_dist, tmp_path):
+    dag = {'pkga': [], 'pkgb': ['pkga'], 'pkgc': ['pkga'], 'pkgd': ['pkgb', 'pkgc']}
+    dist = synthetic_dist(dag)
+
+    config = make_config(tmp_path / 'prefix', max_parallel_packages=4, queue_dir=tmp_path / 'queue')
+    script = WORKER.format(repo=str(REPO_DIR), recipes=str(tmp_path / 'recipes'), dist=dist, dag=dag,
+                           index=str(tmp_path / 'worker-index.json'), queue=str(config.queue_dir))
+    workers = [subprocess.Popen([sys.executable, '-c', textwrap.dedent(script)]) for _ in range(2)]
+    try:
+        assert executor.make_distribution(dist, config)
+    finally:
+        assert [w.wait(timeout=60) for w in workers] == [0, 0]
+
+    with sqlite3.connect(config.install_prefix / StampStore.DB_NAME) as conn:
+        runs = {row[0] for row in conn.execute('SELECT package FROM step_runs WHERE ok = 1')}
+    assert runs == set(dag)
+
+    # The coordinator wrote the stamps, a local build finds everything built
+    restart(executor)
+    recorder = EventRecorder()
+    executor.events.subscribe(recorder)
+    try:
+        assert executor.make_distribution(dist, make_config(tmp_path / 'prefix'))
+    finally:
+        executor.events.unsubscribe(recorder)
+
+    assert recorder.of_kind('step_start') == []
+
+
+def test_claimed_job_that_waited_long_is_not_requeued(tmp_path):
+    coordinator = WorkQueue(tmp_path / 'queue', stale_after=300)
+    worker = WorkQueue(tmp_path / 'queue', stale_after=300)
+
+    job_id = coordinator.publish({'package': 'pkga'})
+    published = time.time() - 400
+    os.utime(coordinator._job_path('pending', job_id), (published, published))
+
+    # The coordinator polls between the worker's rename and its claim record
+    def worker_name() -> str:
+        coordinator._requeue_if_stale(job_id)
+        return 'worker:1'
+    worker.worker_name = worker_name
+
+    assert worker.claim()['id'] == job_id
+    assert not coordinator._job_path('pending', job_id).exists()
+    assert worker.claim() is None
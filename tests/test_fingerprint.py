@@ -0,0 +1,111 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+from extmgr.core import StampStore
+
+from conftest import build, make_config
+
+DAG = {'pkga': [], 'pkgb': ['pkga'], 'pkgc': ['pkgb'], 'pkgd': []}
+
+# A recipe whose config step reads a patch file of its build flag, and whose build step gets `-j`
+RECIPE = '''from extmgr import BasePackage
+
+
+class {class_name}(BasePackage):
+    @property
+    def name(self) -> str: return '{name}'
+
+    @property
+    def version(self) -> str: return '1.0'
+
+    def prepare_src_steps(self):
+        return [('fetch', ['true'])]
+
+    def build_steps(self):
+        return [('config', [f'cat {patch_dir}/{{self.name}}-{{self.build_flag}}.patch > /dev/null']),
+                ('build', [f'{build_cmd} -j{{self.n_jobs}}'])]
+'''
+
+
+@pytest.fixture
+def dist(synthetic_dist, tmp_path):
+    """
+    A synthetic distribution of `DAG` with the recipes of `RECIPE`.
+    """
+    name = synthetic_dist(DAG)
+    for package in DAG:
+        for flag in ('t-opt', 't-dbg'):
+            write_patch(tmp_path, package, flag, 'initial')
+        write_recipe(tmp_path, name, package, 'true')
+    return name
+
+
+def write_patch(tmp_path: Path, package: str, flag: str, text: str) -> None:
+    (tmp_path / 'patches').mkdir(exist_ok=True)
+    (tmp_path / 'patches' / f'{package}-{flag}.patch').write_text(text)
+
+
+def write_recipe(tmp_path: Path, dist: str, package: str, build_cmd: str) -> None:
+    text = RECIPE.format(class_name=package.capitalize(), name=package, patch_dir=tmp_path / 'patches', build_cmd=build_cmd)
+    (tmp_path / 'recipes' / dist / f'{package}.py').write_text(text)
+    # Imported again by the next registry
+    sys.modules.pop(f'{dist}.{package}', None)
+
+
+def build_steps(packages: list[str], flag: str = 't-opt') -> set[tuple[str, str, str]]:
+    return {(p, flag, step) for p in packages for step in ('config', 'build')}
+
+
+def test_rerun_skips_every_step(executor, dist, tmp_path):
+    config = make_config(tmp_path / 'prefix')
+    ran = build(executor, dist, config)
+    assert ran == build_steps(DAG) | {(p, '', 'fetch') for p in DAG}
+
+    assert build(executor, dist, config) == set()
+
+
+def test_changing_one_flag_leaves_the_other_alone(executor, dist, tmp_path):
+    opt = make_config(tmp_path / 'prefix', 't-opt')
+    dbg = make_config(tmp_path / 'prefix', 't-dbg', cmake_build_type='Debug')
+    build(executor, dist, opt, dbg)
+
+    write_patch(tmp_path, 'pkgd', 't-dbg', 'changed')
+    assert build(executor, dist, opt, dbg) == build_steps(['pkgd'], 't-dbg')
+
+
+def test_patch_change_reruns_package_and_dependents(executor, dist, tmp_path):
+    config = make_config(tmp_path / 'prefix')
+    build(executor, dist, config)
+
+    write_patch(tmp_path, 'pkgb', 't-opt', 'changed')
+    assert build(executor, dist, config) == build_steps(['pkgb', 'pkgc'])
+
+
+def test_recipe_change_reruns_package_and_dependents(executor, dist, tmp_path):
+    config = make_config(tmp_path / 'prefix')
+    build(executor, dist, config)
+
+    write_recipe(tmp_path, dist, 'pkga', 'true --changed')
+    assert build(executor, dist, config) == {('pkga', 't-opt', 'build')} | build_steps(['pkgb', 'pkgc'])
+
+
+def test_number_of_jobs_is_not_fingerprinted(executor, dist, tmp_path):
+    build(executor, dist, make_config(tmp_path / 'prefix', n_jobs=1))
+
+    assert build(executor, dist, make_config(tmp_path / 'prefix', n_jobs=4)) == set()
+
+
+def test_legacy_timestamps_are_upgraded_without_rebuild(executor, dist, tmp_path):
+    config = make_config(tmp_path / 'prefix')
+    build(executor, dist, config)
+
+    # Stamps of older versions are plain timestamps, in the order the steps ran
+    store = StampStore.for_prefix(config.install_prefix)
+    for package, version, flag, step, _, time in store.query():
+        store.upsert(package, version, flag, step, time)
+
+    assert build(executor, dist, config) == set()
+    assert all(fingerprint is not None for *_, fingerprint, _ in store.query())
+    assert build(executor, dist, config) == set()
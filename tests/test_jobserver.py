@@ -0,0 +1,25 @@
+from extmgr.core import BasePackage
+
+from conftest import make_config
+
+
+def test_old_ninja_gets_its_own_jobs_with_the_whole_pool(executor, synthetic_dist, tmp_path, monkeypatch):
+    dist = synthetic_dist({'pkga': [], 'pkgb': ['pkga']})
+
+    # ninja < 1.13 cannot join the jobserver
+    monkeypatch.setattr(BasePackage, 'ninja_version', staticmethod(lambda: '1.10.2'))
+
+    envs = {}
+    def build(package):
+        envs[package.name] = package._step_env()
+        return True
+    monkeypatch.setattr(BasePackage, '_build', build)
+
+    config = make_config(tmp_path, n_jobs=4, max_parallel_packages=1, max_memory=64 << 30)
+    assert executor.make_distribution(dist, config)
+
+    assert set(envs) == {'pkga', 'pkgb'}
+    for env in envs.values():
+        assert env['CMAKE_GENERATOR'] == 'Ninja'
+        assert 'MAKEFLAGS' not in env
+        assert env['CMAKE_BUILD_PARALLEL_LEVEL'] == '4'
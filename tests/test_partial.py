@@ -0,0 +1,28 @@
+import logging
+
+from conftest import EventRecorder, make_config
+
+
+def test_only_fails_before_fetching_and_names_unbuilt_dependencies(executor, synthetic_dist, tmp_path, caplog):
+    dist = synthetic_dist({'pkga': [], 'pkgb': ['pkga'], 'pkgc': ['pkgb']})
+    config = make_config(tmp_path)
+
+    recorder = EventRecorder()
+    executor.events.subscribe(recorder)
+    try:
+        with caplog.at_level(logging.ERROR):
+            assert not executor.make_distribution(dist, config, ['pkgc'])
+    finally:
+        executor.events.unsubscribe(recorder)
+
+    assert recorder.events == []
+    assert 'pkga (needed by pkgc); pkgb (needed by pkgc)' in caplog.text
+
+
+def test_until_builds_the_dependencies(executor, synthetic_dist, tmp_path):
+    dist = synthetic_dist({'pkga': [], 'pkgb': ['pkga'], 'pkgc': ['pkgb'], 'pkgd': []})
+    selected = executor.get_distribution(dist).select(until=['pkgc'])
+    assert selected == ['pkga', 'pkgb', 'pkgc']
+
+    assert executor.make_distribution(dist, make_config(tmp_path), selected)
+    assert executor.make_distribution(dist, make_config(tmp_path), ['pkgc'])
@@ -0,0 +1,66 @@
+import json
+import sys
+
+from extmgr.core import StampStore
+
+from conftest import build, make_config
+
+# A source step whose name looks like `<build flag>-<step>`
+RECIPE = '''from extmgr import BasePackage
+
+
+class {class_name}(BasePackage):
+    @property
+    def name(self) -> str: return '{name}'
+
+    @property
+    def version(self) -> str: return '1.0'
+
+    def prepare_src_steps(self):
+        return [('fetch-src-for-opt-build', ['true']), ('apply-patch-for-gcc-13', ['true'])]
+
+    def build_steps(self):
+        return [('config', ['true']), ('build', ['true'])]
+'''
+
+
+def test_split_step_key_recognizes_build_flags():
+    assert StampStore.split_step_key('x86_64-el9-gcc13-opt-build') == ('x86_64-el9-gcc13-opt', 'build')
+    assert StampStore.split_step_key('-debian12-gcc12-dbg-config') == ('-debian12-gcc12-dbg', 'config')
+    assert StampStore.split_step_key('apply-patch-for-gcc-13') == ('', 'apply-patch-for-gcc-13')
+
+    flags = ['x86_64-el9-gcc13-opt']
+    assert StampStore.split_step_key('fetch-src-for-opt-build', known_flags=flags) == ('', 'fetch-src-for-opt-build')
+    assert StampStore.split_step_key('x86_64-el9-gcc13-opt-build', known_flags=flags) == ('x86_64-el9-gcc13-opt', 'build')
+
+
+def test_migrated_json_stamps_rerun_nothing(executor, synthetic_dist, tmp_path):
+    dag = {'pkga': [], 'pkgb': ['pkga']}
+    dist = synthetic_dist(dag)
+    for package in dag:
+        (tmp_path / 'recipes' / dist / f'{package}.py').write_text(RECIPE.format(class_name=package.capitalize(), name=package))
+        sys.modules.pop(f'{dist}.{package}', None)
+
+    opt = make_config(tmp_path / 'prefix', 'x86_64-el9-gcc13-opt')
+    dbg = make_config(tmp_path / 'prefix', 'x86_64-el9-gcc13-dbg', cmake_build_type='Debug')
+    build(executor, dist, opt, dbg)
+
+    # Rewrite the stamps as the `step_stamp.json` files of older versions, with timestamps only
+    db_path = opt.install_prefix.resolve() / StampStore.DB_NAME
+    legacy = {}
+    for package, version, flag, step, _, time in StampStore.for_prefix(opt.install_prefix).query():
+        legacy.setdefault((package, version), {})[StampStore.step_key(flag, step)] = time
+    for (package, version), stamps in legacy.items():
+        (opt.install_prefix / package / version / 'step_stamp.json').write_text(json.dumps(stamps))
+
+    StampStore._stores.pop(db_path)
+    for path in db_path.parent.glob(f'{StampStore.DB_NAME}*'):
+        path.unlink()
+
+    assert build(executor, dist, opt, dbg) == set()
+
+    # Source steps are filed as shared by all build flags
+    rows = StampStore.for_prefix(opt.install_prefix).query()
+    assert {flag for *_, flag, _, _, _ in rows} == {'', opt.build_flag, dbg.build_flag}
+    assert {step for _, _, flag, step, _, _ in rows if flag == ''} == {'fetch-src-for-opt-build', 'apply-patch-for-gcc-13'}
+    assert all((opt.install_prefix / package / '1.0' / 'step_stamp.json.migrated').exists() for package in dag)